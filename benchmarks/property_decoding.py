@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""Microbenchmark for dumping end users with many attributes.
+
+Compares the converter table on EndUserPropertyTypes against the old
+eval-per-property decoding. Runs without a database or app context:
+
+    python -m benchmarks.property_decoding --users 100 --attributes 60
+"""
+import argparse
+import datetime as dt
+import json
+import timeit
+import uuid
+from types import SimpleNamespace
+
+from weasl.end_user.models import EndUserPropertyTypes
+from weasl.end_user.schema import EndUserSchema
+
+
+class EvalEndUserSchema(EndUserSchema):
+    """The end user schema as it decoded properties before the converter table."""
+
+    def attributes_from_properties(self, end_user):
+        attrs = {}
+        for prop in end_user.properties:
+            converter = eval('{}'.format(prop.property_type.value))
+            attrs[prop.property_name] = {
+                'value': converter(prop.property_value),
+                'trusted': prop.trusted,
+            }
+        return attrs
+
+
+SAMPLE_VALUES = [
+    (EndUserPropertyTypes.STRING, 'some string'),
+    (EndUserPropertyTypes.NUMBER, '42'),
+    (EndUserPropertyTypes.JSON, json.dumps({'plan': 'pro', 'seats': 5})),
+    (EndUserPropertyTypes.BOOLEAN, 'True'),
+]
+
+
+def make_end_user(num_attributes):
+    """Make an end user-like object with the given number of properties."""
+    now = dt.datetime.utcnow()
+    properties = []
+    for i in range(num_attributes):
+        prop_type, value = SAMPLE_VALUES[i % len(SAMPLE_VALUES)]
+        properties.append(SimpleNamespace(
+            property_name='attribute_{}'.format(i),
+            property_value=value,
+            property_type=prop_type,
+            trusted=bool(i % 2),
+        ))
+    return SimpleNamespace(
+        id=uuid.uuid4(),
+        email='user@example.com',
+        phone_number='+15555555555',
+        google_id=None,
+        created_at=now,
+        updated_at=now,
+        last_login_at=now,
+        properties=properties,
+    )
+
+
+def run(num_users, num_attributes, repeat):
+    """Time dumping the users with both schemas and return users dumped per second."""
+    end_users = [make_end_user(num_attributes) for _ in range(num_users)]
+    results = {}
+    for name, schema in (('eval', EvalEndUserSchema()), ('converter', EndUserSchema())):
+        best = min(timeit.repeat(lambda: schema.dump(end_users, many=True), number=1, repeat=repeat))
+        results[name] = num_users / best
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--attributes', type=int, default=60)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    results = run(args.users, args.attributes, args.repeat)
+    for name, users_per_second in results.items():
+        print('{:<10} {:>10.0f} users/s'.format(name, users_per_second))
+    print('speedup    {:>10.2f}x'.format(results['converter'] / results['eval']))
+
+
+if __name__ == '__main__':
+    main()
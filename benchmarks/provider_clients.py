@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""Benchmark reusing provider clients against building them per call.
+
+Times building an SES client per email against reusing one, and a bare
+requests.get against the pooled keep-alive session, using a local HTTP
+server so no provider is contacted:
+
+    python -m benchmarks.provider_clients --calls 200
+"""
+import argparse
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import boto3
+import requests
+
+from weasl.providers import make_http_session
+
+
+class OkHandler(BaseHTTPRequestHandler):
+    """Answers every GET with a small JSON body over keep-alive connections."""
+
+    protocol_version = 'HTTP/1.1'
+    # write headers and body in one segment so keep-alive isn't stalled by delayed ACKs
+    wbufsize = 64 * 1024
+
+    def do_GET(self):
+        body = b'{"verified_email": true}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def time_per_call(func, calls):
+    """Get the mean seconds per call of func."""
+    start = time.perf_counter()
+    for _ in range(calls):
+        func()
+    return (time.perf_counter() - start) / calls
+
+
+def run(calls):
+    """Run the benchmarks and return the mean milliseconds per call for each."""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), OkHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:{}/userinfo'.format(server.server_address[1])
+
+    ses_client = boto3.client('ses', region_name='us-west-2')
+    session = make_http_session(10)
+    results = {
+        'ses_client_per_call': time_per_call(lambda: boto3.client('ses', region_name='us-west-2'), max(calls // 10, 1)),
+        'ses_client_reused': time_per_call(lambda: ses_client, calls),
+        'http_requests_get': time_per_call(lambda: requests.get(url).json(), calls),
+        'http_pooled_session': time_per_call(lambda: session.get(url).json(), calls),
+    }
+    server.shutdown()
+    return {name: seconds * 1000 for name, seconds in results.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--calls', type=int, default=200)
+    args = parser.parse_args()
+
+    for name, millis in run(args.calls).items():
+        print('{:<22} {:>8.3f} ms/call'.format(name, millis))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+"""Gunicorn settings for the web process.
+
+The workers share their Prometheus metrics through files in a directory the
+master makes fresh on start, so /internal/metrics answers for all of them.
+
+With WEB_WORKER_CLASS=gevent each worker serves up to WEB_WORKER_CONNECTIONS
+requests at once on greenlets, switching away from a request whenever it
+waits on Postgres, Twilio, SES or Google, instead of one at a time.
+"""
+import os
+import shutil
+import tempfile
+
+worker_class = os.environ.get('WEB_WORKER_CLASS', 'sync')
+worker_connections = int(os.environ.get('WEB_WORKER_CONNECTIONS', 100))
+
+
+def on_starting(server):
+    """Make an empty metrics directory for the workers to inherit."""
+    path = os.environ.setdefault('prometheus_multiproc_dir', os.path.join(tempfile.gettempdir(), 'weasl-metrics'))
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+
+
+def post_fork(server, worker):
+    """Have psycopg2 wait on the gevent hub, since monkey patching doesn't reach its C sockets."""
+    if server.cfg.worker_class_str == 'gevent':
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+
+
+def child_exit(server, worker):
+    """Stop reporting the live gauges of a worker that exited."""
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
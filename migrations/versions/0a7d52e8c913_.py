@@ -0,0 +1,26 @@
+"""Adds row versions to orgs and end users
+
+Revision ID: 0a7d52e8c913
+Revises: f18c6d3a9b20
+Create Date: 2026-10-18 16:05:44.870213
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0a7d52e8c913'
+down_revision = 'f18c6d3a9b20'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('orgs', sa.Column('version', sa.Integer(), server_default='1', nullable=False))
+    op.add_column('end_users', sa.Column('version', sa.Integer(), server_default='1', nullable=False))
+
+
+def downgrade():
+    op.drop_column('end_users', 'version')
+    op.drop_column('orgs', 'version')
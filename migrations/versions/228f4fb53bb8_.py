@@ -0,0 +1,26 @@
+"""Enables pgcrypto for gen_random_uuid
+
+Revision ID: 228f4fb53bb8
+Revises: 7c3e9a1d5b24
+Create Date: 2026-10-18 21:04:37.118402
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '228f4fb53bb8'
+down_revision = '7c3e9a1d5b24'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # bulk imports create end users with gen_random_uuid(), which is only built in from Postgres 13
+    op.execute('CREATE EXTENSION IF NOT EXISTS pgcrypto')
+
+
+def downgrade():
+    # left in place: it may have been created before this migration, or be used by something else
+    pass
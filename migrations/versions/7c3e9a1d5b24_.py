@@ -0,0 +1,29 @@
+"""Adds idempotency keys to login tokens
+
+Revision ID: 7c3e9a1d5b24
+Revises: 0a7d52e8c913
+Create Date: 2026-10-18 19:12:08.524617
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7c3e9a1d5b24'
+down_revision = '0a7d52e8c913'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    for table in ('end_users_email_auth_token', 'end_users_sms_auth_token'):
+        op.add_column(table, sa.Column('idempotency_key', sa.String(length=255), nullable=True))
+        op.create_index('ix_{}_end_user_id_created_at'.format(table), table, ['end_user_id', 'created_at'],
+                        unique=False)
+
+
+def downgrade():
+    for table in ('end_users_sms_auth_token', 'end_users_email_auth_token'):
+        op.drop_index('ix_{}_end_user_id_created_at'.format(table), table_name=table)
+        op.drop_column(table, 'idempotency_key')
@@ -0,0 +1,28 @@
+"""Adds (org_id, created_at) indices for cursor pagination
+
+Revision ID: 9c2f4e1b7a3d
+Revises: 373d888b4475
+Create Date: 2026-10-18 10:40:12.118204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9c2f4e1b7a3d'
+down_revision = '373d888b4475'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_end_users_org_id_created_at', 'end_users', ['org_id', 'created_at'], unique=False)
+    op.create_index('ix_end_users_email_auth_token_org_id_created_at', 'end_users_email_auth_token', ['org_id', 'created_at'], unique=False)
+    op.create_index('ix_end_users_sms_auth_token_org_id_created_at', 'end_users_sms_auth_token', ['org_id', 'created_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_end_users_sms_auth_token_org_id_created_at', table_name='end_users_sms_auth_token')
+    op.drop_index('ix_end_users_email_auth_token_org_id_created_at', table_name='end_users_email_auth_token')
+    op.drop_index('ix_end_users_org_id_created_at', table_name='end_users')
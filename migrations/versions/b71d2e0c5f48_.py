@@ -0,0 +1,41 @@
+"""Adds the delivery outbox table
+
+Revision ID: b71d2e0c5f48
+Revises: 9c2f4e1b7a3d
+Create Date: 2026-10-18 11:02:37.540911
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = 'b71d2e0c5f48'
+down_revision = '9c2f4e1b7a3d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('delivery_outbox',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('channel', sa.Enum('SMS', 'EMAIL', name='outboxchannels'), nullable=False),
+    sa.Column('token', sa.String(length=36), nullable=False),
+    sa.Column('end_user_id', postgresql.UUID(as_uuid=True), nullable=False),
+    sa.Column('org_id', sa.Integer(), nullable=True),
+    sa.Column('created_at', sa.DateTime(timezone=True), nullable=False),
+    sa.Column('available_at', sa.DateTime(timezone=True), nullable=False),
+    sa.Column('delivered_at', sa.DateTime(timezone=True), nullable=True),
+    sa.Column('attempts', sa.Integer(), nullable=False),
+    sa.Column('last_error', sa.Text(), nullable=True),
+    sa.ForeignKeyConstraint(['end_user_id'], ['end_users.id'], ),
+    sa.ForeignKeyConstraint(['org_id'], ['orgs.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_delivery_outbox_pending', 'delivery_outbox', ['available_at'], unique=False, postgresql_where=sa.text('delivered_at IS NULL'))
+
+
+def downgrade():
+    op.drop_index('ix_delivery_outbox_pending', table_name='delivery_outbox')
+    op.drop_table('delivery_outbox')
+    sa.Enum(name='outboxchannels').drop(op.get_bind(), checkfirst=False)
@@ -0,0 +1,33 @@
+"""Adds the daily login rollup table
+
+Revision ID: d4a83c61e2f9
+Revises: b71d2e0c5f48
+Create Date: 2026-10-18 11:31:05.229473
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd4a83c61e2f9'
+down_revision = 'b71d2e0c5f48'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('login_daily_counts',
+    sa.Column('org_id', sa.Integer(), nullable=False),
+    sa.Column('day', sa.Date(), nullable=False),
+    sa.Column('sms_created', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('sms_used', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('email_created', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('email_used', sa.Integer(), server_default='0', nullable=False),
+    sa.ForeignKeyConstraint(['org_id'], ['orgs.id'], ),
+    sa.PrimaryKeyConstraint('org_id', 'day')
+    )
+
+
+def downgrade():
+    op.drop_table('login_daily_counts')
@@ -0,0 +1,31 @@
+"""Swaps the token active/sent indices for partial (org_id, token) indices on live tokens
+
+Revision ID: e5b19f07c2a6
+Revises: d4a83c61e2f9
+Create Date: 2026-10-18 14:02:37.551920
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5b19f07c2a6'
+down_revision = 'd4a83c61e2f9'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    for table in ('end_users_email_auth_token', 'end_users_sms_auth_token'):
+        op.drop_index('ix_{}_active'.format(table), table_name=table)
+        op.drop_index('ix_{}_sent'.format(table), table_name=table)
+        op.create_index('ix_{}_org_id_token_active'.format(table), table, ['org_id', 'token'], unique=False,
+                        postgresql_where=sa.text('active'))
+
+
+def downgrade():
+    for table in ('end_users_sms_auth_token', 'end_users_email_auth_token'):
+        op.drop_index('ix_{}_org_id_token_active'.format(table), table_name=table)
+        op.create_index('ix_{}_sent'.format(table), table, ['sent'], unique=False)
+        op.create_index('ix_{}_active'.format(table), table, ['active'], unique=False)
@@ -0,0 +1,57 @@
+"""Makes active SMS tokens unique per org
+
+Revision ID: f18c6d3a9b20
+Revises: e5b19f07c2a6
+Create Date: 2026-10-18 15:21:09.304116
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f18c6d3a9b20'
+down_revision = 'e5b19f07c2a6'
+branch_labels = None
+depends_on = None
+
+
+TABLE = 'end_users_sms_auth_token'
+INDEX = 'ix_end_users_sms_auth_token_org_id_token_active'
+
+
+def partitions():
+    """Get the table's partitions if `flask partition-tokens` has run, else None.
+
+    Postgres only allows unique indices on a partitioned table when they
+    include the partition key, so there the index is made on each partition,
+    named as weasl.end_user.retention names them.
+    """
+    bind = op.get_bind()
+    if not bind.execute(sa.text('SELECT EXISTS (SELECT 1 FROM pg_partitioned_table '
+                                'WHERE partrelid = to_regclass(:name))'), name=TABLE).scalar():
+        return None
+    return [name for name, in bind.execute(sa.text(
+        'SELECT child.relname FROM pg_inherits JOIN pg_class child ON child.oid = pg_inherits.inhrelid '
+        'WHERE pg_inherits.inhparent = to_regclass(:name)'), name=TABLE)]
+
+
+def upgrade():
+    op.execute('DROP INDEX IF EXISTS {}'.format(INDEX))
+    names = partitions()
+    if names is None:
+        op.create_index(INDEX, TABLE, ['org_id', 'token'], unique=True, postgresql_where=sa.text('active'))
+        return
+    for name in names:
+        op.execute('CREATE UNIQUE INDEX IF NOT EXISTS {0}_org_id_token_key ON {0} (org_id, token) WHERE active'.format(
+            name))
+
+
+def downgrade():
+    names = partitions()
+    if names is None:
+        op.drop_index(INDEX, table_name=TABLE)
+    else:
+        for name in names:
+            op.execute('DROP INDEX IF EXISTS {}_org_id_token_key'.format(name))
+    op.create_index(INDEX, TABLE, ['org_id', 'token'], unique=False, postgresql_where=sa.text('active'))
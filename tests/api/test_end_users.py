@@ -0,0 +1,537 @@
+# -*- encoding: utf-8 -*-
+"""Test the views at /end_users."""
+import base64
+import csv
+import gzip
+import io
+import json
+
+import pytest
+
+from weasl.commands import import_end_users
+from weasl.end_user.models import EmailToken, EndUser, EndUserProperty, EndUserPropertyTypes, LoginDailyCount, SMSToken
+from weasl.replica import REPLICA_BIND
+
+from ..conftest import QueryCounter
+from ..factories import EndUserFactory, EndUserPropFactory, OrgFactory
+
+
+def make_end_users(db, org, count):
+    """Make end users in the org, each with a couple of properties."""
+    end_users = [EndUserFactory(org_id=org.id) for _ in range(count)]
+    db.session.commit()
+    for end_user in end_users:
+        EndUserPropFactory(end_user_id=end_user.id, property_name='plan', property_value='pro',
+                           property_type=EndUserPropertyTypes.STRING)
+        EndUserPropFactory(end_user_id=end_user.id, property_name='seats', property_value='5',
+                           property_type=EndUserPropertyTypes.NUMBER)
+    db.session.commit()
+    return end_users
+
+
+@pytest.mark.usefixtures('db')
+class TestListEndUsers(object):
+    """Test GET /end_users."""
+
+    base_url = '/end_users?per_page={}'
+
+    def count_list_queries(self, testapp, end_user, db, query_counter, url):
+        token = end_user.encode_auth_token().decode('utf-8')
+        db.session.expunge_all()
+        with query_counter:
+            res = testapp.get(url, headers={'Authorization': 'Bearer {}'.format(token)})
+        return res, query_counter.count
+
+    def test_lists_attributes(self, testapp, end_user_as_weasl_user, org, db, query_counter):
+        """Test that every end user on the page comes back with their attributes."""
+        make_end_users(db, org, 3)
+        res, _ = self.count_list_queries(testapp, end_user_as_weasl_user, db, query_counter, self.base_url.format(10))
+        assert len(res.json['data']) == 4
+        assert sum('plan' in user['attributes'] for user in res.json['data']) == 3
+
+    def test_query_count_independent_of_page_size(self, testapp, end_user_as_weasl_user, org, db, query_counter):
+        """Test that listing more end users doesn't issue more queries."""
+        make_end_users(db, org, 20)
+        _, small_page = self.count_list_queries(testapp, end_user_as_weasl_user, db, query_counter, self.base_url.format(2))
+        _, large_page = self.count_list_queries(testapp, end_user_as_weasl_user, db, query_counter, self.base_url.format(20))
+        assert small_page == large_page
+
+
+@pytest.mark.usefixtures('db')
+class TestListLogins(object):
+    """Test GET /end_users/email-logins and /end_users/sms-logins."""
+
+    @pytest.mark.parametrize('token_cls, url', [
+        (EmailToken, '/end_users/email-logins?per_page={}'),
+        (SMSToken, '/end_users/sms-logins?per_page={}'),
+    ])
+    def test_query_count_independent_of_page_size(self, testapp, end_user_as_weasl_user, org, db, query_counter, token_cls, url):
+        """Test that listing more logins doesn't issue more queries."""
+        for end_user in make_end_users(db, org, 10):
+            token_cls.generate(end_user)
+        token = end_user_as_weasl_user.encode_auth_token().decode('utf-8')
+        counts = []
+        for per_page in (2, 10):
+            db.session.expunge_all()
+            with query_counter:
+                testapp.get(url.format(per_page), headers={'Authorization': 'Bearer {}'.format(token)})
+            counts.append(query_counter.count)
+        assert counts[0] == counts[1]
+
+
+@pytest.mark.usefixtures('db')
+class TestCursorPagination(object):
+    """Test GET /end_users?pagination=cursor."""
+
+    def get(self, testapp, end_user, url, **kwargs):
+        token = end_user.encode_auth_token().decode('utf-8')
+        return testapp.get(url, headers={'Authorization': 'Bearer {}'.format(token)}, **kwargs)
+
+    def test_walks_every_end_user_once(self, testapp, end_user_as_weasl_user, org, db):
+        """Test that following next links visits each end user exactly once, including ones without created_at."""
+        end_users = make_end_users(db, org, 6)
+        end_users[0].update(created_at=None)
+        end_users[1].update(created_at=end_users[2].created_at)
+        seen = []
+        url = '/end_users?pagination=cursor&per_page=3'
+        while url:
+            res = self.get(testapp, end_user_as_weasl_user, url)
+            seen += [user['id'] for user in res.json['data']]
+            url = res.json['meta']['pagination'].get('next')
+        assert len(seen) == 7
+        assert set(seen) == {str(end_user.id) for end_user in end_users + [end_user_as_weasl_user]}
+        assert seen[-1] == str(end_users[0].id)
+
+    def test_next_cursor_in_meta(self, testapp, end_user_as_weasl_user, org, db):
+        """Test that the next cursor is given alongside the next link."""
+        make_end_users(db, org, 2)
+        res = self.get(testapp, end_user_as_weasl_user, '/end_users?pagination=cursor&per_page=2')
+        pagination = res.json['meta']['pagination']
+        assert pagination['next'].endswith('&cursor={}'.format(pagination['next_cursor']))
+        assert 'count' not in pagination
+
+    @pytest.mark.parametrize('count', ['exact', 'estimate'])
+    def test_optional_count(self, testapp, end_user_as_weasl_user, org, db, count):
+        """Test that a count is only given when asked for."""
+        make_end_users(db, org, 2)
+        res = self.get(testapp, end_user_as_weasl_user, '/end_users?pagination=cursor&count={}'.format(count))
+        assert isinstance(res.json['meta']['pagination']['count'], int)
+
+    @pytest.mark.parametrize('url, key', [
+        ('/end_users', ['2020-01-01T00:00:00', 'abc']),
+        ('/end_users', ['2020-01-01T00:00:00', 5]),
+        ('/end_users', [None, None]),
+        ('/end_users/email-logins', ['2020-01-01T00:00:00', 'abc']),
+        ('/end_users/sms-logins', ['2020-01-01T00:00:00', 123456, '00000000-0000-0000-0000-000000000000']),
+    ])
+    def test_bad_cursor_key(self, testapp, end_user_as_weasl_user, url, key):
+        """Test that we get a 400 for a cursor whose key doesn't fit the key columns' types."""
+        cursor = base64.urlsafe_b64encode(json.dumps(key).encode('utf-8')).decode('ascii')
+        res = self.get(testapp, end_user_as_weasl_user, '{}?cursor={}'.format(url, cursor), status=400)
+        assert res.json['error_code'] == 'bad-cursor'
+
+    def test_empty_page_size(self, testapp, end_user_as_weasl_user, org, db):
+        """Test that asking for pages of no rows gets pages of one."""
+        make_end_users(db, org, 2)
+        res = self.get(testapp, end_user_as_weasl_user, '/end_users?pagination=cursor&per_page=0')
+        assert len(res.json['data']) == 1
+        assert 'next' in res.json['meta']['pagination']
+
+    def test_bad_cursor(self, testapp, end_user_as_weasl_user):
+        """Test that we get a 400 for a cursor we didn't make."""
+        res = self.get(testapp, end_user_as_weasl_user, '/end_users?cursor=garbage', status=400)
+        assert res.json['error_code'] == 'bad-cursor'
+
+    @pytest.mark.parametrize('token_cls, url', [
+        (EmailToken, '/end_users/email-logins?pagination=cursor&per_page=2'),
+        (SMSToken, '/end_users/sms-logins?pagination=cursor&per_page=2'),
+    ])
+    def test_walks_every_login_once(self, testapp, end_user_as_weasl_user, org, db, token_cls, url):
+        """Test that following next links visits each login exactly once."""
+        for end_user in make_end_users(db, org, 5):
+            token_cls.generate(end_user)
+        seen = 0
+        while url:
+            res = self.get(testapp, end_user_as_weasl_user, url)
+            seen += len(res.json['data'])
+            url = res.json['meta']['pagination'].get('next')
+        assert seen == 5
+
+
+@pytest.mark.usefixtures('db')
+class TestAggregateLogins(object):
+    """Test GET /end_users/aggregate/logins."""
+
+    def get(self, testapp, end_user, query='', **kwargs):
+        token = end_user.encode_auth_token().decode('utf-8')
+        return testapp.get('/end_users/aggregate/logins' + query,
+                           headers={'Authorization': 'Bearer {}'.format(token)}, **kwargs)
+
+    def make_logins(self, db, org):
+        end_users = make_end_users(db, org, 3)
+        for end_user in end_users:
+            SMSToken.generate(end_user)
+        token = EmailToken.generate(end_users[0])
+        token.send()
+        EmailToken.use(token.token, org.id)
+
+    def test_counts_created_and_used_tokens(self, testapp, end_user_as_weasl_user, org, db):
+        """Test that the rollup counts tokens as they are created and used."""
+        self.make_logins(db, org)
+        data = self.get(testapp, end_user_as_weasl_user).json['data']
+        assert [count for count, _ in data['sms_logins']] == [3]
+        assert [count for count, _ in data['email_logins']] == [1]
+        assert [count for count, _ in data['email_verifications']] == [1]
+        assert data['sms_verifications'] == []
+
+    def test_backfill_matches_incremental_counts(self, testapp, end_user_as_weasl_user, org, db):
+        """Test that rebuilding the rollup from the token tables gives the same counts."""
+        self.make_logins(db, org)
+        # a token whose delivery failed is deactivated without being sent or used
+        EmailToken.generate(end_user_as_weasl_user).update(active=False)
+        before = self.get(testapp, end_user_as_weasl_user).json['data']
+        LoginDailyCount.query.delete()
+        db.session.commit()
+        LoginDailyCount.backfill(SMSToken, 'sms')
+        LoginDailyCount.backfill(EmailToken, 'email')
+        assert self.get(testapp, end_user_as_weasl_user).json['data'] == before
+
+    def test_date_range_and_granularity(self, testapp, end_user_as_weasl_user, org, db):
+        """Test that logins outside the range are left out and periods are truncated."""
+        self.make_logins(db, org)
+        data = self.get(testapp, end_user_as_weasl_user, '?granularity=month').json['data']
+        assert len(data['sms_logins']) == 1
+        data = self.get(testapp, end_user_as_weasl_user, '?from=2000-01-01&to=2000-12-31').json['data']
+        assert data['sms_logins'] == []
+
+    @pytest.mark.parametrize('query, error_code', [
+        ('?granularity=year', 'bad-granularity'),
+        ('?from=yesterday', 'bad-date'),
+    ])
+    def test_bad_parameters(self, testapp, end_user_as_weasl_user, query, error_code):
+        """Test that we get a 400 for parameters we don't understand."""
+        res = self.get(testapp, end_user_as_weasl_user, query, status=400)
+        assert res.json['error_code'] == error_code
+
+
+@pytest.mark.usefixtures('db')
+class TestReadReplica(object):
+    """Test that the admin listings read from the replica, with the test database as its own replica."""
+
+    @pytest.fixture
+    def replica(self, app, db):
+        app.config['SQLALCHEMY_BINDS'] = {REPLICA_BIND: app.config['SQLALCHEMY_DATABASE_URI']}
+        app.replica_lag.clear()
+        return QueryCounter(db.get_engine(app, bind=REPLICA_BIND))
+
+    def list_end_users(self, testapp, end_user, db, query_counter, replica, query=''):
+        token = end_user.encode_auth_token().decode('utf-8')
+        db.session.expunge_all()
+        with query_counter, replica:
+            res = testapp.get('/end_users' + query, headers={'Authorization': 'Bearer {}'.format(token)})
+        return res
+
+    def test_listing_reads_from_replica(self, testapp, end_user_as_weasl_user, org, db, query_counter, replica):
+        """Test that the listing's queries run on the replica and only the auth runs on the primary."""
+        make_end_users(db, org, 3)
+        # a short first page skips the count on some Flask-SQLAlchemy versions
+        res = self.list_end_users(testapp, end_user_as_weasl_user, db, query_counter, replica, '?per_page=2')
+        assert len(res.json['data']) == 2
+        # the lag check, the org, the page, its properties and the count
+        assert replica.count == 5
+        # the end user and their properties, for the auth
+        assert query_counter.count == 2
+
+    def test_falls_back_to_primary_when_lagging(self, app, testapp, end_user_as_weasl_user, db, query_counter,
+                                                 replica):
+        """Test that the listing stays on the primary while the replica is too far behind."""
+        app.config['REPLICA_MAX_LAG_SECONDS'] = -1
+        res = self.list_end_users(testapp, end_user_as_weasl_user, db, query_counter, replica)
+        assert len(res.json['data']) == 1
+        # just the lag check
+        assert replica.count == 1
+
+    def test_writes_stay_on_primary(self, app, testapp, org, end_user, db, replica):
+        """Test that routes without the decorator don't touch the replica."""
+        with replica:
+            testapp.put_json('/end_users/{}/attributes/plan'.format(end_user.id), {'value': 'pro'},
+                             headers={'X-Weasl-Client-Secret': org.client_secret})
+        assert replica.count == 0
+
+
+@pytest.mark.usefixtures('db')
+class TestExport(object):
+    """Test GET /end_users/export, /end_users/email-logins/export and /end_users/sms-logins/export."""
+
+    def get(self, testapp, end_user, url, **kwargs):
+        token = end_user.encode_auth_token().decode('utf-8')
+        headers = dict(kwargs.pop('headers', {}), Authorization='Bearer {}'.format(token))
+        return testapp.get(url, headers=headers, **kwargs)
+
+    def records(self, res):
+        return [json.loads(line) for line in res.text.splitlines()]
+
+    def test_exports_ndjson_with_attributes(self, app, testapp, end_user_as_weasl_user, org, db):
+        """Test that every end user comes back, across fetch batches, with their typed attributes."""
+        app.config['EXPORT_BATCH_SIZE'] = 2
+        make_end_users(db, org, 4)
+        res = self.get(testapp, end_user_as_weasl_user, '/end_users/export')
+        assert res.content_type == 'application/x-ndjson'
+        records = self.records(res)
+        assert len(records) == 5
+        assert sum(record['attributes'] == {'plan': {'value': 'pro', 'trusted': False},
+                                            'seats': {'value': 5, 'trusted': False}}
+                   for record in records) == 4
+
+    def test_exports_csv(self, testapp, end_user_as_weasl_user, org, db):
+        """Test that CSV has a header row and a cursor column."""
+        make_end_users(db, org, 2)
+        res = self.get(testapp, end_user_as_weasl_user, '/end_users/export?format=csv')
+        assert res.content_type == 'text/csv'
+        rows = list(csv.DictReader(io.StringIO(res.text)))
+        assert len(rows) == 3
+        assert all(row['cursor'] for row in rows)
+        assert sum(json.loads(row['attributes']).get('plan', {}).get('value') == 'pro' for row in rows) == 2
+
+    def test_gzips_when_accepted(self, app, end_user_as_weasl_user, org, db):
+        """Test that the export is gzipped for clients that accept it."""
+        make_end_users(db, org, 2)
+        token = end_user_as_weasl_user.encode_auth_token().decode('utf-8')
+        # webtest decodes gzipped responses, so use the Flask client to see the raw body
+        res = app.test_client().get('/end_users/export', headers={
+            'Authorization': 'Bearer {}'.format(token), 'Accept-Encoding': 'gzip'})
+        assert res.headers['Content-Encoding'] == 'gzip'
+        assert 'Accept-Encoding' in res.headers['Vary']
+        assert len(gzip.decompress(res.data).splitlines()) == 3
+
+    def test_since_resumes(self, testapp, end_user_as_weasl_user, org, db):
+        """Test that passing a row's cursor resumes after it, including past rows without created_at."""
+        end_users = make_end_users(db, org, 4)
+        end_users[0].update(created_at=None)
+        records = self.records(self.get(testapp, end_user_as_weasl_user, '/end_users/export'))
+        assert records[-1]['id'] == str(end_users[0].id)
+        for i, record in enumerate(records):
+            rest = self.get(testapp, end_user_as_weasl_user, '/end_users/export?since={}'.format(record['cursor']))
+            assert [r['id'] for r in self.records(rest)] == [r['id'] for r in records[i + 1:]]
+
+    @pytest.mark.parametrize('token_cls, url', [
+        (EmailToken, '/end_users/email-logins/export'),
+        (SMSToken, '/end_users/sms-logins/export'),
+    ])
+    def test_exports_logins(self, testapp, end_user_as_weasl_user, org, db, token_cls, url):
+        """Test that each login comes back with its end user's contact details, without the token."""
+        end_users = make_end_users(db, org, 3)
+        for end_user in end_users:
+            token_cls.generate(end_user)
+        records = self.records(self.get(testapp, end_user_as_weasl_user, url))
+        assert {record['end_user_id'] for record in records} == {str(end_user.id) for end_user in end_users}
+        assert all('token' not in record for record in records)
+        rest = self.get(testapp, end_user_as_weasl_user, '{}?since={}'.format(url, records[0]['cursor']))
+        assert len(self.records(rest)) == 2
+
+    def test_undecodable_attribute_exported_as_stored(self, testapp, end_user_as_weasl_user, org, db):
+        """Test that an attribute that doesn't decode as its type is exported as stored, not cutting the export off."""
+        end_users = make_end_users(db, org, 2)
+        EndUserPropFactory(end_user_id=end_users[0].id, property_name='score', property_value='abc',
+                           property_type=EndUserPropertyTypes.NUMBER)
+        db.session.commit()
+        records = self.records(self.get(testapp, end_user_as_weasl_user, '/end_users/export'))
+        assert len(records) == 3
+        assert sum(record['attributes'].get('score') == {'value': 'abc', 'trusted': False} for record in records) == 1
+
+    @pytest.mark.parametrize('query, error_code', [
+        ('?format=xml', 'bad-export-format'),
+        ('?since=garbage', 'bad-cursor'),
+        # a valid timestamp with an id that isn't a UUID
+        ('?since=WyIyMDIwLTAxLTAxVDAwOjAwOjAwIiwiYWJjIl0', 'bad-cursor'),
+    ])
+    def test_bad_parameters(self, testapp, end_user_as_weasl_user, query, error_code):
+        """Test that we get a 400 for a format or cursor we don't understand."""
+        res = self.get(testapp, end_user_as_weasl_user, '/end_users/export' + query, status=400)
+        assert res.json['error_code'] == error_code
+
+
+@pytest.mark.usefixtures('db')
+class TestImport(object):
+    """Test POST /end_users/import and flask import-end-users."""
+
+    def post(self, testapp, org, body, content_type, **kwargs):
+        return testapp.post('/end_users/import', body, content_type=content_type,
+                            headers={'X-Weasl-Client-Secret': org.client_secret}, **kwargs)
+
+    def attributes(self, end_user):
+        return {prop.property_name: (prop.property_value, prop.property_type, prop.trusted)
+                for prop in end_user.properties}
+
+    def test_imports_csv(self, testapp, org, db):
+        """Test that CSV rows become end users with typed, trusted attributes."""
+        body = ('email,phone_number,plan,seats:NUMBER\n'
+                'Ada@Example.com,,pro,5\n'
+                ',+15550000001,free,\n')
+        res = self.post(testapp, org, body, 'text/csv')
+        assert res.json['data']['created'] == 2
+        assert res.json['data']['attributes'] == 3
+        ada = EndUser.query.filter(EndUser.org_id == org.id, EndUser.email == 'ada@example.com').one()
+        assert self.attributes(ada) == {
+            'plan': ('pro', EndUserPropertyTypes.STRING, True),
+            'seats': ('5', EndUserPropertyTypes.NUMBER, True),
+        }
+        phone_user = EndUser.query.filter(EndUser.org_id == org.id, EndUser.phone_number == '+15550000001').one()
+        assert self.attributes(phone_user) == {'plan': ('free', EndUserPropertyTypes.STRING, True)}
+
+    def test_updates_existing_users(self, testapp, org, end_user, db):
+        """Test that a row for an existing user updates their attributes and version."""
+        version = end_user.version
+        body = '{{"phone_number": "{}", "attributes": {{"seats": {{"value": 3, "type": "NUMBER"}}}}}}\n'.format(
+            end_user.phone_number)
+        res = self.post(testapp, org, body, 'application/x-ndjson')
+        assert res.json['data']['updated'] == 1
+        assert res.json['data']['created'] == 0
+        db.session.expire_all()
+        assert self.attributes(end_user)['seats'] == ('3', EndUserPropertyTypes.NUMBER, True)
+        assert end_user.version == version + 1
+
+    def test_reports_invalid_and_conflicting_rows(self, testapp, org, end_user, db):
+        """Test that bad rows are counted with their lines, and rows breaking a unique constraint skipped."""
+        body = '\n'.join([
+            '{"email": "ok@example.com", "attributes": {"plan": "pro"}}',
+            '{"attributes": {"plan": "pro"}}',
+            'not json',
+            '{"email": "taken@example.com", "phone_number": "%s"}' % end_user.phone_number,
+        ])
+        data = self.post(testapp, org, body, 'application/x-ndjson').json['data']
+        assert (data['rows'], data['created'], data['skipped'], data['invalid']) == (2, 1, 1, 2)
+        assert [error['line'] for error in data['errors']] == [2, 3]
+        assert EndUser.query.filter(EndUser.email == 'taken@example.com').first() is None
+
+    def test_attribute_values_must_decode_as_their_type(self, testapp, org):
+        """Test that an attribute its type can't decode invalidates its row instead of being stored."""
+        body = 'email,seats:NUMBER,tags:JSON\na@example.com,lots,[]\nb@example.com,5,[\n'
+        data = self.post(testapp, org, body, 'text/csv').json['data']
+        assert (data['rows'], data['invalid']) == (0, 2)
+        assert [error['error'] for error in data['errors']] == [
+            'attribute seats is not a valid NUMBER',
+            'attribute tags is not a valid JSON',
+        ]
+
+    def test_repeated_users_across_chunks(self, app, testapp, org, db):
+        """Test that a user repeated within and across chunks is created once, with the last row's attributes."""
+        app.config['IMPORT_CHUNK_SIZE'] = 2
+        body = 'email,plan\na@example.com,free\na@example.com,pro\nb@example.com,free\na@example.com,team\n'
+        data = self.post(testapp, org, body, 'text/csv').json['data']
+        assert (data['created'], data['updated']) == (2, 2)
+        a = EndUser.query.filter(EndUser.org_id == org.id, EndUser.email == 'a@example.com').one()
+        assert self.attributes(a)['plan'][0] == 'team'
+
+    def test_bad_format(self, testapp, org):
+        """Test that we get a 400 for a body that isn't CSV or NDJSON."""
+        res = self.post(testapp, org, '{}', 'application/json', status=400)
+        assert res.json['error_code'] == 'bad-import-format'
+
+    def test_too_large(self, app, testapp, org):
+        """Test that we get a 413 for a body over IMPORT_MAX_BYTES, before anything is imported."""
+        app.config['IMPORT_MAX_BYTES'] = 20
+        res = self.post(testapp, org, 'email\na@example.com\nb@example.com\n', 'text/csv', status=413)
+        assert res.json['error_code'] == 'import-too-large'
+        assert EndUser.query.filter(EndUser.org_id == org.id).count() == 0
+
+    @pytest.mark.parametrize('body, content_type', [
+        (b'email,plan\na@example.com,pro\nb@example.com,caf\xe9\nc@example.com,pro\n', 'text/csv'),
+        (b'{"email": "a@example.com"}\n{"email": "b@example.com", "attributes": {"plan": "caf\xe9"}}\n'
+         b'{"email": "c@example.com"}\n', 'application/x-ndjson'),
+    ])
+    def test_undecodable_rows_invalid(self, testapp, org, body, content_type):
+        """Test that a row with bytes that aren't valid in the charset is reported, and the rest imported."""
+        data = self.post(testapp, org, body, content_type).json['data']
+        assert (data['created'], data['invalid']) == (2, 1)
+        assert data['errors'][0]['error'] == "the row has bytes that aren't valid in the import's charset"
+        assert EndUser.query.filter(EndUser.email == 'b@example.com').first() is None
+
+    def test_declared_charset(self, testapp, org):
+        """Test that the body is decoded with the Content-Type's charset."""
+        body = 'email,plan\na@example.com,pro\n'.encode('utf-16')
+        data = self.post(testapp, org, body, 'text/csv; charset=utf-16').json['data']
+        assert (data['created'], data['invalid']) == (1, 0)
+
+    @pytest.mark.parametrize('charset', ['klingon', 'rot13'])
+    def test_bad_charset(self, testapp, org, charset):
+        """Test that we get a 400 for a charset that isn't a known text encoding."""
+        res = self.post(testapp, org, b'email\na@example.com\n', 'text/csv; charset={}'.format(charset), status=400)
+        assert res.json['error_code'] == 'bad-import-charset'
+
+    def test_command(self, app, org, db, tmpdir):
+        """Test that the command imports a file for the org with the client ID."""
+        source = tmpdir.join('users.csv')
+        source.write('email,plan\na@example.com,pro\n')
+        org_id = org.id
+        res = app.test_cli_runner().invoke(import_end_users, [org.client_id, str(source)])
+        assert '1 created' in res.output
+        assert EndUser.query.filter(EndUser.org_id == org_id, EndUser.email == 'a@example.com').count() == 1
+
+
+@pytest.mark.usefixtures('db')
+class TestUpdateAttributes(object):
+    """Test PUT|POST|PATCH /end_users/<uid>/attributes[/<attribute_name>]."""
+
+    def test_single_attribute_upserted(self, testapp, end_user, org):
+        """Test that writing an attribute twice keeps one row with the latest value."""
+        url = '/end_users/{}/attributes/plan'.format(end_user.id)
+        headers = {'X-Weasl-Client-Secret': org.client_secret}
+        testapp.put_json(url, {'value': 'free'}, headers=headers)
+        res = testapp.put_json(url, {'value': '5', 'type': 'NUMBER'}, headers=headers)
+        assert res.json['data']['attributes']['plan'] == {'value': 5, 'trusted': True}
+
+    def test_bulk_attributes_in_one_statement(self, testapp, end_user, org, db, query_counter):
+        """Test that many attributes are written with a single upsert."""
+        url = '/end_users/{}/attributes'.format(end_user.id)
+        headers = {'X-Weasl-Client-Secret': org.client_secret}
+        attributes = {'attribute_{}'.format(i): {'value': str(i), 'type': 'NUMBER'} for i in range(20)}
+        with query_counter:
+            res = testapp.put_json(url, {'attributes': attributes}, headers=headers)
+        assert len(res.json['data']['attributes']) == 20
+        assert sum(statement.startswith('INSERT') for statement in query_counter.statements) == 1
+
+    @pytest.mark.parametrize('body, error_code', [
+        ({'attributes': ['plan']}, 'bad-attributes'),
+        ({'attributes': {'plan': 'pro'}}, 'bad-attributes'),
+        (['plan'], 'bad-attributes'),
+        ({'attributes': {'plan': {'value': 'pro', 'type': ['STRING']}}}, 'bad-property-type'),
+    ])
+    def test_bulk_attributes_bad_body(self, testapp, end_user, org, body, error_code):
+        """Test that we get a 400 for attributes that aren't an object of attribute objects."""
+        url = '/end_users/{}/attributes'.format(end_user.id)
+        res = testapp.put_json(url, body, headers={'X-Weasl-Client-Secret': org.client_secret}, status=400)
+        assert res.json['error_code'] == error_code
+
+    @pytest.mark.parametrize('attribute', [
+        {'value': 'lots', 'type': 'NUMBER'},
+        {'value': 'not json', 'type': 'JSON'},
+        {'value': True, 'type': 'NUMBER'},
+    ])
+    def test_bulk_attributes_bad_value(self, testapp, end_user, org, attribute):
+        """Test that we get a 400, and write nothing, for a value that isn't valid for its type."""
+        url = '/end_users/{}/attributes'.format(end_user.id)
+        headers = {'X-Weasl-Client-Secret': org.client_secret}
+        body = {'attributes': {'plan': {'value': 'pro'}, 'seats': attribute}}
+        res = testapp.put_json(url, body, headers=headers, status=400)
+        assert res.json['error_code'] == 'bad-attribute-value'
+        assert EndUserProperty.query.filter_by(end_user_id=end_user.id).count() == 0
+
+    def test_bulk_attributes_json_object(self, testapp, end_user, org):
+        """Test that a JSON attribute can be given as an object."""
+        url = '/end_users/{}/attributes'.format(end_user.id)
+        headers = {'X-Weasl-Client-Secret': org.client_secret}
+        body = {'attributes': {
+            'settings': {'value': {'a': 1}, 'type': 'JSON'},
+            'seats': {'value': 5, 'type': 'NUMBER'},
+        }}
+        res = testapp.put_json(url, body, headers=headers)
+        assert res.json['data']['attributes']['settings']['value'] == {'a': 1}
+        assert res.json['data']['attributes']['seats']['value'] == 5
+
+    def test_bulk_attributes_for_other_org(self, testapp, end_user, db):
+        """Test that an org can't write attributes for another org's end users."""
+        other_org = OrgFactory()
+        db.session.commit()
+        url = '/end_users/{}/attributes'.format(end_user.id)
+        testapp.put_json(url, {'attributes': {}}, headers={'X-Weasl-Client-Secret': other_org.client_secret}, status=404)
@@ -0,0 +1,45 @@
+# -*- encoding: utf-8 -*-
+"""Test the per-request timings."""
+import json
+import logging
+
+import pytest
+
+
+@pytest.mark.usefixtures('db')
+class TestRequestInstrumentation(object):
+    """Test the Server-Timing header and request log lines."""
+
+    def test_no_server_timing_by_default(self, testapp, org):
+        """Test that the header is opt-in."""
+        res = testapp.get('/widget/org', headers={'X-Weasl-Client-Id': org.client_id})
+        assert 'Server-Timing' not in res.headers
+
+    def test_server_timing_counts_statements(self, app, testapp, org, query_counter):
+        """Test that the header reports the statements the request ran and its total time."""
+        app.config['SERVER_TIMING'] = True
+        app.org_cache.clear()
+        headers = {'X-Weasl-Client-Id': org.client_id}
+        with query_counter:
+            res = testapp.get('/widget/org', headers=headers)
+        timing = res.headers['Server-Timing']
+        assert 'desc="{} statements"'.format(query_counter.count) in timing
+        assert 'pool;dur=' in timing
+        assert 'total;dur=' in timing
+
+    def test_server_timing_includes_providers(self, app, testapp, org):
+        """Test that time spent sending through a provider is reported separately."""
+        app.config.update(SERVER_TIMING=True, SEND_SMS=True)
+        res = testapp.post_json('/widget/sms/send', {'phone_number': '5555555555'},
+                                headers={'X-Weasl-Client-Id': org.client_id})
+        assert 'twilio;dur=' in res.headers['Server-Timing']
+
+    def test_logs_request(self, testapp, org, caplog):
+        """Test that each request is logged as JSON tagged with its endpoint and org."""
+        with caplog.at_level(logging.INFO, logger='weasl.requests'):
+            testapp.get('/widget/org', headers={'X-Weasl-Client-Id': org.client_id})
+        line = json.loads(caplog.records[-1].getMessage())
+        assert line['endpoint'] == 'widget.get_public_org'
+        assert line['org_id'] == org.id
+        assert line['status'] == 200
+        assert line['db_statements'] > 0
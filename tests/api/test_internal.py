@@ -0,0 +1,40 @@
+# -*- encoding: utf-8 -*-
+"""Test the views at /internal."""
+import pytest
+
+from weasl.end_user.models import SMSToken
+
+
+@pytest.mark.usefixtures('db')
+class TestGetMetrics(object):
+    """Test GET /internal/metrics."""
+
+    base_url = '/internal/metrics'
+
+    @pytest.fixture
+    def metrics_token(self, app):
+        app.config['METRICS_TOKEN'] = 'scrape-me'
+        return {'Authorization': 'Bearer scrape-me'}
+
+    def test_not_found_without_token_configured(self, testapp):
+        """Test that metrics are off unless a token is configured."""
+        testapp.get(self.base_url, status=404)
+
+    def test_unauthorized_with_wrong_token(self, testapp, metrics_token):
+        """Test that we get a 401 without the configured token."""
+        res = testapp.get(self.base_url, headers={'Authorization': 'Bearer guess'}, status=401)
+        assert res.json['error_code'] == 'bad-metrics-token'
+
+    def test_prometheus_text_format(self, testapp, org, metrics_token):
+        """Test that served requests, pool checkouts and logins show up in the exposition."""
+        testapp.get('/widget/org', headers={'X-Weasl-Client-Id': org.client_id})
+        res = testapp.get(self.base_url, headers=metrics_token)
+        assert res.content_type == 'text/plain'
+        assert 'weasl_request_duration_seconds_bucket{endpoint="widget.get_public_org"' in res.text
+        assert 'weasl_db_pool_checkout_wait_seconds_count' in res.text
+
+    def test_counts_verifies_by_result(self, testapp, end_user, metrics_token):
+        """Test that successful and failed verifies are counted apart."""
+        SMSToken.use('nope00', end_user.org_id)
+        res = testapp.get(self.base_url, headers=metrics_token)
+        assert 'weasl_login_verifies_total{channel="sms",result="failure"}' in res.text
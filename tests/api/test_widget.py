@@ -0,0 +1,240 @@
+# -*- encoding: utf-8 -*-
+"""Test the widget's views at /widget."""
+import datetime as dt
+
+import pytest
+
+from weasl.end_user.models import EmailToken, EndUserProperty, EndUserPropertyTypes, SMSToken
+from weasl.org.constants import Constant, OrgPropertyConstants
+from weasl.org.models import OrgProperty, OrgPropertyNamespaces
+from weasl.ratelimit import Limit
+
+
+@pytest.mark.usefixtures('db')
+class TestGetPublicOrg(object):
+    """Test GET /widget/org."""
+
+    def get(self, testapp, org, etag=None, **kwargs):
+        headers = {'X-Weasl-Client-Id': org.client_id}
+        if etag is not None:
+            headers['If-None-Match'] = etag
+        return testapp.get('/widget/org', headers=headers, **kwargs)
+
+    def test_cacheable_by_shared_caches(self, testapp, org):
+        """Test that the org comes with an ETag and public caching headers."""
+        res = self.get(testapp, org)
+        assert res.headers['ETag'].startswith('"')
+        assert 'public' in res.headers['Cache-Control']
+        assert 'max-age=60' in res.headers['Cache-Control']
+        assert 'X-Weasl-Client-Id' in res.headers['Vary']
+
+    def test_not_modified_skips_serializing(self, testapp, org, db, query_counter):
+        """Test that a matching If-None-Match gets an empty 304 without loading properties."""
+        etag = self.get(testapp, org).headers['ETag']
+        with query_counter:
+            res = self.get(testapp, org, etag, status=304)
+        assert res.body == b''
+        assert res.headers['ETag'] == etag
+        assert not any('org_properties' in statement for statement in query_counter.statements)
+
+    def test_property_write_changes_etag(self, testapp, org):
+        """Test that saving an org property makes the old ETag stale."""
+        etag = self.get(testapp, org).headers['ETag']
+        OrgProperty.save_prop_for_org(org.id, OrgPropertyConstants.COMPANY_NAME, 'Weasl')
+        res = self.get(testapp, org, etag)
+        assert res.status_code == 200
+        assert res.headers['ETag'] != etag
+
+
+@pytest.mark.usefixtures('db')
+class TestGetMe(object):
+    """Test GET /widget/me."""
+
+    def get(self, testapp, org, end_user, etag=None, **kwargs):
+        headers = {
+            'X-Weasl-Client-Id': org.client_id,
+            'Authorization': 'Bearer {}'.format(end_user.encode_auth_token().decode('utf-8')),
+        }
+        if etag is not None:
+            headers['If-None-Match'] = etag
+        return testapp.get('/widget/me', headers=headers, **kwargs)
+
+    def test_private_and_revalidated(self, testapp, org, end_user):
+        """Test that the end user is only cached privately and always revalidated."""
+        res = self.get(testapp, org, end_user)
+        assert 'private' in res.headers['Cache-Control']
+        assert 'no-cache' in res.headers['Cache-Control']
+        assert 'Authorization' in res.headers['Vary']
+
+    def test_not_modified(self, testapp, org, end_user):
+        """Test that a matching If-None-Match gets a 304."""
+        etag = self.get(testapp, org, end_user).headers['ETag']
+        self.get(testapp, org, end_user, etag, status=304)
+
+    def test_attribute_write_changes_etag(self, testapp, org, end_user):
+        """Test that saving an attribute makes the old ETag stale."""
+        etag = self.get(testapp, org, end_user).headers['ETag']
+        EndUserProperty.save_prop_for_end_user(end_user.id, 'plan', 'pro', EndUserPropertyTypes.STRING, True)
+        res = self.get(testapp, org, end_user, etag)
+        assert res.json['data']['attributes']['plan']['value'] == 'pro'
+        assert res.headers['ETag'] != etag
+
+    def test_login_changes_etag(self, testapp, org, end_user):
+        """Test that logging in, which changes last_login_at, makes the old ETag stale."""
+        etag = self.get(testapp, org, end_user).headers['ETag']
+        token = SMSToken.generate(end_user)
+        SMSToken.use(token.token, org.id)
+        assert self.get(testapp, org, end_user, etag).status_code == 200
+
+
+@pytest.mark.usefixtures('db')
+class TestSendRateLimits(object):
+    """Test the rate limits on POST /widget/sms/send and /widget/email/send."""
+
+    @pytest.fixture(autouse=True)
+    def no_cooldown(self, app):
+        app.config['SEND_COOLDOWN_SECONDS'] = 0
+
+    def send_sms(self, testapp, org, phone_number='+15550000001', **kwargs):
+        return testapp.post_json('/widget/sms/send', {'phone_number': phone_number},
+                                 headers=dict(kwargs.pop('headers', {}), **{'X-Weasl-Client-Id': org.client_id}),
+                                 **kwargs)
+
+    def test_limits_each_destination(self, app, testapp, org):
+        """Test that a destination over its limit gets a 429 with Retry-After, and others still send."""
+        app.rate_limiter.defaults['destination'] = Limit(2, 60)
+        self.send_sms(testapp, org)
+        self.send_sms(testapp, org)
+        res = self.send_sms(testapp, org, status=429)
+        assert res.json['error_code'] == 'rate-limited'
+        assert int(res.headers['Retry-After']) == 30
+        self.send_sms(testapp, org, '+15550000002')
+
+    def test_reused_sends_are_refunded(self, app, testapp, org):
+        """Test that sends answered with the live token don't use up the limit."""
+        app.config['SEND_COOLDOWN_SECONDS'] = 30
+        app.rate_limiter.defaults['destination'] = Limit(2, 60)
+        for _ in range(4):
+            self.send_sms(testapp, org)
+        assert SMSToken.query.count() == 1
+
+    def test_reused_sends_still_count_per_ip(self, app, testapp, org):
+        """Test that sends answered with the live token still use up the client IP's limit."""
+        app.config['SEND_COOLDOWN_SECONDS'] = 30
+        app.rate_limiter.defaults['ip'] = Limit(2, 60)
+        app.rate_limiter.trusted_proxies = 1
+        headers = {'X-Forwarded-For': '1.1.1.1'}
+        self.send_sms(testapp, org, headers=headers)
+        self.send_sms(testapp, org, headers=headers)
+        self.send_sms(testapp, org, headers=headers, status=429)
+        assert SMSToken.query.count() == 1
+
+    def test_email_destinations_ignore_case(self, app, testapp, org):
+        """Test that an email's limit covers every capitalization of it."""
+        app.rate_limiter.defaults['destination'] = Limit(1, 60)
+        headers = {'X-Weasl-Client-Id': org.client_id}
+        testapp.post_json('/widget/email/send', {'email': 'ada@example.com'}, headers=headers)
+        testapp.post_json('/widget/email/send', {'email': 'Ada@Example.com'}, headers=headers, status=429)
+
+    def test_rejection_skips_the_database(self, app, testapp, org, db, query_counter):
+        """Test that, with the org cached, a rejected send runs no queries."""
+        app.rate_limiter.defaults['destination'] = Limit(1, 60)
+        headers = {'X-Weasl-Client-Id': org.client_id}
+        testapp.post_json('/widget/sms/send', {'phone_number': '+15550000001'}, headers=headers)
+        db.session.expunge_all()
+        with query_counter:
+            testapp.post_json('/widget/sms/send', {'phone_number': '+15550000001'}, headers=headers, status=429)
+        assert query_counter.statements == []
+
+    def test_limits_each_client_ip(self, app, testapp, org):
+        """Test that the IP limit goes by the address the trusted proxy saw."""
+        app.rate_limiter.defaults['ip'] = Limit(1, 60)
+        app.rate_limiter.trusted_proxies = 1
+        self.send_sms(testapp, org, '+15550000001', headers={'X-Forwarded-For': '1.1.1.1, 10.0.0.1'})
+        # a spoofed first address doesn't get a fresh bucket
+        self.send_sms(testapp, org, '+15550000002', headers={'X-Forwarded-For': '2.2.2.2, 10.0.0.1'}, status=429)
+        self.send_sms(testapp, org, '+15550000003', headers={'X-Forwarded-For': '10.0.0.2'})
+
+    def test_org_settings_override_defaults(self, app, testapp, org):
+        """Test that an org's rate_limit_<scope> settings replace the defaults as soon as they're saved."""
+        def save(value):
+            OrgProperty.save_prop_for_org(org.id, Constant(property_name='rate_limit_destination', display_name=None,
+                                                           default=None),
+                                          value, namespace=OrgPropertyNamespaces.SETTINGS)
+        save('1/60')
+        self.send_sms(testapp, org)
+        self.send_sms(testapp, org, status=429)
+        save('off')
+        self.send_sms(testapp, org)
+
+    def test_settings_api_rejects_bad_limits(self, testapp, end_user_as_weasl_user):
+        """Test that a malformed limit can't be saved as an org setting."""
+        token = end_user_as_weasl_user.encode_auth_token().decode('utf-8')
+        res = testapp.put_json('/orgs/settings/rate_limit_ip', {'value': 'lots'},
+                               headers={'Authorization': 'Bearer {}'.format(token)}, status=400)
+        assert res.json['error_code'] == 'bad-rate-limit'
+
+
+@pytest.mark.usefixtures('db')
+class TestIdempotentSend(object):
+    """Test that repeated POST /widget/sms/send and /widget/email/send reuse the live token."""
+
+    def send_sms(self, testapp, org, idempotency_key=None, **kwargs):
+        headers = {'X-Weasl-Client-Id': org.client_id}
+        if idempotency_key is not None:
+            headers['Idempotency-Key'] = idempotency_key
+        return testapp.post_json('/widget/sms/send', {'phone_number': '+15550000001'}, headers=headers, **kwargs)
+
+    def test_repeat_within_cooldown_reuses_token(self, app, testapp, org):
+        """Test that a double-click sends one text from one token."""
+        app.config['SEND_SMS'] = True
+        self.send_sms(testapp, org)
+        self.send_sms(testapp, org)
+        assert SMSToken.query.count() == 1
+        assert len(app.providers.twilio.sent) == 1
+
+    def test_resends_after_cooldown(self, app, testapp, org, db):
+        """Test that a send after the cooldown mints and sends a new token."""
+        self.send_sms(testapp, org)
+        SMSToken.query.update({'created_at': SMSToken.created_at - dt.timedelta(minutes=5)},
+                              synchronize_session=False)
+        db.session.commit()
+        self.send_sms(testapp, org)
+        assert SMSToken.query.count() == 2
+
+    def test_unsent_token_not_reused(self, app, testapp, org):
+        """Test that a token still waiting in the outbox isn't answered with during the cooldown."""
+        app.config['ASYNC_DELIVERY'] = True
+        self.send_sms(testapp, org)
+        self.send_sms(testapp, org)
+        assert SMSToken.query.count() == 2
+
+    def test_used_token_not_reused(self, testapp, org):
+        """Test that once the token is used, another send gets a fresh one."""
+        self.send_sms(testapp, org)
+        token = SMSToken.query.one()
+        testapp.post_json('/widget/sms/verify', {'token_string': token.token},
+                          headers={'X-Weasl-Client-Id': org.client_id})
+        self.send_sms(testapp, org)
+        assert SMSToken.query.count() == 2
+
+    def test_idempotency_key_outlasts_cooldown(self, app, testapp, org):
+        """Test that a retry with the same Idempotency-Key is answered without sending, and a new key sends."""
+        app.config['SEND_COOLDOWN_SECONDS'] = 0
+        self.send_sms(testapp, org, 'click-1')
+        self.send_sms(testapp, org, 'click-1')
+        assert SMSToken.query.count() == 1
+        self.send_sms(testapp, org, 'click-2')
+        assert SMSToken.query.count() == 2
+
+    def test_email(self, testapp, org):
+        """Test that repeated email sends reuse the token too."""
+        for _ in range(2):
+            testapp.post_json('/widget/email/send', {'email': 'ada@example.com'},
+                              headers={'X-Weasl-Client-Id': org.client_id})
+        assert EmailToken.query.count() == 1
+
+    def test_bad_idempotency_key(self, testapp, org):
+        """Test that we get a 400 for an Idempotency-Key too long to store."""
+        res = self.send_sms(testapp, org, 'k' * 256, status=400)
+        assert res.json['error_code'] == 'bad-idempotency-key'
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 """Defines fixtures available to all tests."""
 import pytest
+from sqlalchemy import event
 from webtest import TestApp
 
 from weasl.app import create_app
@@ -35,6 +36,9 @@ def db(app):
     _db.app = app
     with app.app_context():
         _db.create_all()
+        # as in the migrations, for gen_random_uuid() before Postgres 13
+        _db.session.execute('CREATE EXTENSION IF NOT EXISTS pgcrypto')
+        _db.session.commit()
 
     yield _db
 
@@ -43,6 +47,35 @@ def db(app):
     _db.drop_all()
 
 
+class QueryCounter(object):
+    """Counts the SQL statements run against the engine inside a ``with`` block."""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.statements = []
+
+    def _record(self, conn, cursor, statement, *args):
+        self.statements.append(statement)
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    def __enter__(self):
+        self.statements = []
+        event.listen(self.engine, 'before_cursor_execute', self._record)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(self.engine, 'before_cursor_execute', self._record)
+
+
+@pytest.fixture
+def query_counter(db):
+    """A statement counter for the test database."""
+    return QueryCounter(db.engine)
+
+
 @pytest.fixture
 def org(db):
     """An org factory for the tests."""
@@ -0,0 +1,38 @@
+from weasl import bench
+from weasl.commands import bench as bench_command
+
+
+def results(**best_ns):
+    return {'results': {name: {'median_ns': ns * 2, 'best_ns': ns} for name, ns in best_ns.items()}}
+
+
+class TestBench:
+
+    def test_every_hot_path_runs(self, app):
+        with app.test_request_context():
+            ran = bench.run_benchmarks(attributes=3, rounds=1, min_seconds=0.001)
+        assert set(ran['results']) == set(bench.HOT_PATHS)
+        assert all(result['median_ns'] > 0 for result in ran['results'].values())
+
+    def test_compare_flags_regressions_beyond_threshold(self):
+        changes, regressions = bench.compare(
+            results(encode_auth_token=130, org_schema_dump=105, only_now=10),
+            results(encode_auth_token=100, org_schema_dump=100, only_before=10),
+            threshold=0.2,
+        )
+        assert [change[0] for change in changes] == ['encode_auth_token', 'org_schema_dump']
+        assert regressions == ['encode_auth_token']
+
+    def test_compare_ignores_noisy_medians(self):
+        noisy = {'results': {'encode_auth_token': {'median_ns': 170, 'best_ns': 102}}}
+        changes, regressions = bench.compare(noisy, results(encode_auth_token=100), threshold=0.2)
+        assert changes[0][1:3] == (100, 102)
+        assert regressions == []
+
+    def test_command_fails_on_regression(self, app, tmpdir):
+        baseline = tmpdir.join('baseline.json')
+        baseline.write('{"results": {"create_random_token": {"median_ns": 0.002, "best_ns": 0.001}}}')
+        runner = app.test_cli_runner()
+        res = runner.invoke(bench_command, ['-p', 'create_random_token', '-r', '1', '-c', str(baseline)])
+        assert res.exit_code == 1
+        assert 'REGRESSED' in res.output
@@ -1,6 +1,15 @@
+import threading
+import time
+
 import pytest
 
-from weasl.end_user.models import EndUser
+from weasl.end_user.models import (GOOGLE_USER_URL, EmailToken, EndUser, EndUserClaims, EndUserProperty,
+                                    EndUserPropertyTypes, LoginDailyCount, SMSToken)
+from weasl.end_user.schema import EndUserSchema
+from weasl.errors import InternalServerError
+from weasl.org.models import Org
+from weasl import providers
+from weasl.providers import FakeProviders, ProviderUnavailable
 
 
 @pytest.mark.usefixtures('db')
@@ -14,3 +23,277 @@ class TestEndUser:
         auth_token = end_user.encode_auth_token()
         assert isinstance(auth_token, bytes)
         assert EndUser.decode_auth_token(auth_token) == str(end_user.id)
+
+    def test_token_has_no_claims_by_default(self, end_user):
+        claims = EndUser.decode_auth_claims(end_user.encode_auth_token())
+        assert 'org' not in claims
+        assert isinstance(EndUser.from_token(end_user.encode_auth_token()), EndUser)
+
+
+@pytest.mark.usefixtures('db')
+class TestStatelessAuth:
+
+    @pytest.fixture(autouse=True)
+    def stateless_auth(self, app):
+        app.config['STATELESS_AUTH'] = True
+
+    def test_claims_in_token(self, end_user_as_weasl_user):
+        claims = EndUser.decode_auth_claims(end_user_as_weasl_user.encode_auth_token())
+        assert claims['org'] == end_user_as_weasl_user.org_id
+        assert claims['adm'] == end_user_as_weasl_user.org_id
+        assert claims['mst'] is False
+
+    def test_from_token_skips_the_database(self, end_user_as_weasl_user, db):
+        token = end_user_as_weasl_user.encode_auth_token()
+        db.session.expunge_all()
+        end_user = EndUser.from_token(token)
+        assert isinstance(end_user, EndUserClaims)
+        assert end_user.id == end_user_as_weasl_user.id
+        assert end_user.admin_org_id() == end_user_as_weasl_user.org_id
+        assert len(db.session.identity_map) == 0
+
+    def test_loads_for_uncovered_columns(self, end_user):
+        end_user_claims = EndUser.from_token(end_user.encode_auth_token())
+        assert end_user_claims.email == end_user.email
+
+    def test_master_admin_claim_is_trusted(self, end_user, db, query_counter):
+        token = end_user.encode_auth_token()
+        EndUserProperty.save_prop_for_end_user(end_user.id, 'is_weasl_admin', 'true', EndUserPropertyTypes.BOOLEAN, True)
+        db.session.expunge_all()
+        with query_counter:
+            assert EndUser.from_token(token).is_weasl_master_admin() is False
+        assert query_counter.count == 0
+
+    def test_me_etag_follows_the_version(self, testapp, end_user, org):
+        token = end_user.encode_auth_token().decode('utf-8')
+        headers = {'X-Weasl-Client-Id': org.client_id, 'Authorization': 'Bearer {}'.format(token)}
+        etag = testapp.get('/widget/me', headers=headers).headers['ETag']
+        EndUserProperty.save_prop_for_end_user(end_user.id, 'nickname', 'bob')
+        res = testapp.get('/widget/me', headers=dict(headers, **{'If-None-Match': etag}))
+        assert res.status_code == 200
+        assert res.json['data']['attributes']['nickname']['value'] == 'bob'
+
+    def test_missing_admin_claim_falls_back(self, end_user, org):
+        token = end_user.encode_auth_token()
+        EndUserProperty.save_prop_for_end_user(end_user.id, 'org_id_as_admin', org.id, EndUserPropertyTypes.NUMBER, True)
+        assert EndUser.from_token(token).org_for_admin().id == org.id
+
+
+@pytest.mark.usefixtures('db')
+class TestEndUserProperties:
+
+    def test_properties_loaded_once(self, end_user_as_weasl_user, db, query_counter):
+        token = end_user_as_weasl_user.encode_auth_token()
+        db.session.expunge_all()
+        with query_counter:
+            end_user = EndUser.from_token(token)
+            end_user.properties
+            end_user.admin_org_id()
+            end_user.is_weasl_master_admin()
+        assert query_counter.count == 2
+
+    def test_save_prop_keeps_loaded_properties_in_sync(self, end_user):
+        assert end_user.properties == []
+        EndUserProperty.save_prop_for_end_user(end_user.id, 'nickname', 'bob')
+        EndUserProperty.save_prop_for_end_user(end_user.id, 'nickname', 'rob')
+        assert [(p.property_name, p.property_value) for p in end_user.properties] == [('nickname', 'rob')]
+
+    def test_save_prop_updates_type_and_trust(self, end_user):
+        EndUserProperty.save_prop_for_end_user(end_user.id, 'age', '3')
+        prop = EndUserProperty.save_prop_for_end_user(end_user.id, 'age', '4', EndUserPropertyTypes.NUMBER, True)
+        assert prop.property_type == EndUserPropertyTypes.NUMBER
+        assert prop.trusted is True
+
+    def test_properties_decoded_by_type(self, end_user):
+        EndUserProperty.save_prop_for_end_user(end_user.id, 'plan', '{"seats": 5}', EndUserPropertyTypes.JSON)
+        EndUserProperty.save_prop_for_end_user(end_user.id, 'age', '30', EndUserPropertyTypes.NUMBER)
+        attrs = EndUserSchema().dump(end_user)['attributes']
+        assert attrs['plan']['value'] == {'seats': 5}
+        assert attrs['age']['value'] == 30
+
+
+@pytest.mark.usefixtures('db')
+class TestTokenMinting:
+
+    @pytest.mark.parametrize('token_cls', [EmailToken, SMSToken])
+    def test_minted_without_probes(self, end_user, db, query_counter, token_cls):
+        end_user_id = end_user.id
+        with query_counter:
+            token = token_cls.generate(end_user)
+        assert not any(statement.startswith('SELECT') for statement in query_counter.statements)
+        assert token.end_user_id == end_user_id
+
+    def test_sms_code_retried_on_active_collision(self, end_user, db, monkeypatch):
+        codes = iter(['aaaaaa', 'aaaaaa', 'bbbbbb'])
+        monkeypatch.setattr(SMSToken, 'create_random_token', staticmethod(lambda: next(codes)))
+        other_user = EndUser.create(org_id=end_user.org_id, email='other@example.com')
+        SMSToken.generate(end_user)
+        assert SMSToken.generate(other_user).token == 'bbbbbb'
+
+    def test_sms_code_reused_in_other_orgs_and_once_used(self, end_user, db, monkeypatch):
+        monkeypatch.setattr(SMSToken, 'create_random_token', staticmethod(lambda: 'aaaaaa'))
+        other_org_user = EndUser.create(org_id=Org.generate_new().id, email='other@example.com')
+        SMSToken.generate(end_user)
+        assert SMSToken.generate(other_org_user).token == 'aaaaaa'
+        SMSToken.use('aaaaaa', end_user.org_id)
+        other_user = EndUser.create(org_id=end_user.org_id, email='another@example.com')
+        assert SMSToken.generate(other_user).token == 'aaaaaa'
+
+    def test_gives_up_after_repeated_collisions(self, end_user, db, monkeypatch):
+        monkeypatch.setattr(SMSToken, 'create_random_token', staticmethod(lambda: 'aaaaaa'))
+        SMSToken.generate(end_user)
+        with pytest.raises(InternalServerError):
+            SMSToken.generate(end_user)
+
+
+def wait_for_lock_waiters(conn, count):
+    """Wait until that many statements are waiting on locks."""
+    deadline = time.monotonic() + 10
+    while conn.scalar('SELECT count(*) FROM pg_locks WHERE NOT granted') < count:
+        assert time.monotonic() < deadline, 'statements never waited on the lock'
+        time.sleep(0.01)
+
+
+@pytest.mark.usefixtures('db')
+class TestTokenRedemption:
+
+    @pytest.mark.parametrize('token_cls', [EmailToken, SMSToken])
+    def test_redeemed_in_one_statement(self, end_user, db, query_counter, token_cls):
+        token_string, org_id = token_cls.generate(end_user).token, end_user.org_id
+        with query_counter:
+            used = token_cls.use(token_string, org_id)
+        assert used.token == token_string
+        assert used.active is False
+        assert [statement.split()[0] for statement in query_counter.statements] == ['WITH']
+
+    @pytest.mark.parametrize('token_cls, counter', [(EmailToken, 'email_used'), (SMSToken, 'sms_used')])
+    def test_records_login_and_counts_it(self, end_user, db, token_cls, counter):
+        token = token_cls.generate(end_user)
+        token_cls.use(token.token, end_user.org_id)
+        db.session.expire_all()
+        assert end_user.last_login_at is not None
+        assert getattr(LoginDailyCount.query.one(), counter) == 1
+
+    @pytest.mark.parametrize('token_cls', [EmailToken, SMSToken])
+    def test_only_redeemed_once(self, end_user, token_cls):
+        token = token_cls.generate(end_user)
+        assert token_cls.use(token.token, end_user.org_id) is not None
+        assert token_cls.use(token.token, end_user.org_id) is None
+
+    def test_expired_token_rejected(self, end_user, db):
+        token = EmailToken.generate(end_user)
+        token.update(expired_at=token.created_at)
+        assert EmailToken.use(token.token, end_user.org_id) is None
+        db.session.expire_all()
+        assert end_user.last_login_at is None
+        assert LoginDailyCount.query.one().email_used == 0
+
+    def test_sms_token_case_insensitive(self, end_user):
+        token = SMSToken.generate(end_user)
+        assert SMSToken.use(token.token.upper(), end_user.org_id) is not None
+
+    @pytest.mark.parametrize('token_cls, counter', [(EmailToken, 'email_used'), (SMSToken, 'sms_used')])
+    def test_concurrent_redemptions_only_one_succeeds(self, app, end_user, db, token_cls, counter):
+        token_string, org_id = token_cls.generate(end_user).token, end_user.org_id
+        results = []
+
+        def redeem():
+            with app.app_context():
+                results.append(token_cls.use(token_string, org_id) is not None)
+                db.session.remove()
+
+        # Hold the token's row lock until both redemptions are waiting on it, so they really race
+        with db.engine.connect() as blocker:
+            locked = blocker.begin()
+            blocker.execute(token_cls.__table__.select().where(token_cls.token == token_string).with_for_update())
+            threads = [threading.Thread(target=redeem) for _ in range(2)]
+            for thread in threads:
+                thread.start()
+            wait_for_lock_waiters(blocker, 2)
+            locked.commit()
+        for thread in threads:
+            thread.join()
+
+        assert sorted(results) == [False, True]
+        db.session.expire_all()
+        assert end_user.last_login_at is not None
+        assert getattr(LoginDailyCount.query.one(), counter) == 1
+
+    def test_verify_racing_a_resend_doesnt_deadlock(self, app, org, end_user, db):
+        token_string = SMSToken.generate(end_user).token
+        end_user_id, client_id = end_user.id, org.client_id
+        statuses = {}
+
+        def request(name, path, body):
+            res = app.test_client().post(path, json=body, headers={'X-Weasl-Client-Id': client_id})
+            statuses[name] = res.status_code
+
+        # Hold the end user's row lock until the resend, then the verify, are queued on it
+        with db.engine.connect() as blocker:
+            locked = blocker.begin()
+            blocker.execute(EndUser.__table__.select().where(EndUser.id == end_user_id).with_for_update())
+            send = threading.Thread(target=request, args=('send', '/widget/sms/send',
+                                                          {'phone_number': end_user.phone_number}))
+            verify = threading.Thread(target=request, args=('verify', '/widget/sms/verify',
+                                                            {'token_string': token_string}))
+            send.start()
+            wait_for_lock_waiters(blocker, 1)
+            verify.start()
+            wait_for_lock_waiters(blocker, 2)
+            locked.commit()
+        send.join()
+        verify.join()
+
+        assert statuses == {'send': 200, 'verify': 200}
+        db.session.expire_all()
+        counts = LoginDailyCount.query.one()
+        assert (counts.sms_created, counts.sms_used) == (2, 1)
+
+
+@pytest.mark.usefixtures('db')
+class TestProviders:
+
+    def test_sms_sent_through_provider(self, app, end_user):
+        app.config['SEND_SMS'] = True
+        token = SMSToken.generate(end_user)
+        token.send()
+        assert app.providers.twilio.sent[0]['to'] == end_user.phone_number
+        assert token.token.upper() in app.providers.twilio.sent[0]['body']
+
+    def test_email_sent_through_provider(self, app, end_user):
+        app.config['SEND_EMAILS'] = True
+        EmailToken.generate(end_user).send()
+        assert app.providers.ses.sent[0]['Destination'] == {'ToAddresses': [end_user.email]}
+
+    def test_google_userinfo_fetched_through_provider(self, app, org):
+        app.providers.http.respond(GOOGLE_USER_URL, {'verified_email': True, 'id': '123', 'email': 'g@example.com'})
+        end_user = EndUser.from_google_token('google-token', org.id)
+        assert end_user.google_id == '123'
+        assert app.providers.http.requests[0][1]['headers'] == {'Authorization': 'Bearer google-token'}
+
+    def test_simulated_provider_failures(self, app, end_user):
+        app.config['SEND_SMS'] = True
+        app.providers = FakeProviders(failure_rate=1)
+        with pytest.raises(ProviderUnavailable):
+            SMSToken.generate(end_user).send()
+        assert len(app.providers.twilio.sent) == 0
+        assert app.providers.http.get(GOOGLE_USER_URL).status_code == 503
+
+    def test_fakes_keep_bounded_history(self, monkeypatch):
+        monkeypatch.setattr(providers, 'FAKE_HISTORY_SIZE', 3)
+        fakes = FakeProviders()
+        for n in range(5):
+            message = fakes.twilio.messages.create(to='+1555000000{}'.format(n), body='code')
+            fakes.ses.send_email(Destination={'ToAddresses': ['{}@example.com'.format(n)]})
+            fakes.http.get(GOOGLE_USER_URL, headers={'n': n})
+        assert message.sid == '5'
+        assert [sent['to'] for sent in fakes.twilio.sent] == ['+15550000002', '+15550000003', '+15550000004']
+        assert list(fakes.twilio.latest) == ['+15550000002', '+15550000003', '+15550000004']
+        assert len(fakes.ses.sent) == len(fakes.ses.latest) == 3
+        assert [kwargs['headers']['n'] for url, kwargs in fakes.http.requests] == [2, 3, 4]
+
+    def test_google_userinfo_made_per_request(self, app, org):
+        app.providers.http.respond(GOOGLE_USER_URL, lambda headers, **kwargs: {
+            'verified_email': True, 'id': headers['Authorization'], 'email': 'g@example.com'})
+        end_user = EndUser.from_google_token('google-token', org.id)
+        assert end_user.google_id == 'Bearer google-token'
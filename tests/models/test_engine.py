@@ -0,0 +1,67 @@
+import pytest
+from prometheus_client import REGISTRY
+
+from weasl.app import create_app
+from weasl.database import db
+from weasl.instrumentation import TimedQueuePool
+from weasl.settings import TestConfig
+
+
+def statement_timeout():
+    timeout = db.session.execute('SHOW statement_timeout').scalar()
+    db.session.rollback()
+    return timeout
+
+
+@pytest.mark.usefixtures('db')
+class TestEngine:
+
+    def test_pool_from_settings(self, app):
+        pool = db.engine.pool
+        assert isinstance(pool, TimedQueuePool)
+        assert pool.size() == app.config['DB_POOL_SIZE']
+        assert pool._max_overflow == app.config['DB_MAX_OVERFLOW']
+        assert pool._pre_ping == app.config['DB_POOL_PRE_PING']
+
+    def test_pool_usage_reported(self):
+        with db.engine.connect():
+            assert REGISTRY.get_sample_value('weasl_db_pool_checked_out_connections') >= 1
+
+    def test_no_statement_timeout_outside_requests(self):
+        assert statement_timeout() == '0'
+
+    def test_statement_timeout_per_blueprint(self, app):
+        app.config['DB_BLUEPRINT_STATEMENT_TIMEOUTS_MS'] = {'widget': 1500}
+        with app.test_request_context('/widget/org'):
+            assert statement_timeout() == '1500ms'
+        with app.test_request_context('/orgs/me'):
+            assert statement_timeout() == '0'
+
+    def test_timeout_only_set_when_it_changes(self, app):
+        app.config['DB_BLUEPRINT_STATEMENT_TIMEOUTS_MS'] = {'widget': 1500}
+        with app.test_request_context('/widget/org'):
+            assert statement_timeout() == '1500ms'
+            # behind the pool's back, so only a SET on checkout would undo it
+            db.session.execute('SET statement_timeout = 42')
+            db.session.commit()
+            assert statement_timeout() == '42ms'
+
+    def test_pgbouncer_sets_timeout_per_transaction(self, app):
+        app.config.update(DB_PGBOUNCER=True, DB_STATEMENT_TIMEOUT_MS=2000)
+        assert statement_timeout() == '2s'
+
+
+class TestConnectionStatementTimeout:
+
+    def test_connections_start_with_timeout(self):
+        class TimeoutConfig(TestConfig):
+            DB_STATEMENT_TIMEOUT_MS = 2500
+            DB_BLUEPRINT_STATEMENT_TIMEOUTS_MS = {'widget': 2500}
+
+        app = create_app(TimeoutConfig)
+        assert app.config['SQLALCHEMY_ENGINE_OPTIONS']['connect_args'] == {'options': '-c statement_timeout=2500'}
+        with app.test_request_context('/widget/org'):
+            db.app = app
+            with db.engine.connect() as conn:
+                assert conn.execute('SHOW statement_timeout').scalar() == '2500ms'
+            db.engine.dispose()
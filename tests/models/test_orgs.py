@@ -0,0 +1,108 @@
+import pytest
+
+from weasl.org.cache import OrgCache
+from weasl.org.constants import OrgPropertyConstants
+from weasl.errors import InternalServerError
+from weasl.org import models
+from weasl.org.models import Org, OrgProperty, OrgPropertyTypes
+from weasl.org.schema import OrgSchema
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.mark.usefixtures('db')
+class TestOrgCache:
+
+    def test_miss_then_hit(self, org):
+        cache = OrgCache(ttl=60, max_size=10)
+        assert cache.from_client_id(org.client_id).id == org.id
+        assert cache.from_client_id(org.client_id).id == org.id
+        assert cache.stats() == {'hits': 1, 'misses': 1, 'size': 1}
+
+    def test_hit_returns_session_bound_org(self, org, db):
+        cache = OrgCache(ttl=60, max_size=10)
+        cache.from_client_secret(org.client_secret)
+        db.session.expunge_all()
+        cached = cache.from_client_secret(org.client_secret)
+        assert cached in db.session
+        assert cached.client_id == org.client_id
+
+    def test_unknown_client_id_is_cached(self, org):
+        cache = OrgCache(ttl=60, max_size=10)
+        assert cache.from_client_id('not-an-id') is None
+        assert cache.from_client_id('not-an-id') is None
+        assert cache.hits == 1
+
+    def test_entries_expire(self, org):
+        clock = FakeClock()
+        cache = OrgCache(ttl=60, max_size=10, clock=clock)
+        cache.from_client_id(org.client_id)
+        clock.now = 61
+        cache.from_client_id(org.client_id)
+        assert cache.misses == 2
+
+    def test_least_recently_used_is_evicted(self, org):
+        other = Org.generate_new()
+        cache = OrgCache(ttl=60, max_size=1)
+        cache.from_client_id(org.client_id)
+        cache.from_client_id(other.client_id)
+        cache.from_client_id(org.client_id)
+        assert cache.stats() == {'hits': 0, 'misses': 3, 'size': 1}
+
+    def test_disabled_with_zero_ttl(self, org):
+        cache = OrgCache(ttl=0, max_size=10)
+        cache.from_client_id(org.client_id)
+        cache.from_client_id(org.client_id)
+        assert cache.stats() == {'hits': 0, 'misses': 0, 'size': 0}
+
+    def test_generate_new_invalidates(self, app):
+        cache = app.org_cache
+        org = Org.generate_new()
+        cache.from_client_id(org.client_id)
+        Org.generate_new()
+        assert cache.from_client_id(org.client_id).id == org.id
+        cache.invalidate(client_id=org.client_id)
+        cache.from_client_id(org.client_id)
+        assert cache.stats()['misses'] == 2
+
+    def test_property_write_invalidates(self, app, org):
+        cache = app.org_cache
+        cache.from_client_id(org.client_id)
+        OrgProperty.save_prop_for_org(org.id, OrgPropertyConstants.COMPANY_NAME, 'Weasl')
+        assert cache.stats()['size'] == 0
+
+
+@pytest.mark.usefixtures('db')
+class TestOrgProperties:
+
+    def test_boolean_property_decoded(self, org):
+        OrgProperty.save_prop_for_org(org.id, OrgPropertyConstants.COMPANY_NAME, 'true', prop_type=OrgPropertyTypes.BOOLEAN)
+        assert OrgSchema().dump(org)['properties'][0]['value'] is True
+
+
+@pytest.mark.usefixtures('db')
+class TestGenerateOrg:
+
+    def test_one_insert_without_probes(self, query_counter):
+        with query_counter:
+            org = Org.generate_new()
+        assert [statement.split()[0] for statement in query_counter.statements] == ['INSERT']
+        assert len(org.client_id) == 10
+        assert len(org.client_secret) == 32
+
+    def test_retries_colliding_client_id(self, org, monkeypatch):
+        client_ids = iter([org.client_id, 'fresh-id-1'])
+        monkeypatch.setattr(models, 'new_client_id', lambda: next(client_ids))
+        assert Org.generate_new().client_id == 'fresh-id-1'
+
+    def test_gives_up_after_repeated_collisions(self, org, monkeypatch):
+        monkeypatch.setattr(models, 'new_client_secret', lambda: org.client_secret)
+        with pytest.raises(InternalServerError):
+            Org.generate_new()
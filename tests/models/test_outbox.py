@@ -0,0 +1,97 @@
+import datetime as dt
+
+import pytest
+from prometheus_client import REGISTRY, generate_latest
+
+from weasl import metrics
+from weasl.end_user.models import EmailToken, SMSToken
+from weasl.outbox.models import OutboxMessage
+from weasl.outbox.worker import run
+
+
+@pytest.mark.usefixtures('db')
+class TestDeliveryOutbox:
+
+    @pytest.fixture(autouse=True)
+    def async_delivery(self, app):
+        app.config['ASYNC_DELIVERY'] = True
+
+    def drain(self, app, db):
+        run(app, concurrency=2, batch_size=10, poll_interval=0, once=True)
+        db.session.expire_all()
+
+    @pytest.mark.parametrize('url, body', [
+        ('/widget/sms/send', {'phone_number': '5555555555'}),
+        ('/widget/email/send', {'email': 'test@weasl.org'}),
+    ])
+    def test_send_only_enqueues(self, testapp, org, url, body):
+        testapp.post_json(url, body, headers={'X-Weasl-Client-Id': org.client_id})
+        message = OutboxMessage.query.one()
+        assert message.delivered_at is None
+        assert message.load_token().sent is False
+
+    def test_worker_sends_tokens(self, app, db, end_user):
+        OutboxMessage.dispatch(SMSToken.generate(end_user, commit=False))
+        OutboxMessage.dispatch(EmailToken.generate(end_user, commit=False))
+        self.drain(app, db)
+        assert all(token.sent for token in SMSToken.query.all() + EmailToken.query.all())
+        assert all(message.delivered_at is not None for message in OutboxMessage.query.all())
+
+    def test_failed_delivery_is_retried_later(self, app, db, end_user, monkeypatch):
+        def fail(token):
+            raise RuntimeError('provider down')
+        monkeypatch.setattr(SMSToken, 'send', fail)
+        OutboxMessage.dispatch(SMSToken.generate(end_user, commit=False))
+        self.drain(app, db)
+        message = OutboxMessage.query.one()
+        assert message.delivered_at is None
+        assert message.attempts == 1
+        assert 'provider down' in message.last_error
+        assert OutboxMessage.claim(10, dt.timedelta(seconds=60), 5) == []
+
+    def test_inline_delivery_when_disabled(self, app, end_user):
+        app.config['ASYNC_DELIVERY'] = False
+        token = SMSToken.generate(end_user, commit=False)
+        OutboxMessage.dispatch(token)
+        assert token.sent is True
+        assert OutboxMessage.query.count() == 0
+
+    def test_failed_inline_delivery_deactivates_token(self, app, db, end_user, monkeypatch):
+        app.config['ASYNC_DELIVERY'] = False
+        def fail(token):
+            raise RuntimeError('provider down')
+        monkeypatch.setattr(SMSToken, 'send', fail)
+        with pytest.raises(RuntimeError):
+            OutboxMessage.dispatch(SMSToken.generate(end_user, commit=False))
+        db.session.expire_all()
+        token = SMSToken.query.one()
+        assert (token.active, token.sent) == (False, False)
+
+    def test_last_failed_attempt_deactivates_token(self, app, db, end_user, monkeypatch, caplog):
+        app.config['DELIVERY_MAX_ATTEMPTS'] = 1
+        def fail(token):
+            raise RuntimeError('provider down')
+        monkeypatch.setattr(SMSToken, 'send', fail)
+        abandoned = REGISTRY.get_sample_value('weasl_deliveries_abandoned_total', {'channel': 'sms'}) or 0
+        OutboxMessage.dispatch(SMSToken.generate(end_user, commit=False))
+        self.drain(app, db)
+        assert SMSToken.query.one().active is False
+        assert OutboxMessage.query.one().attempts == 1
+        assert REGISTRY.get_sample_value('weasl_deliveries_abandoned_total', {'channel': 'sms'}) == abandoned + 1
+        assert any(record.levelname == 'ERROR' and 'Giving up' in record.getMessage() for record in caplog.records)
+
+    def test_worker_pushes_metrics(self, app, db, end_user, monkeypatch):
+        pushes = []
+        monkeypatch.setattr(metrics, 'push_to_gateway', lambda gateway, job, registry, **kwargs: pushes.append(
+            (gateway, job, kwargs['grouping_key'], generate_latest(registry).decode())))
+        app.config['METRICS_PUSHGATEWAY'] = 'pushgateway:9091'
+        self.drain(app, db)
+        gateway, job, grouping_key, body = pushes[-1]
+        assert (gateway, job) == ('pushgateway:9091', 'weasl-deliver')
+        assert 'instance' in grouping_key
+        assert 'weasl_deliveries_abandoned_total' in body
+
+    def test_failed_metrics_push_is_logged(self, app, db, caplog):
+        app.config['METRICS_PUSHGATEWAY'] = 'http://127.0.0.1:9'
+        self.drain(app, db)
+        assert 'Pushing metrics to http://127.0.0.1:9 failed' in caplog.text
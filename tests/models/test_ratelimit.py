@@ -0,0 +1,56 @@
+import pytest
+
+from weasl.ratelimit import Limit, MemoryBackend, parse_limit
+
+
+class TestMemoryBackend:
+
+    def test_refills_over_the_window(self):
+        backend = MemoryBackend()
+        bucket = [('k', Limit(2, 10))]
+        assert backend.acquire(bucket, 0) == 0
+        assert backend.acquire(bucket, 0) == 0
+        assert backend.acquire(bucket, 0) == pytest.approx(5)
+        # one token back after half the window
+        assert backend.acquire(bucket, 5) == 0
+        assert backend.acquire(bucket, 5) > 0
+
+    def test_takes_from_all_buckets_or_none(self):
+        backend = MemoryBackend()
+        roomy, full = ('roomy', Limit(10, 10)), ('full', Limit(1, 10))
+        assert backend.acquire([full], 0) == 0
+        assert backend.acquire([roomy, full], 0) > 0
+        # the rejected send didn't use up the roomy bucket
+        for _ in range(10):
+            assert backend.acquire([roomy], 0) == 0
+
+    def test_release_gives_back_a_token(self):
+        backend = MemoryBackend()
+        bucket = [('a', Limit(1, 10))]
+        assert backend.acquire(bucket, 0) == 0
+        backend.release(bucket, 0)
+        assert backend.acquire(bucket, 0) == 0
+        assert backend.acquire(bucket, 0) > 0
+
+    def test_bounded_to_max_keys(self):
+        backend = MemoryBackend(max_keys=2)
+        for key in 'abc':
+            backend.acquire([(key, Limit(1, 10))], 0)
+        # the least recently used bucket was dropped, so it's full again
+        assert backend.acquire([('a', Limit(1, 10))], 0) == 0
+        assert backend.acquire([('c', Limit(1, 10))], 0) > 0
+
+
+@pytest.mark.parametrize('value, limit', [
+    ('5/300', Limit(5, 300)),
+    ('off', None),
+    (None, None),
+])
+def test_parse_limit(value, limit):
+    assert parse_limit(value) == limit
+
+
+@pytest.mark.parametrize('value', ['5', '0/60', 'five/60'])
+def test_parse_bad_limit(value):
+    with pytest.raises(ValueError):
+        parse_limit(value)
@@ -0,0 +1,87 @@
+import datetime as dt
+import io
+import json
+
+import pytest
+
+from weasl.end_user.models import EmailToken, SMSToken
+from weasl.end_user.retention import is_partitioned, list_partitions, partition_by_month, reap_tokens
+
+
+def make_tokens(db, end_user, token_cls, ages):
+    """Make a token created the given number of days ago for each age."""
+    now = dt.datetime.now(dt.timezone.utc)
+    tokens = [token_cls.generate(end_user) for _ in ages]
+    for token, age in zip(tokens, ages):
+        token.update(created_at=now - dt.timedelta(days=age), active=False, commit=False)
+    db.session.commit()
+    return [token.token for token in tokens]
+
+
+def cutoff(days):
+    return dt.datetime.now(dt.timezone.utc) - dt.timedelta(days=days)
+
+
+@pytest.mark.usefixtures('db')
+class TestReapTokens:
+
+    @pytest.mark.parametrize('token_cls', [EmailToken, SMSToken])
+    def test_deletes_only_old_tokens(self, end_user, db, token_cls):
+        kept = make_tokens(db, end_user, token_cls, [0, 1, 40, 50, 60])[:2]
+        assert reap_tokens(token_cls, cutoff(30), batch_size=2) == 3
+        assert sorted(token.token for token in token_cls.query) == sorted(kept)
+
+    def test_deletes_in_batches(self, end_user, db, query_counter):
+        make_tokens(db, end_user, SMSToken, [40] * 5)
+        with query_counter:
+            assert reap_tokens(SMSToken, cutoff(30), batch_size=2) == 5
+        deletes = [statement for statement in query_counter.statements if statement.startswith('DELETE')]
+        assert len(deletes) == 3
+
+    def test_archives_deleted_tokens(self, end_user, db):
+        reaped = make_tokens(db, end_user, EmailToken, [40, 0])[0]
+        archive = io.StringIO()
+        reap_tokens(EmailToken, cutoff(30), batch_size=10, archive=archive)
+        rows = [json.loads(line) for line in archive.getvalue().splitlines()]
+        assert [row['token'] for row in rows] == [str(reaped)]
+
+
+@pytest.mark.usefixtures('db')
+class TestPartitionTokens:
+
+    @pytest.mark.parametrize('token_cls', [EmailToken, SMSToken])
+    def test_converts_table_keeping_rows(self, end_user, db, token_cls):
+        tokens = make_tokens(db, end_user, token_cls, [0, 70])
+        partition_by_month(token_cls, months_ahead=2)
+        assert is_partitioned(token_cls.__tablename__)
+        assert sorted(token.token for token in token_cls.query) == sorted(tokens)
+        assert len(list_partitions(token_cls.__tablename__)) >= 5
+
+    def test_tokens_work_once_partitioned(self, end_user, db):
+        partition_by_month(SMSToken, months_ahead=1)
+        token = SMSToken.generate(end_user)
+        assert SMSToken.use(token.token, end_user.org_id) is not None
+
+    def test_sms_codes_unique_across_partitions(self, end_user, db, monkeypatch):
+        make_tokens(db, end_user, SMSToken, [0])
+        SMSToken.query.update({'active': True, 'created_at': cutoff(40)})
+        db.session.commit()
+        partition_by_month(SMSToken, months_ahead=1)
+        codes = iter([SMSToken.query.one().token, 'bbbbbb'])
+        monkeypatch.setattr(SMSToken, 'create_random_token', staticmethod(lambda: next(codes)))
+        assert SMSToken.generate(end_user).token == 'bbbbbb'
+
+    def test_rerun_only_adds_partitions(self, end_user, db):
+        partition_by_month(EmailToken, months_ahead=1)
+        assert partition_by_month(EmailToken, months_ahead=1) == []
+        assert len(partition_by_month(EmailToken, months_ahead=2)) == 1
+
+    def test_reaps_by_dropping_old_partitions(self, end_user, db, query_counter):
+        make_tokens(db, end_user, EmailToken, [0, 70, 71, 100])
+        partition_by_month(EmailToken, months_ahead=1)
+        before = len(list_partitions(EmailToken.__tablename__))
+        with query_counter:
+            assert reap_tokens(EmailToken, cutoff(65), batch_size=10) == 3
+        assert len(list_partitions(EmailToken.__tablename__)) < before
+        assert any(statement.startswith('DROP TABLE') for statement in query_counter.statements)
+        assert EmailToken.query.count() == 1
@@ -1,21 +1,29 @@
 """API routes for end users."""
-from datetime import datetime as dt
+import logging
+from datetime import date, datetime as dt
 
-from flask import Blueprint, jsonify, request, g
+from flask import Blueprint, current_app, jsonify, request, g, stream_with_context
 import sqlalchemy as sa
+from sqlalchemy.orm import selectinload
 
-from weasl.errors import BadRequest, Unauthorized
-from weasl.end_user.models import SMSToken, EmailToken, EndUser, EndUserPropertyTypes, EndUserProperty
+from weasl.errors import BadRequest, NotFound, PayloadTooLarge, Unauthorized
+from weasl.end_user.bulk_import import import_end_users, text_stream
+from weasl.end_user.export import CONTENT_TYPES, export_end_users, export_logins
+from weasl.end_user.models import SMSToken, EmailToken, EndUser, EndUserPropertyTypes, EndUserProperty, LoginDailyCount
 from weasl.end_user.schema import EndUserSchema, SMSTokenSchema, EmailTokenSchema
 from weasl.utils import get_request_secret_key, client_secret_required, client_id_required, friendly_arg_get, end_user_as_weasl_user_required, end_user_login_required
 from weasl.constants import Errors
 from weasl.database import db
+from weasl.pagination import paginate
+from weasl.replica import read_replica
 
 blueprint = Blueprint('end_users', __name__, url_prefix='/end_users')
+logger = logging.getLogger('weasl.imports')
 
 END_USER_SCHEMA = EndUserSchema()
 SMS_TOKEN_SCHEMA = SMSTokenSchema()
 EMAIL_TOKEN_SCHEMA = EmailTokenSchema()
+IMPORT_FORMATS = {'text/csv': 'csv', 'application/x-ndjson': 'ndjson'}
 
 
 @blueprint.route('/me', methods=['GET'], strict_slashes=False)
@@ -27,95 +35,45 @@ def get_me():
 
 @blueprint.route('/email-logins', methods=['GET'], strict_slashes=False)
 @end_user_as_weasl_user_required
+@read_replica
 def list_end_user_email_logins():
-    page_num = friendly_arg_get('page', 1, int)
-    per_page = friendly_arg_get('per_page', 10, int)
-
-    # TODO: allow ordering
     org = g.end_user.org_for_admin()
-    page = EmailToken.query.filter(EmailToken.org_id==org.id).paginate(page=page_num, per_page=per_page)
-
-    meta_pagination = {
-        'first': request.path + '?page={page}&per_page={per_page}'.format(
-            page=1, per_page=page.per_page),
-        'next': request.path + '?page={page}&per_page={per_page}'.format(
-            page=page.next_num, per_page=page.per_page),
-        'last': request.path + '?page={page}&per_page={per_page}'.format(
-            page=page.pages or 1, per_page=page.per_page),
-        'prev': request.path + '?page={page}&per_page={per_page}'.format(
-            page=page.prev_num, per_page=page.per_page),
-        'total': page.pages
-    }
-
-    if not page.has_next:
-        meta_pagination.pop('next')
-    if not page.has_prev:
-        meta_pagination.pop('prev')
-
-    return jsonify(data=EMAIL_TOKEN_SCHEMA.dump(page.items, many=True),
+    query = EmailToken.query\
+        .options(selectinload(EmailToken.end_user).selectinload(EndUser.properties))\
+        .filter(EmailToken.org_id==org.id)
+    items, meta_pagination = paginate(query, [EmailToken.created_at, EmailToken.token])
+
+    return jsonify(data=EMAIL_TOKEN_SCHEMA.dump(items, many=True),
                    meta={'pagination': meta_pagination})
 
 
 
 @blueprint.route('/sms-logins', methods=['GET'], strict_slashes=False)
 @end_user_as_weasl_user_required
+@read_replica
 def list_end_user_sms_logins():
-    page_num = friendly_arg_get('page', 1, int)
-    per_page = friendly_arg_get('per_page', 10, int)
-
-    # TODO: allow ordering
     org = g.end_user.org_for_admin()
-    page = SMSToken.query.filter(SMSToken.org_id==org.id).paginate(page=page_num, per_page=per_page)
-
-    meta_pagination = {
-        'first': request.path + '?page={page}&per_page={per_page}'.format(
-            page=1, per_page=page.per_page),
-        'next': request.path + '?page={page}&per_page={per_page}'.format(
-            page=page.next_num, per_page=page.per_page),
-        'last': request.path + '?page={page}&per_page={per_page}'.format(
-            page=page.pages or 1, per_page=page.per_page),
-        'prev': request.path + '?page={page}&per_page={per_page}'.format(
-            page=page.prev_num, per_page=page.per_page),
-        'total': page.pages
-    }
-
-    if not page.has_next:
-        meta_pagination.pop('next')
-    if not page.has_prev:
-        meta_pagination.pop('prev')
-
-    return jsonify(data=SMS_TOKEN_SCHEMA.dump(page.items, many=True),
+    query = SMSToken.query\
+        .options(selectinload(SMSToken.end_user).selectinload(EndUser.properties))\
+        .filter(SMSToken.org_id==org.id)
+    items, meta_pagination = paginate(query, [SMSToken.created_at, SMSToken.token, SMSToken.end_user_id])
+
+    return jsonify(data=SMS_TOKEN_SCHEMA.dump(items, many=True),
                    meta={'pagination': meta_pagination})
 
 
 @blueprint.route('', methods=['GET'], strict_slashes=False)
 @end_user_as_weasl_user_required
+@read_replica
 def list_my_end_users():
-    page_num = friendly_arg_get('page', 1, int)
-    per_page = friendly_arg_get('per_page', 10, int)
-
-    # TODO: allow ordering
     org = g.end_user.org_for_admin()
-    page = EndUser.query.filter(EndUser.org_id==org.id).paginate(page=page_num, per_page=per_page)
-
-    meta_pagination = {
-        'first': request.path + '?page={page}&per_page={per_page}'.format(
-            page=1, per_page=page.per_page),
-        'next': request.path + '?page={page}&per_page={per_page}'.format(
-            page=page.next_num, per_page=page.per_page),
-        'last': request.path + '?page={page}&per_page={per_page}'.format(
-            page=page.pages or 1, per_page=page.per_page),
-        'prev': request.path + '?page={page}&per_page={per_page}'.format(
-            page=page.prev_num, per_page=page.per_page),
-        'total': page.pages
-    }
-
-    if not page.has_next:
-        meta_pagination.pop('next')
-    if not page.has_prev:
-        meta_pagination.pop('prev')
-
-    return jsonify(data=END_USER_SCHEMA.dump(page.items, many=True),
+    # load the properties for the whole page in one IN (...) query
+    query = EndUser.query\
+        .options(selectinload(EndUser.properties))\
+        .filter(EndUser.org_id==org.id)
+    items, meta_pagination = paginate(query, [EndUser.created_at, EndUser.id])
+
+    return jsonify(data=END_USER_SCHEMA.dump(items, many=True),
                    meta={'pagination': meta_pagination})
 
 
@@ -130,46 +88,152 @@ def update_attribute(uid, attribute_name):
         raise BadRequest(Errors.ATTRIBUTE_VALUE_MISSING)
     attr_type = request.json.get('type')
     if attr_type is None:
-        attr_type = EndUserPropertyTypes.STRING
+        attr_type = 'STRING'
     try:
         attr_type = EndUserPropertyTypes[attr_type]
     except KeyError:
         raise BadRequest(Errors.BAD_PROPERTY_TYPE)
     secret_key = get_request_secret_key()
-    prop = EndUserProperty.query.get((end_user.id, attribute_name))
-    if prop is not None:
-        prop.update(
-            property_type = attr_type,
-            property_value = value,
-            trusted = g.current_org.client_secret == secret_key,
-        )
-    else:
-        EndUserProperty.create(
-            end_user_id = end_user.id,
-            property_type = attr_type,
-            property_name = attribute_name,
-            property_value = value,
-            trusted = g.current_org.client_secret == secret_key,
-        )
+    EndUserProperty.save_prop_for_end_user(
+        end_user.id,
+        attribute_name,
+        value,
+        attr_type,
+        g.current_org.client_secret == secret_key,
+    )
     return jsonify(data=END_USER_SCHEMA.dump(end_user)), 200
 
 
-@blueprint.route('/aggregate/logins', methods=['GET'])
+@blueprint.route('/<string:uid>/attributes', methods=['POST', 'PATCH', 'PUT'])
+@client_secret_required
+def update_attributes(uid):
+    """Save many attributes at once from a body of {"attributes": {name: {"value", "type"}}}."""
+    end_user = EndUser.find(uid)
+    if end_user is None or end_user.org_id != g.current_org.id:
+        raise NotFound(Errors.END_USER_NOT_FOUND)
+    body = request.json
+    attributes = body.get('attributes') or {} if isinstance(body, dict) else None
+    if not isinstance(attributes, dict) or not all(isinstance(attribute, dict) for attribute in attributes.values()):
+        raise BadRequest(Errors.BAD_ATTRIBUTES)
+    props = []
+    for attribute_name, attribute in attributes.items():
+        value = attribute.get('value')
+        if value is None:
+            raise BadRequest(Errors.ATTRIBUTE_VALUE_MISSING)
+        try:
+            attr_type = EndUserPropertyTypes[attribute.get('type') or 'STRING']
+        except (KeyError, TypeError):
+            raise BadRequest(Errors.BAD_PROPERTY_TYPE)
+        try:
+            value = attr_type.encode(value)
+        except ValueError:
+            raise BadRequest(Errors.BAD_ATTRIBUTE_VALUE)
+        props.append((attribute_name, value, attr_type, True))
+    if props:
+        EndUserProperty.save_props_for_end_user(end_user.id, props)
+    return jsonify(data=END_USER_SCHEMA.dump(end_user)), 200
+
+
+@blueprint.route('/export', methods=['GET'])
 @end_user_as_weasl_user_required
-def get_aggregate_logins():
-    """Get the logins aggregated by date for the account."""
+@read_replica
+def export_my_end_users():
+    """Stream every end user in the org, with their attributes."""
+    org = g.end_user.org_for_admin()
+    return export_response(export_end_users, org.id)
+
+
+@blueprint.route('/email-logins/export', methods=['GET'])
+@end_user_as_weasl_user_required
+@read_replica
+def export_end_user_email_logins():
+    """Stream every email login in the org."""
     org = g.end_user.org_for_admin()
+    return export_response(export_logins, EmailToken, org.id)
 
-    sms_logins = SMSToken.query.session\
-        .query(sa.func.count(SMSToken.token), sa.func.date(SMSToken.created_at))\
-        .group_by(sa.func.date(SMSToken.created_at))\
-        .filter(SMSToken.org_id==org.id)\
-        .all()
 
-    email_logins = EmailToken.query.session\
-        .query(sa.func.count(EmailToken.token), sa.func.date(EmailToken.created_at))\
-        .group_by(sa.func.date(EmailToken.created_at))\
-        .filter(EmailToken.org_id==org.id)\
-        .all()
+@blueprint.route('/sms-logins/export', methods=['GET'])
+@end_user_as_weasl_user_required
+@read_replica
+def export_end_user_sms_logins():
+    """Stream every SMS login in the org."""
+    org = g.end_user.org_for_admin()
+    return export_response(export_logins, SMSToken, org.id)
+
+
+def export_response(open_export, *args):
+    """Stream an export as ?format=ndjson (the default) or csv, gzipped if the client accepts it.
+
+    The export is opened here rather than when the response is iterated, so
+    its query runs while the read_replica route is still being served.
+    """
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in CONTENT_TYPES:
+        raise BadRequest(Errors.BAD_EXPORT_FORMAT)
+    export = open_export(*args, since=request.args.get('since'))
+    compress = 'gzip' in request.accept_encodings
+    body = export.stream(fmt, current_app.config['EXPORT_BATCH_SIZE'], compress)
+    response = current_app.response_class(stream_with_context(body), content_type=CONTENT_TYPES[fmt])
+    if compress:
+        response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+@blueprint.route('/import', methods=['POST'])
+@client_secret_required
+def import_users():
+    """Import the org's existing users from a CSV or NDJSON body, streamed in chunks.
+
+    The import runs within the request, so bodies are limited to
+    IMPORT_MAX_BYTES; larger imports go through flask import-end-users. See
+    weasl.end_user.bulk_import for the formats.
+    """
+    fmt = IMPORT_FORMATS.get(request.mimetype)
+    if fmt is None:
+        raise BadRequest(Errors.BAD_IMPORT_FORMAT)
+    if request.content_length is None or request.content_length > current_app.config['IMPORT_MAX_BYTES']:
+        raise PayloadTooLarge(Errors.IMPORT_TOO_LARGE)
+    org_id = g.current_org.id
+
+    def log_progress(stats):
+        logger.info('Imported %d rows for org %d', stats.rows + stats.invalid, org_id)
+
+    try:
+        stream = text_stream(request.stream, request.mimetype_params.get('charset', 'utf-8'))
+    except LookupError:
+        raise BadRequest(Errors.BAD_IMPORT_CHARSET)
+    stats = import_end_users(org_id, stream, fmt, current_app.config['IMPORT_CHUNK_SIZE'], log_progress)
+    return jsonify(data=stats.to_dict()), 200
+
 
-    return jsonify(data={'sms_logins': sms_logins, 'email_logins': email_logins})
\ No newline at end of file
+@blueprint.route('/aggregate/logins', methods=['GET'])
+@end_user_as_weasl_user_required
+@read_replica
+def get_aggregate_logins():
+    """Get the logins aggregated by date for the account.
+
+    Takes optional `from`/`to` dates (YYYY-MM-DD, inclusive) and a
+    `granularity` of day, week or month.
+    """
+    org = g.end_user.org_for_admin()
+
+    granularity = request.args.get('granularity', 'day')
+    if granularity not in LoginDailyCount.GRANULARITIES:
+        raise BadRequest(Errors.BAD_GRANULARITY)
+    try:
+        start, end = [
+            date.fromisoformat(request.args[arg]) if arg in request.args else None
+            for arg in ('from', 'to')
+        ]
+    except ValueError:
+        raise BadRequest(Errors.BAD_DATE)
+
+    rows = LoginDailyCount.aggregate(org.id, start, end, granularity)
+
+    return jsonify(data={
+        'sms_logins': [(row.sms_created, row.period) for row in rows if row.sms_created],
+        'email_logins': [(row.email_created, row.period) for row in rows if row.email_created],
+        'sms_verifications': [(row.sms_used, row.period) for row in rows if row.sms_used],
+        'email_verifications': [(row.email_used, row.period) for row in rows if row.email_used],
+    })
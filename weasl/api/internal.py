@@ -0,0 +1,26 @@
+"""API routes for operating the service."""
+import hmac
+
+from flask import Blueprint, current_app, request
+
+from weasl import metrics
+from weasl.constants import Errors
+from weasl.errors import NotFound, Unauthorized
+
+blueprint = Blueprint('internal', __name__, url_prefix='/internal')
+
+
+@blueprint.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Get the metrics for every worker in the Prometheus text format.
+
+    Only served when METRICS_TOKEN is set, to requests that send it as a bearer token.
+    """
+    token = current_app.config['METRICS_TOKEN']
+    if not token:
+        raise NotFound(Errors.METRICS_DISABLED)
+    auth_header = request.headers.get('Authorization', '')
+    if not hmac.compare_digest(auth_header.encode('utf-8'), 'Bearer {}'.format(token).encode('utf-8')):
+        raise Unauthorized(Errors.BAD_METRICS_TOKEN)
+    body, content_type = metrics.exposition()
+    return current_app.response_class(body, content_type=content_type)
@@ -8,6 +8,7 @@ from weasl.errors import BadRequest, Forbidden
 from weasl.org.models import Org, OrgPropertyTypes, OrgPropertyNamespaces, OrgProperty
 from weasl.org.schema import OrgSchema
 from weasl.org.constants import Constant
+from weasl.ratelimit import SETTING_PREFIX, parse_limit
 from weasl.utils import client_id_required, end_user_as_weasl_user_required
 
 blueprint = Blueprint('orgs', __name__, url_prefix='/orgs')
@@ -76,6 +77,12 @@ def update_integration(property_name: str):
         except KeyError:
             raise BadRequest(Errors.BAD_PROPERTY_TYPE)
 
+    if property_name.startswith(SETTING_PREFIX):
+        try:
+            parse_limit(value)
+        except (AttributeError, ValueError):
+            raise BadRequest(Errors.BAD_RATE_LIMIT)
+
     org = g.end_user.org_for_admin()
     OrgProperty.save_prop_for_org(
         org.id,
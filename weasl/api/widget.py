@@ -1,18 +1,21 @@
 """API routes that power the widget."""
 from datetime import datetime as dt
 
-from flask import Blueprint, jsonify, request, g
+from flask import Blueprint, current_app, jsonify, request, g
 from marshmallow import EXCLUDE
-import pytz
 import uuid
 from validate_email import validate_email
 
 from weasl.errors import BadRequest, Unauthorized
-from weasl.end_user.models import SMSToken, EmailToken, EndUser, EndUserPropertyTypes, EndUserProperty
+from weasl.end_user.models import SMSToken, EmailToken, EndUser, EndUserPropertyTypes, EndUserProperty, reusable_token
 from weasl.end_user.schema import EndUserSchema, SMSTokenSchema, EmailTokenSchema
 from weasl.org.schema import OrgSchema
-from weasl.utils import client_id_required, end_user_login_required, friendly_arg_get
+from weasl.outbox.models import OutboxMessage
+from weasl.ratelimit import rate_limited, refund_send
+from weasl.utils import (client_id_required, conditional_response, end_user_login_required, friendly_arg_get,
+                         get_request_secret_key)
 from weasl.constants import Errors
+from weasl.database import db
 
 blueprint = Blueprint('widget', __name__, url_prefix='/widget')
 
@@ -25,14 +28,30 @@ PUBLIC_ORG_SCHEMA = OrgSchema(exclude=OrgSchema.private_fields, unknown=EXCLUDE)
 @blueprint.route('/org', methods=['GET'])
 @client_id_required
 def get_public_org():
-    return jsonify(data=PUBLIC_ORG_SCHEMA.dump(g.current_org)), 200
+    org = g.current_org
+    response = conditional_response(
+        'org-{}-{}'.format(org.id, org.version),
+        lambda: jsonify(data=PUBLIC_ORG_SCHEMA.dump(org)),
+        public=True,
+        max_age=current_app.config['WIDGET_ORG_MAX_AGE'],
+    )
+    response.vary.add('X-Weasl-Client-Id')
+    return response
 
 
 @blueprint.route('/me', methods=['GET'], strict_slashes=False)
 @client_id_required
 @end_user_login_required
 def get_me():
-    return jsonify(data=END_USER_SCHEMA.dump(g.end_user)), 200
+    end_user = g.end_user
+    response = conditional_response(
+        'end-user-{}-{}'.format(end_user.id, end_user.version),
+        lambda: jsonify(data=END_USER_SCHEMA.dump(end_user)),
+        private=True,
+        no_cache=True,
+    )
+    response.vary.add('Authorization')
+    return response
 
 
 @blueprint.route('/sms/verify', methods=['POST', 'PUT', 'PATCH'])
@@ -46,8 +65,6 @@ def verify_via_sms():
         raise BadRequest(Errors.NO_TOKEN)
     sms_token = SMSToken.use(token_string, g.current_org.id)
     if sms_token:
-        end_user = sms_token.end_user
-        end_user.update(last_login_at=dt.utcnow().replace(tzinfo=pytz.utc))
         return jsonify({'JWT': sms_token.end_user.encode_auth_token().decode('utf-8')})
     else:
         raise Unauthorized(Errors.BAD_TOKEN)
@@ -55,10 +72,12 @@ def verify_via_sms():
 
 @blueprint.route('/sms/send', methods=['POST', 'PUT', 'PATCH'])
 @client_id_required
+@rate_limited('sms', 'phone_number')
 def send_to_sms():
     phone_number = request.json.get('phone_number')
     if phone_number is None:
         raise BadRequest(Errors.PHONE_REQUIRED)
+    idempotency_key = get_idempotency_key()
     end_user = EndUser.query.filter(
         EndUser.phone_number == phone_number,
         EndUser.org_id == g.current_org.id,
@@ -71,9 +90,7 @@ def send_to_sms():
             created_at=dt.utcnow(),
             updated_at=dt.utcnow(),
         )
-    # create an SMS token and send it
-    token = SMSToken.generate(end_user)
-    token.send()
+    send_token(SMSToken, end_user, idempotency_key)
     return jsonify({'message': 'token successfully sent'}), 200
 
 
@@ -92,8 +109,6 @@ def verify_via_email():
         raise BadRequest(Errors.BAD_GUID)
     email_token = EmailToken.use(uuid_token, g.current_org.id)
     if email_token:
-        end_user = email_token.end_user
-        end_user.update(last_login_at=dt.utcnow().replace(tzinfo=pytz.utc))
         return jsonify({'JWT': email_token.end_user.encode_auth_token().decode('utf-8')})
     else:
         raise Unauthorized(Errors.BAD_TOKEN)
@@ -101,12 +116,14 @@ def verify_via_email():
 
 @blueprint.route('/email/send', methods=['POST', 'PUT', 'PATCH'])
 @client_id_required
+@rate_limited('email', 'email')
 def send_to_email():
     email = request.json.get('email')
     if email is None:
         raise BadRequest(Errors.EMAIL_REQUIRED)
     if not validate_email(email):
         raise BadRequest(Errors.INVALID_EMAIL)
+    idempotency_key = get_idempotency_key()
     email = email.lower()
     end_user = EndUser.query.filter(
         EndUser.email == email,
@@ -120,12 +137,28 @@ def send_to_email():
             created_at=dt.utcnow(),
             updated_at=dt.utcnow(),
         )
-    # create an email token and send it
-    token = EmailToken.generate(end_user)
-    token.send()
+    send_token(EmailToken, end_user, idempotency_key)
     return jsonify({'message': 'token successfully sent'}), 200
 
 
+def get_idempotency_key():
+    """Get the send's Idempotency-Key header, if it has one."""
+    idempotency_key = request.headers.get('Idempotency-Key') or None
+    if idempotency_key is not None and len(idempotency_key) > 255:
+        raise BadRequest(Errors.BAD_IDEMPOTENCY_KEY)
+    return idempotency_key
+
+
+def send_token(token_cls, end_user, idempotency_key=None):
+    """Create a token for the end user and send it, unless this repeats a send that should be reused."""
+    if reusable_token(token_cls, end_user, idempotency_key) is not None:
+        db.session.commit()
+        refund_send()
+        return
+    token = token_cls.generate(end_user, commit=False, idempotency_key=idempotency_key)
+    OutboxMessage.dispatch(token)
+
+
 @blueprint.route('/attributes/<string:attribute_name>', methods=['POST', 'PATCH', 'PUT'])
 @end_user_login_required
 @client_id_required
@@ -135,27 +168,19 @@ def update_attributes(attribute_name):
         raise BadRequest(Errors.ATTRIBUTE_VALUE_MISSING)
     attr_type = request.json.get('type')
     if attr_type is None:
-        attr_type = EndUserPropertyTypes.STRING
+        attr_type = 'STRING'
     try:
         attr_type = EndUserPropertyTypes[attr_type]
     except KeyError:
         raise BadRequest(Errors.BAD_PROPERTY_TYPE)
     secret_key = get_request_secret_key()
-    prop = EndUserProperty.query.get((g.end_user.id, attribute_name))
-    if prop is not None:
-        prop.update(
-            property_type=attr_type,
-            property_value=value,
-            trusted=g.current_org.client_secret == secret_key,
-        )
-    else:
-        EndUserProperty.create(
-            end_user_id=g.end_user.id,
-            property_type=attr_type,
-            property_name=attribute_name,
-            property_value=value,
-            trusted=g.current_org.client_secret == secret_key,
-        )
+    EndUserProperty.save_prop_for_end_user(
+        g.end_user.id,
+        attribute_name,
+        value,
+        attr_type,
+        g.current_org.client_secret == secret_key,
+    )
     return jsonify(data=END_USER_SCHEMA.dump(g.end_user)), 200
 
 
@@ -8,14 +8,19 @@ from flask_cors import CORS
 from marshmallow.exceptions import ValidationError
 from flask_sslify import SSLify
 from sentry_sdk.integrations.flask import FlaskIntegration
-from twilio.rest import Client
 
-from weasl import commands
+from weasl import commands, instrumentation
+from weasl.database import init_engine
 from weasl.errors import APIException
 from weasl.extensions import db, migrate
 from weasl.settings import ProdConfig
+from weasl.org.cache import OrgCache
+from weasl.providers import Providers
+from weasl.ratelimit import RateLimiter
+from weasl.replica import ReplicaLag
 from weasl.org.models import Org
 from weasl.end_user.models import EndUser
+from weasl.outbox.models import OutboxMessage
 
 
 def create_app(config_object=ProdConfig):
@@ -27,10 +32,13 @@ def create_app(config_object=ProdConfig):
     """
     app = Flask(__name__.split('.')[0])
     app.config.from_object(config_object)
-    app.twilio_client = Client(
-        config_object.TWILIO_ACCOUNT_SID,
-        config_object.TWILIO_AUTH_TOKEN,
+    app.providers = Providers.from_config(app.config)
+    app.org_cache = OrgCache(
+        ttl=config_object.ORG_CACHE_TTL,
+        max_size=config_object.ORG_CACHE_MAX_SIZE,
     )
+    app.replica_lag = ReplicaLag(config_object.REPLICA_LAG_CHECK_SECONDS)
+    app.rate_limiter = RateLimiter.from_config(app.config)
     register_blueprints(app)
     register_extensions(app)
     register_errorhandlers(app)
@@ -59,8 +67,10 @@ def register_extensions(app):
         dsn=app.config['SENTRY_DSN'],
         integrations=[FlaskIntegration()]
     )
+    init_engine(app)
     db.init_app(app)
     migrate.init_app(app, db)
+    instrumentation.init_app(app)
     CORS(
         app,
         resources={
@@ -78,6 +88,7 @@ def register_blueprints(app):
     from weasl.api.orgs import blueprint as orgs_blueprint
     from weasl.api.end_users import blueprint as end_users_blueprint
     from weasl.api.widget import blueprint as widget_blueprint
+    from weasl.api.internal import blueprint as internal_blueprint
 
     from weasl.views.landing import blueprint as landing_blueprint
     from weasl.views.emails import blueprint as emails_blueprint
@@ -85,6 +96,7 @@ def register_blueprints(app):
     app.register_blueprint(widget_blueprint)
     app.register_blueprint(orgs_blueprint)
     app.register_blueprint(end_users_blueprint)
+    app.register_blueprint(internal_blueprint)
     app.register_blueprint(landing_blueprint)
     app.register_blueprint(emails_blueprint)
     return None
@@ -102,7 +114,7 @@ def register_errorhandlers(app):
     @app.errorhandler(APIException)
     def handle_api_error(err):
         """Handle an APIException."""
-        return jsonify(err.to_dict()), err.status_code
+        return jsonify(err.to_dict()), err.status_code, err.headers
 
     @app.errorhandler(404)
     def handle_404_error(err):
@@ -130,3 +142,9 @@ def register_commands(app):
     app.cli.add_command(commands.lint)
     app.cli.add_command(commands.clean)
     app.cli.add_command(commands.urls)
+    app.cli.add_command(commands.bench)
+    app.cli.add_command(commands.deliver)
+    app.cli.add_command(commands.backfill_login_counts)
+    app.cli.add_command(commands.reap_tokens)
+    app.cli.add_command(commands.partition_tokens)
+    app.cli.add_command(commands.import_end_users)
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""Microbenchmarks for the CPU-bound code on the login and widget paths.
+
+Each hot path runs on objects built in memory, with no database or provider
+calls, so only the Python work is measured. Results are the median and best
+nanoseconds per call over several timed rounds. Runs are compared with a saved
+baseline on the best round, since the median moves with whatever else the
+machine is doing and only noise makes a round faster.
+"""
+import datetime as dt
+import json
+import platform
+import statistics
+import subprocess
+import timeit
+import uuid
+from types import SimpleNamespace
+
+from flask import render_template
+
+from weasl.end_user.models import EmailToken, EndUser, EndUserProperty, EndUserPropertyTypes, SMSToken
+from weasl.end_user.schema import EndUserSchema
+from weasl.org.models import OrgProperty, OrgPropertyNamespaces, OrgPropertyTypes
+from weasl.org.schema import OrgSchema
+
+HOT_PATHS = {}
+
+
+def hot_path(name):
+    """Register a hot path by name.
+
+    The decorated function sets up the objects the path needs and returns a
+    function of no arguments that runs the path once.
+    """
+    def register(setup):
+        HOT_PATHS[name] = setup
+        return setup
+    return register
+
+
+def _end_user(attributes=0):
+    now = dt.datetime.utcnow()
+    end_user = EndUser(id=uuid.uuid4(), org_id=1, email='bench@example.com', phone_number='+15555555555',
+                       created_at=now, updated_at=now, last_login_at=now)
+    end_user.properties = [
+        EndUserProperty(property_name='attribute_{}'.format(i), property_value=str(i),
+                        property_type=EndUserPropertyTypes.NUMBER, trusted=bool(i % 2))
+        for i in range(attributes)
+    ]
+    return end_user
+
+
+@hot_path('encode_auth_token')
+def _encode_auth_token(attributes):
+    return _end_user().encode_auth_token
+
+
+@hot_path('decode_auth_token')
+def _decode_auth_token(attributes):
+    token = _end_user().encode_auth_token()
+    return lambda: EndUser.decode_auth_token(token)
+
+
+@hot_path('end_user_schema_dump')
+def _end_user_schema_dump(attributes):
+    schema, end_user = EndUserSchema(), _end_user(attributes)
+    return lambda: schema.dump(end_user)
+
+
+@hot_path('org_schema_dump')
+def _org_schema_dump(attributes):
+    schema = OrgSchema()
+    # Org.properties is a query, so dump a stand-in with the org's fields
+    org = SimpleNamespace(id=1, client_id='0123456789', client_secret='0123456789abcdef0123456789abcdef')
+    org.properties = [
+        OrgProperty(org_id=1, property_name='property_{}'.format(i), property_value=str(i),
+                    property_type=OrgPropertyTypes.NUMBER, property_namespace=OrgPropertyNamespaces.NONE)
+        for i in range(attributes)
+    ]
+    return lambda: schema.dump(org)
+
+
+@hot_path('build_magiclink')
+def _build_magiclink(attributes):
+    token = uuid.uuid4()
+    return lambda: EmailToken.build_magiclink('https://example.com/login?next=%2Faccount&utm_source=email', token)
+
+
+@hot_path('create_random_token')
+def _create_random_token(attributes):
+    return SMSToken.create_random_token
+
+
+@hot_path('render_magiclink_email')
+def _render_magiclink_email(attributes):
+    magiclink = 'https://example.com/login?w_token={}'.format(uuid.uuid4())
+    return lambda: render_template('emails/magiclink.html', org_name='Bench Co', email_magiclink=magiclink)
+
+
+def measure(run, rounds, min_seconds):
+    """Time a function over several rounds of enough calls to take at least min_seconds each.
+
+    :return: a dict of the median and best nanoseconds per call, and the calls per round
+    """
+    timer = timeit.Timer(run)
+    calls = 1
+    while timer.timeit(calls) < min_seconds:
+        calls *= 2
+    per_call = [seconds / calls * 1e9 for seconds in timer.repeat(repeat=rounds, number=calls)]
+    return {
+        'median_ns': round(statistics.median(per_call), 1),
+        'best_ns': round(min(per_call), 1),
+        'calls': calls,
+    }
+
+
+def run_benchmarks(names=None, attributes=20, rounds=5, min_seconds=0.2):
+    """Run the hot paths, in an app context.
+
+    :param names: the hot paths to run, or None for all of them
+    :param attributes int: the number of attributes or properties on the dumped end user and org
+    :return: the results, with the settings and the commit they were run at
+    """
+    results = {}
+    for name in names or sorted(HOT_PATHS):
+        results[name] = measure(HOT_PATHS[name](attributes), rounds, min_seconds)
+    return {
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'settings': {'attributes': attributes, 'rounds': rounds, 'min_seconds': min_seconds},
+        'results': results,
+    }
+
+
+def compare(results, baseline, threshold):
+    """Compare best times with a baseline's.
+
+    :param threshold float: the allowed slowdown, e.g. 0.1 for 10%
+    :return: a list of (name, baseline ns, current ns, change) for the paths in both, and
+        a list of the names of those that regressed beyond the threshold
+    """
+    changes, regressions = [], []
+    for name, current in sorted(results['results'].items()):
+        before = baseline['results'].get(name)
+        if before is None:
+            continue
+        change = current['best_ns'] / before['best_ns'] - 1
+        changes.append((name, before['best_ns'], current['best_ns'], change))
+        if change > threshold:
+            regressions.append(name)
+    return changes, regressions
+
+
+def load(path):
+    """Read saved results."""
+    with open(path) as f:
+        return json.load(f)
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL)\
+            .decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
 """Click commands."""
+import datetime as dt
+import json
 import os
+import time
 from glob import glob
 from subprocess import call
 
@@ -47,6 +50,155 @@ def lint(fix_imports):
     execute_tool('Checking code style', 'flake8')
 
 
+@click.command()
+@click.option('-c', '--concurrency', default=None, type=int,
+              help='Number of messages to send at once (default: DELIVERY_CONCURRENCY)')
+@click.option('-b', '--batch-size', default=None, type=int,
+              help='Number of messages to claim per poll (default: DELIVERY_BATCH_SIZE)')
+@click.option('--once', default=False, is_flag=True,
+              help='Exit once the outbox is empty instead of polling')
+@with_appcontext
+def deliver(concurrency, batch_size, once):
+    """Send the SMS and email tokens queued in the delivery outbox."""
+    from weasl.outbox.worker import run
+    config = current_app.config
+    run(
+        current_app._get_current_object(),
+        concurrency=concurrency or config['DELIVERY_CONCURRENCY'],
+        batch_size=batch_size or config['DELIVERY_BATCH_SIZE'],
+        poll_interval=config['DELIVERY_POLL_INTERVAL'],
+        once=once,
+    )
+
+
+@click.command('backfill-login-counts')
+@with_appcontext
+def backfill_login_counts():
+    """Rebuild the daily login rollups from the SMS and email token tables.
+
+    Run it once after the rollup table is created; counts written by requests
+    while it runs are overwritten.
+    """
+    from weasl.end_user.models import EmailToken, LoginDailyCount, SMSToken
+    LoginDailyCount.backfill(SMSToken, 'sms')
+    LoginDailyCount.backfill(EmailToken, 'email')
+    click.echo('Backfilled the daily login counts')
+
+
+@click.command('reap-tokens')
+@click.option('-d', '--days', default=None, type=int,
+              help='Keep tokens created in the last this many days (default: TOKEN_RETENTION_DAYS)')
+@click.option('-b', '--batch-size', default=None, type=int,
+              help='Number of tokens to delete per transaction (default: TOKEN_REAP_BATCH_SIZE)')
+@click.option('-a', '--archive', default=None, type=click.File('a'),
+              help='Append the deleted tokens to this file as JSON lines')
+@with_appcontext
+def reap_tokens(days, batch_size, archive):
+    """Delete the SMS and email tokens that are past the retention window.
+
+    On partitioned token tables, whole months past the window are dropped and
+    the partitions for the coming months are created.
+    """
+    from weasl.end_user.models import EmailToken, SMSToken
+    from weasl.end_user import retention
+    config = current_app.config
+    days = config['TOKEN_RETENTION_DAYS'] if days is None else days
+    before = dt.datetime.now(dt.timezone.utc) - dt.timedelta(days=days)
+    for token_cls in (SMSToken, EmailToken):
+        if retention.is_partitioned(token_cls.__tablename__):
+            retention.partition_by_month(token_cls, config['TOKEN_PARTITION_MONTHS_AHEAD'])
+        reaped = retention.reap_tokens(
+            token_cls, before, batch_size or config['TOKEN_REAP_BATCH_SIZE'], archive=archive)
+        click.echo('Reaped {} tokens from {}'.format(reaped, token_cls.__tablename__))
+
+
+@click.command('partition-tokens')
+@click.option('-m', '--months-ahead', default=None, type=int,
+              help='Number of future months to create partitions for (default: TOKEN_PARTITION_MONTHS_AHEAD)')
+@with_appcontext
+def partition_tokens(months_ahead):
+    """Range partition the SMS and email token tables by month on created_at.
+
+    Converting a table copies its rows under a lock, so run it while traffic is
+    low. Running it again only adds partitions for the coming months.
+    """
+    from weasl.end_user.models import EmailToken, SMSToken
+    from weasl.end_user.retention import partition_by_month
+    if months_ahead is None:
+        months_ahead = current_app.config['TOKEN_PARTITION_MONTHS_AHEAD']
+    for token_cls in (SMSToken, EmailToken):
+        created = partition_by_month(token_cls, months_ahead)
+        click.echo('Created {} partitions of {}'.format(len(created), token_cls.__tablename__))
+
+
+@click.command('import-end-users')
+@click.argument('client_id')
+@click.argument('source', type=click.File('rb'))
+@click.option('-f', '--format', 'fmt', default=None, type=click.Choice(['csv', 'ndjson']),
+              help='Format of the source (default: from its extension)')
+@click.option('-s', '--chunk-size', default=None, type=int,
+              help='Number of rows to merge per transaction (default: IMPORT_CHUNK_SIZE)')
+@with_appcontext
+def import_end_users(client_id, source, fmt, chunk_size):
+    """Import an org's existing users from a CSV or NDJSON file, or - for stdin."""
+    from weasl.end_user.bulk_import import import_end_users, text_stream
+    from weasl.org.models import Org
+    org = Org.from_client_id(client_id)
+    if org is None:
+        raise click.BadParameter('no org has that client ID', param_hint='CLIENT_ID')
+    if fmt is None:
+        fmt = 'csv' if source.name.endswith('.csv') else 'ndjson'
+    if chunk_size is None:
+        chunk_size = current_app.config['IMPORT_CHUNK_SIZE']
+    started = time.perf_counter()
+
+    def report(stats):
+        rows = stats.rows + stats.invalid
+        click.echo('{} rows, {:.0f} rows/s: {} created, {} updated, {} skipped, {} invalid'.format(
+            rows, rows / (time.perf_counter() - started), stats.created, stats.updated, stats.skipped,
+            stats.invalid))
+
+    stats = import_end_users(org.id, text_stream(source), fmt, chunk_size, report)
+    for error in stats.errors:
+        click.echo('Line {line}: {error}'.format(**error))
+
+
+@click.command()
+@click.option('-p', '--path', 'paths', multiple=True,
+              help='Hot path to run, may be repeated (default: all of them)')
+@click.option('-n', '--attributes', default=20, type=int,
+              help='Number of attributes on the dumped end user and org (default: 20)')
+@click.option('-r', '--rounds', default=5, type=int,
+              help='Number of timed rounds per hot path (default: 5)')
+@click.option('-o', '--output', default=None, type=click.File('w'),
+              help='Write the results to this JSON file')
+@click.option('-c', '--compare', 'baseline', default=None, type=click.Path(exists=True, dir_okay=False),
+              help='Compare with results saved by an earlier run')
+@click.option('-t', '--threshold', default=0.2, type=float,
+              help='Slowdown of the best round against the baseline\'s that fails the run (default: 0.2, i.e. 20%)')
+@with_appcontext
+def bench(paths, attributes, rounds, output, baseline, threshold):
+    """Microbenchmark the CPU-bound hot paths, optionally against a baseline."""
+    from weasl import bench as benchmarks
+    unknown = set(paths) - set(benchmarks.HOT_PATHS)
+    if unknown:
+        raise click.BadParameter('no such hot path: {}'.format(', '.join(sorted(unknown))), param_hint='--path')
+    results = benchmarks.run_benchmarks(paths or None, attributes=attributes, rounds=rounds)
+    if output is not None:
+        json.dump(results, output, indent=2, sort_keys=True)
+    if baseline is None:
+        for name, result in results['results'].items():
+            click.echo('{:<24} {:>12.0f} ns  (best {:.0f} ns)'.format(name, result['median_ns'], result['best_ns']))
+        return
+    changes, regressions = benchmarks.compare(results, benchmarks.load(baseline), threshold)
+    for name, before, after, change in changes:
+        click.echo('{:<24} {:>12.0f} ns -> {:>12.0f} ns  {:+7.1%}{}'.format(
+            name, before, after, change, '  REGRESSED' if name in regressions else ''))
+    if regressions:
+        click.echo('{} hot paths regressed by more than {:.0%}'.format(len(regressions), threshold))
+        exit(1)
+
+
 @click.command()
 def clean():
     """Remove *.pyc and *.pyo files recursively starting at current directory.
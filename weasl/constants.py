@@ -23,6 +23,8 @@ class Errors(object):
     ATTRIBUTE_VALUE_MISSING = ('attributes-value-missing', 'A value is required for the attribute')
     ATTRIBUTE_TYPE_MISSING = ('attributes-type-missing', 'A type is required for the attribute')
     BAD_PROPERTY_TYPE = ('bad-property-type', 'Property type must be one of: STRING, NUMBER, JSON, BOOLEAN')
+    BAD_ATTRIBUTE_VALUE = ('bad-attribute-value', 'Attribute values must be valid for their type')
+    BAD_ATTRIBUTES = ('bad-attributes', 'Attributes must be an object of {"value": ..., "type": ...} objects')
     UNRECOGNIZED_PROPERTY = ('unrecognized-property', 'Property name is not recognized')
     BAD_NAMESPACE = ('bad-namespace', 'Namespace must be one of: NONE, GATES, THEME, SETTINGS, or INTEGRATIONS')
     NOT_ADMIN = ('not-admin', 'You need to be an admin to do that')
@@ -30,6 +32,20 @@ class Errors(object):
     AUTH_PROVIDER_FAILED = ('auth-provider-failed', 'The auth provider gave a bad response')
     INVALID_EMAIL = ('invalid-email', 'That email is invalid')
     NOT_USER = ('not-user', 'That is not a valid user type')
+    BAD_CURSOR = ('bad-cursor', 'We couldn\'t understand the pagination cursor.')
+    BAD_DATE = ('bad-date', 'Dates must be formatted as YYYY-MM-DD')
+    BAD_GRANULARITY = ('bad-granularity', 'Granularity must be one of: day, week, month')
+    METRICS_DISABLED = ('metrics-disabled', 'Metrics are not enabled')
+    BAD_METRICS_TOKEN = ('bad-metrics-token', 'A valid metrics token is required for that')
+    UNIQUE_VALUE_EXHAUSTED = ('unique-value-exhausted', 'We couldn\'t generate a unique value, please try again')
+    BAD_IMPORT_CHARSET = ('bad-import-charset', 'The import\'s charset isn\'t a known text encoding')
+    BAD_IMPORT_FORMAT = ('bad-import-format', 'Imports must be text/csv or application/x-ndjson')
+    IMPORT_TOO_LARGE = ('import-too-large', 'Imports over the API need a Content-Length within the size limit; '
+                        'use flask import-end-users for larger ones')
+    BAD_EXPORT_FORMAT = ('bad-export-format', 'Format must be one of: ndjson, csv')
+    BAD_RATE_LIMIT = ('bad-rate-limit', 'Rate limits must look like <requests>/<seconds>, or off')
+    BAD_IDEMPOTENCY_KEY = ('bad-idempotency-key', 'Idempotency-Key must be at most 255 characters')
+    RATE_LIMITED = ('rate-limited', 'Too many login attempts, please wait and try again')
 
 class Success(object):
     """Constants for success in the form of: (code, message)."""
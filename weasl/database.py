@@ -2,11 +2,17 @@
 """Database module, including the database object and DB-related utilities."""
 import uuid
 
-from sqlalchemy.dialects.postgresql import UUID
+from flask import current_app, has_app_context, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.dialects.postgresql import UUID, insert
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.pool import Pool
 
 from .constants import Errors
-from .errors import BadRequest
+from .errors import BadRequest, InternalServerError
 from .extensions import db
+from .instrumentation import TimedQueuePool
 
 # Alias common SQLAlchemy names
 Column = db.Column
@@ -121,6 +127,66 @@ class UUIDMixin(object):
         return cls.get_by_id(record_id)
 
 
+def upsert(model, rows, index_elements, update_columns, commit=True):
+    """Insert rows, updating the given columns where they conflict, in one statement.
+
+    Returns the written rows as instances in the current session, replacing the
+    state of any copies the session already holds.
+
+    :param model: the mapped class to write to
+    :param rows list: dicts of column values
+    :param index_elements list: the column names of the conflicting unique index
+    :param update_columns list: the column names to overwrite on conflict
+    """
+    table = model.__table__
+    stmt = insert(table).values(rows)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=index_elements,
+        set_={column: stmt.excluded[column] for column in update_columns},
+    ).returning(*table.columns)
+    instances = []
+    for row in db.session.execute(stmt):
+        instance = model(**dict(row))
+        make_transient_to_detached(instance)
+        instances.append(db.session.merge(instance, load=False))
+    if commit:
+        db.session.commit()
+    return instances
+
+
+def insert_unique(model, make_values, attempts=5, unless=None):
+    """Insert a row with randomly generated unique values, regenerating them on a collision.
+
+    Rather than probing with SELECTs first, the insert is tried and skipped by
+    ON CONFLICT DO NOTHING when it hits a unique index, so a collision costs one
+    more statement instead of aborting the transaction. Doesn't commit.
+
+    :param model: the mapped class to write to
+    :param make_values callable: makes a fresh dict of column values for each attempt
+    :param attempts int: how many collisions to tolerate before giving up
+    :param unless callable: takes the values and gives a clause that, if any
+        row matches it, also counts as a collision; for uniqueness an index
+        can't enforce
+    :return: the inserted row as an instance in the current session
+    """
+    table = model.__table__
+    for _ in range(attempts):
+        values = make_values()
+        if unless is None:
+            stmt = insert(table).values(values)
+        else:
+            row = db.select([db.literal(value, table.c[name].type) for name, value in values.items()])\
+                .where(~db.exists().where(unless(values)))
+            stmt = insert(table).from_select(list(values), row)
+        stmt = stmt.on_conflict_do_nothing().returning(*table.columns)
+        inserted = db.session.execute(stmt).first()
+        if inserted is not None:
+            instance = model(**dict(inserted))
+            make_transient_to_detached(instance)
+            return db.session.merge(instance, load=False)
+    raise InternalServerError(Errors.UNIQUE_VALUE_EXHAUSTED)
+
+
 def reference_col(tablename, nullable=False, pk_name='id', **kwargs):
     """Column that adds primary key foreign key reference.
 
@@ -134,6 +200,103 @@ def reference_col(tablename, nullable=False, pk_name='id', **kwargs):
         nullable=nullable, **kwargs)
 
 
+def version_col():
+    """Column for a row version, which every UPDATE of the row bumps.
+
+    Usage: ::
+
+        version = version_col()
+    """
+    return db.Column(db.Integer, nullable=False, default=1, server_default='1',
+                     onupdate=db.literal_column('version + 1'))
+
+
+def bump_version(model, record_id):
+    """Bump the version of a row without changing anything else, without committing.
+
+    For writes to rows that belong to the record, like its properties.
+    """
+    table = model.__table__
+    db.session.execute(table.update().where(table.c.id == record_id).values(version=table.c.version + 1))
+
+
+def init_engine(app):
+    """Set the app's engine options from its DB_* settings.
+
+    Anything already in SQLALCHEMY_ENGINE_OPTIONS wins over the settings.
+    """
+    config = app.config
+    options = {
+        'poolclass': TimedQueuePool,
+        'pool_size': config['DB_POOL_SIZE'],
+        'max_overflow': config['DB_MAX_OVERFLOW'],
+        'pool_timeout': config['DB_POOL_TIMEOUT'],
+        'pool_recycle': config['DB_POOL_RECYCLE'],
+        'pool_pre_ping': config['DB_POOL_PRE_PING'],
+    }
+    if config['DB_EXECUTEMANY_MODE']:
+        options['executemany_mode'] = config['DB_EXECUTEMANY_MODE']
+    # PgBouncer in transaction mode hands each transaction any server
+    # connection, so the timeout is set per transaction instead
+    if config['DB_STATEMENT_TIMEOUT_MS'] and not config['DB_PGBOUNCER']:
+        options['connect_args'] = {'options': '-c statement_timeout={}'.format(config['DB_STATEMENT_TIMEOUT_MS'])}
+    options.update(config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+    config['SQLALCHEMY_ENGINE_OPTIONS'] = options
+
+
+def statement_timeout():
+    """Get the statement timeout the current request, or anything else, should run with.
+
+    Requests to a blueprint in DB_BLUEPRINT_STATEMENT_TIMEOUTS_MS get its
+    timeout; everything else gets DB_STATEMENT_TIMEOUT_MS.
+
+    :return: the timeout in milliseconds, or None outside the app
+    """
+    if not has_app_context():
+        return None
+    config = current_app.config
+    timeout = config['DB_STATEMENT_TIMEOUT_MS']
+    if has_request_context():
+        timeout = config['DB_BLUEPRINT_STATEMENT_TIMEOUTS_MS'].get(request.blueprint, timeout)
+    return timeout
+
+
+@event.listens_for(Pool, 'checkout')
+def _set_connection_statement_timeout(dbapi_connection, connection_record, connection_proxy):
+    """Give a checked out connection the statement timeout it needs, if it doesn't have it already.
+
+    Connections start with DB_STATEMENT_TIMEOUT_MS, and remember the timeout
+    last set on them, so this only costs a statement when a connection moves
+    between blueprints with different timeouts. The SET runs outside a
+    transaction, so it outlasts the transaction it would otherwise be rolled
+    back with.
+    """
+    timeout = statement_timeout()
+    if timeout is None or current_app.config['DB_PGBOUNCER']:
+        return
+    if connection_record.info.get('statement_timeout', current_app.config['DB_STATEMENT_TIMEOUT_MS']) == timeout:
+        return
+    autocommit = dbapi_connection.autocommit
+    dbapi_connection.autocommit = True
+    try:
+        with dbapi_connection.cursor() as cursor:
+            cursor.execute('SET statement_timeout = %s', (timeout,))
+    finally:
+        dbapi_connection.autocommit = autocommit
+    connection_record.info['statement_timeout'] = timeout
+
+
+@event.listens_for(Engine, 'begin')
+def _set_transaction_statement_timeout(conn):
+    """Behind PgBouncer, set the statement timeout in every transaction, since each may get any server connection."""
+    if not has_app_context() or not current_app.config['DB_PGBOUNCER']:
+        return
+    timeout = statement_timeout()
+    if timeout:
+        with conn.connection.cursor() as cursor:
+            cursor.execute('SET LOCAL statement_timeout = %s', (timeout,))
+
+
 class UUIDModel(Model, UUIDMixin):
     __abstract__ = True
 
@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+"""Bulk importing an org's existing users.
+
+Users are read from CSV or NDJSON a chunk at a time, so memory stays flat
+however large the input is. Each chunk is COPYed into temporary staging
+tables and merged into end_users and end_user_properties in a handful of
+set-based statements, then committed.
+
+A user is matched by email if the row has one, else by phone number. New
+users are created; existing ones keep their email and phone number and get
+the row's attributes, which are trusted since imports need the client secret.
+Rows that would break the (org_id, email) or (org_id, phone_number) unique
+constraints, e.g. a new email with a phone number another user has, are
+skipped.
+
+CSV has a header row. Columns other than email, phone_number and google_id
+are attributes, of the type after a colon in their header (``seats:NUMBER``)
+or STRING. NDJSON has one object per line, with attributes shaped like the
+attributes API's: ``{"email": ..., "attributes": {"seats": {"value": 5,
+"type": "NUMBER"}}}``. A bare attribute value is a STRING.
+
+Input is decoded with undecodable bytes replaced (see text_stream), and rows
+containing a replacement are reported as invalid, so a bad byte partway
+through doesn't abort an import whose earlier chunks are committed.
+"""
+import csv
+import io
+import itertools
+import json
+
+from weasl.database import db
+from weasl.end_user.models import EndUserProperty, EndUserPropertyTypes
+
+FORMATS = ('csv', 'ndjson')
+IDENTITY_FIELDS = ('email', 'phone_number', 'google_id')
+MAX_ERRORS = 20
+# What text_stream decodes bytes that aren't valid in the charset to
+REPLACEMENT = '\ufffd'
+UNDECODABLE = "has bytes that aren't valid in the import's charset"
+
+
+class InvalidRow(ValueError):
+    """Raised for a row that can't be imported."""
+
+
+class ImportStats(object):
+    """Running counts for an import."""
+
+    def __init__(self):
+        self.rows = 0
+        self.created = 0
+        self.updated = 0
+        self.skipped = 0
+        self.invalid = 0
+        self.attributes = 0
+        self.errors = []
+
+    def add_error(self, line, message):
+        """Count an invalid row, keeping the first few errors to report."""
+        self.invalid += 1
+        if len(self.errors) < MAX_ERRORS:
+            self.errors.append({'line': line, 'error': message})
+
+    def to_dict(self):
+        return {
+            'rows': self.rows,
+            'created': self.created,
+            'updated': self.updated,
+            'skipped': self.skipped,
+            'invalid': self.invalid,
+            'attributes': self.attributes,
+            'errors': self.errors,
+        }
+
+
+def text_stream(binary, encoding='utf-8'):
+    """Decode a binary stream for import_end_users, replacing bytes that aren't valid in the encoding.
+
+    :raises LookupError: if the encoding isn't a known text encoding
+    """
+    return io.TextIOWrapper(binary, encoding=encoding, errors='replace', newline='')
+
+
+def read_csv(stream):
+    """Read users from CSV text.
+
+    :return: an iterator of (line, user dict or InvalidRow)
+    """
+    reader = csv.reader(stream)
+    header = next(reader, None)
+    if header is None:
+        return
+    if any(REPLACEMENT in name for name in header):
+        yield 1, InvalidRow('the header {}'.format(UNDECODABLE))
+        return
+    columns = []
+    for name in header:
+        name, _, type_name = name.strip().partition(':')
+        columns.append((name, type_name or 'STRING'))
+    for line, values in enumerate(reader, start=2):
+        if len(values) != len(columns):
+            yield line, InvalidRow('expected {} columns, got {}'.format(len(columns), len(values)))
+            continue
+        if any(REPLACEMENT in value for value in values):
+            yield line, InvalidRow('the row {}'.format(UNDECODABLE))
+            continue
+        user = {'attributes': {}}
+        for (name, type_name), value in zip(columns, values):
+            if name in IDENTITY_FIELDS:
+                user[name] = value
+            elif value != '':
+                user['attributes'][name] = {'value': value, 'type': type_name}
+        yield line, user
+
+
+def read_ndjson(stream):
+    """Read users from newline-delimited JSON text.
+
+    :return: an iterator of (line, user dict or InvalidRow)
+    """
+    for line, text in enumerate(stream, start=1):
+        if not text.strip():
+            continue
+        if REPLACEMENT in text:
+            yield line, InvalidRow('the row {}'.format(UNDECODABLE))
+            continue
+        try:
+            user = json.loads(text)
+        except ValueError as exc:
+            yield line, InvalidRow('invalid JSON: {}'.format(exc))
+            continue
+        if not isinstance(user, dict):
+            yield line, InvalidRow('expected an object')
+            continue
+        yield line, user
+
+
+READERS = {'csv': read_csv, 'ndjson': read_ndjson}
+
+
+def staged_rows(line, user):
+    """Turn a read user into rows for the staging tables.
+
+    :return: a tuple of (user row, attribute rows)
+    """
+    email, phone_number, google_id = (user.get(field) or None for field in IDENTITY_FIELDS)
+    if email is None and phone_number is None:
+        raise InvalidRow('an email or phone_number is required')
+    if not all(isinstance(value, str) for value in (email, phone_number, google_id) if value is not None):
+        raise InvalidRow('email, phone_number and google_id must be strings')
+    attributes = user.get('attributes') or {}
+    if not isinstance(attributes, dict):
+        raise InvalidRow('attributes must be an object')
+    attribute_rows = []
+    for name, attribute in attributes.items():
+        if not isinstance(attribute, dict):
+            attribute = {'value': attribute}
+        value = attribute.get('value')
+        if value is None:
+            raise InvalidRow('attribute {} has no value'.format(name))
+        type_name = attribute.get('type') or 'STRING'
+        if type_name not in EndUserPropertyTypes.__members__:
+            raise InvalidRow('attribute {} has a bad type'.format(name))
+        try:
+            stored = EndUserPropertyTypes[type_name].encode(value)
+        except ValueError:
+            raise InvalidRow('attribute {} is not a valid {}'.format(name, type_name))
+        attribute_rows.append((line, name, stored, type_name))
+    return (line, email.lower() if email else None, phone_number, google_id), attribute_rows
+
+
+def import_end_users(org_id, stream, fmt, chunk_size, progress=None):
+    """Import users into an org from a text stream.
+
+    :param fmt: csv or ndjson
+    :param chunk_size int: the most rows to stage and merge per transaction
+    :param progress callable: called with the ImportStats after each chunk
+    :return: the ImportStats
+    """
+    stats = ImportStats()
+    rows = READERS[fmt](stream)
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            return stats
+        users, attributes = io.StringIO(), io.StringIO()
+        user_writer, attribute_writer = csv.writer(users), csv.writer(attributes)
+        staged = 0
+        for line, user in chunk:
+            try:
+                if isinstance(user, InvalidRow):
+                    raise user
+                user_row, attribute_rows = staged_rows(line, user)
+            except InvalidRow as exc:
+                stats.add_error(line, str(exc))
+                continue
+            user_writer.writerow(user_row)
+            attribute_writer.writerows(attribute_rows)
+            staged += 1
+        stats.rows += staged
+        if staged:
+            _merge_chunk(org_id, users, attributes, stats)
+        if progress is not None:
+            progress(stats)
+
+
+def _merge_chunk(org_id, users, attributes, stats):
+    """COPY one chunk into the staging tables and merge it, in one transaction."""
+    property_type = EndUserProperty.__table__.c.property_type.type.name
+    session = db.session
+    session.execute(
+        'CREATE TEMP TABLE import_users (line bigint, email text, phone_number text, google_id text, '
+        'end_user_id uuid, existed boolean NOT NULL DEFAULT false) ON COMMIT DROP'
+    )
+    session.execute(
+        'CREATE TEMP TABLE import_attributes (line bigint, name text, value text, type text) ON COMMIT DROP'
+    )
+    with session.connection().connection.cursor() as cursor:
+        users.seek(0)
+        cursor.copy_expert('COPY import_users (line, email, phone_number, google_id) FROM STDIN WITH (FORMAT csv)',
+                           users)
+        attributes.seek(0)
+        cursor.copy_expert('COPY import_attributes FROM STDIN WITH (FORMAT csv)', attributes)
+    session.execute('ANALYZE import_users')
+    params = {'org_id': org_id}
+
+    stats.updated += _resolve_end_users(params, existed=True)
+    created = session.execute(
+        'INSERT INTO end_users (id, org_id, email, phone_number, google_id, created_at, updated_at, version) '
+        'SELECT gen_random_uuid(), :org_id, email, phone_number, google_id, now(), now(), 1 FROM ('
+        '  SELECT DISTINCT ON (coalesce(email, phone_number)) email, phone_number, google_id FROM import_users '
+        '  WHERE end_user_id IS NULL ORDER BY coalesce(email, phone_number), line DESC'
+        ') new_users '
+        'ON CONFLICT DO NOTHING',
+        params,
+    ).rowcount
+    stats.created += created
+    resolved = _resolve_end_users(params, existed=False)
+    stats.skipped += session.execute('SELECT count(*) FROM import_users WHERE end_user_id IS NULL').scalar()
+    # rows repeating a user the chunk creates count as updates
+    stats.updated += resolved - created
+
+    stats.attributes += session.execute(
+        'INSERT INTO end_user_properties (end_user_id, property_name, property_value, property_type, trusted) '
+        'SELECT DISTINCT ON (u.end_user_id, a.name) u.end_user_id, a.name, a.value, a.type::{}, true '
+        'FROM import_attributes a JOIN import_users u ON u.line = a.line '
+        'WHERE u.end_user_id IS NOT NULL '
+        'ORDER BY u.end_user_id, a.name, a.line DESC '
+        'ON CONFLICT (end_user_id, property_name) DO UPDATE SET property_value = EXCLUDED.property_value, '
+        'property_type = EXCLUDED.property_type, trusted = EXCLUDED.trusted'.format(property_type)
+    ).rowcount
+    session.execute(
+        'UPDATE end_users SET version = version + 1, updated_at = now() '
+        'WHERE id IN (SELECT u.end_user_id FROM import_users u WHERE u.existed '
+        '             AND EXISTS (SELECT 1 FROM import_attributes a WHERE a.line = u.line))'
+    )
+    session.commit()
+
+
+def _resolve_end_users(params, existed):
+    """Point staged rows at the org's users with their email, or phone number if they have no email.
+
+    :return: the number of rows resolved
+    """
+    resolved = 0
+    for column, only_without_email in (('email', False), ('phone_number', True)):
+        resolved += db.session.execute(
+            'UPDATE import_users u SET end_user_id = eu.id, existed = :existed FROM end_users eu '
+            'WHERE u.end_user_id IS NULL AND eu.org_id = :org_id AND eu.{column} = u.{column}{extra}'.format(
+                column=column, extra=' AND u.email IS NULL' if only_without_email else ''),
+            dict(params, existed=existed),
+        ).rowcount
+    return resolved
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""Streaming exports of an org's end users and login history.
+
+Rows come off a server-side cursor a batch at a time and are encoded,
+optionally gzipped, as they go, so an export holds one batch in memory
+however big the org is. Every row carries the cursor of its key; passing the
+last one received as ``since`` resumes the export after that row.
+"""
+import csv
+import datetime as dt
+import io
+import json
+import zlib
+
+from sqlalchemy import and_, func, or_, select, tuple_
+
+from weasl.database import db
+from weasl.end_user.models import EndUser, EndUserProperty, EndUserPropertyTypes
+from weasl.pagination import decode_cursor, encode_cursor
+
+CONTENT_TYPES = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+END_USER_FIELDS = ['id', 'email', 'phone_number', 'google_id', 'created_at', 'updated_at', 'last_login_at',
+                   'attributes']
+LOGIN_FIELDS = ['end_user_id', 'email', 'phone_number', 'created_at', 'expired_at', 'sent', 'active']
+# gzip rather than raw deflate framing
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+class Export(object):
+    """An export's rows, open on a server-side cursor."""
+
+    def __init__(self, result, fields, key_columns, to_record):
+        self.result = result
+        self.fields = fields
+        self.key_columns = key_columns
+        self.to_record = to_record
+
+    def stream(self, fmt, batch_size, compress=False):
+        """Encode the rows as they're fetched.
+
+        :param fmt: ndjson or csv
+        :param compress bool: gzip the output
+        :return: an iterator of bytes
+        """
+        compressor = zlib.compressobj(wbits=GZIP_WBITS) if compress else None
+        buffer = io.StringIO()
+        writer = csv.writer(buffer) if fmt == 'csv' else None
+        if writer is not None:
+            writer.writerow(self.fields + ['cursor'])
+
+        def drain():
+            data = buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+            return compressor.compress(data) if compressor is not None else data
+
+        try:
+            while True:
+                rows = self.result.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    record = self.to_record(row)
+                    cursor = encode_cursor([row[column] for column in self.key_columns])
+                    if writer is not None:
+                        writer.writerow([_csv_value(record[field]) for field in self.fields] + [cursor])
+                    else:
+                        record['cursor'] = cursor
+                        buffer.write(json.dumps(record, default=_json_default) + '\n')
+                chunk = drain()
+                if chunk:
+                    yield chunk
+            chunk = drain()
+            if compressor is not None:
+                chunk += compressor.flush()
+            if chunk:
+                yield chunk
+        finally:
+            self.result.close()
+
+
+def export_end_users(org_id, since=None):
+    """Open an export of the org's end users with their attributes, in created_at order."""
+    end_users = EndUser.__table__
+    properties = EndUserProperty.__table__
+    attributes = select([func.json_agg(func.json_build_array(
+        properties.c.property_name, properties.c.property_value, properties.c.property_type, properties.c.trusted,
+    ))]).where(properties.c.end_user_id == end_users.c.id).as_scalar().label('attributes')
+    columns = [end_users.c[field] for field in END_USER_FIELDS[:-1]] + [attributes]
+    key_columns = [end_users.c.created_at, end_users.c.id]
+    return _open(select(columns).where(end_users.c.org_id == org_id), key_columns, since,
+                 END_USER_FIELDS, _end_user_record)
+
+
+def export_logins(token_cls, org_id, since=None):
+    """Open an export of the org's SMS or email logins, in created_at order."""
+    tokens = token_cls.__table__
+    end_users = EndUser.__table__
+    columns = [tokens.c.token, tokens.c.end_user_id, end_users.c.email, end_users.c.phone_number,
+               tokens.c.created_at, tokens.c.expired_at, tokens.c.sent, tokens.c.active]
+    key_columns = [tokens.c.created_at, tokens.c.token, tokens.c.end_user_id]
+    query = select(columns)\
+        .select_from(tokens.join(end_users, end_users.c.id == tokens.c.end_user_id))\
+        .where(tokens.c.org_id == org_id)
+    return _open(query, key_columns, since, LOGIN_FIELDS, lambda row: {field: row[field] for field in LOGIN_FIELDS})
+
+
+def _open(query, key_columns, since, fields, to_record):
+    """Run the export's query on a server-side cursor, starting after the since cursor.
+
+    Rows with a null timestamp come last, ordered by the remaining key columns.
+    """
+    timestamp, tiebreakers = key_columns[0], key_columns[1:]
+    if since is not None:
+        after = decode_cursor(since, key_columns)
+        if after[0] is None:
+            query = query.where(and_(timestamp.is_(None), tuple_(*tiebreakers) > tuple(after[1:])))
+        else:
+            query = query.where(or_(timestamp.is_(None), tuple_(*key_columns) > tuple(after)))
+    query = query.order_by(timestamp.asc().nullslast(), *tiebreakers)
+    result = db.session.execute(query.execution_options(stream_results=True))
+    return Export(result, fields, key_columns, to_record)
+
+
+def _end_user_record(row):
+    record = {field: row[field] for field in END_USER_FIELDS[:-1]}
+    record['attributes'] = {
+        name: {'value': _attribute_value(value, type_name), 'trusted': trusted}
+        for name, value, type_name, trusted in row['attributes'] or ()
+    }
+    return record
+
+
+def _attribute_value(value, type_name):
+    """Decode a stored attribute value, or give it as stored if it doesn't decode as its type.
+
+    The response has already started by the time a row is encoded, so raising
+    here would cut the export off.
+    """
+    try:
+        return EndUserPropertyTypes[type_name].converter(value)
+    except (ValueError, TypeError):
+        return value
+
+
+def _json_default(value):
+    if isinstance(value, dt.datetime):
+        return value.isoformat()
+    return str(value)
+
+
+def _csv_value(value):
+    if isinstance(value, dict):
+        return json.dumps(value, default=_json_default)
+    if isinstance(value, dt.datetime):
+        return value.isoformat()
+    return value
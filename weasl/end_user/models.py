@@ -1,34 +1,214 @@
 import datetime as dt
 import enum
-import random
+import json
+import secrets
 import uuid
 import urllib.parse as urlparse
 from urllib.parse import urlencode
 
-import requests as req
-import boto3
 import jwt
 import pytz
 from flask import current_app, render_template
-from sqlalchemy.dialects.postgresql import UUID, JSONB
+from sqlalchemy.dialects.postgresql import UUID, JSONB, insert
 from sqlalchemy.ext.mutable import Mutable
+from sqlalchemy.orm import joinedload, lazyload, make_transient_to_detached, selectinload, subqueryload
+from sqlalchemy.orm.util import identity_key
 from sqlalchemy.schema import UniqueConstraint
 
 from weasl.org.models import OrgProperty, Org
 from weasl.org.constants import OrgPropertyConstants
 from weasl.constants import Errors
-from weasl.database import (Column, Model, UUIDModel, db, reference_col,
-                             relationship)
+from weasl.database import (Column, Model, UUIDModel, bump_version, db, insert_unique,
+                             reference_col, relationship, upsert, version_col)
 from weasl.errors import Unauthorized, ProxyAuthenticationRequired, InternalServerError
+from weasl.instrumentation import provider_timer
+from weasl.metrics import LOGIN_SEND_REUSES, LOGIN_SENDS, LOGIN_VERIFIES, PROVIDER_ERRORS
 
 
 GOOGLE_USER_URL = 'https://content.googleapis.com/oauth2/v2/userinfo'
+PROPERTY_LOADERS = {
+    'select': lazyload,
+    'selectin': selectinload,
+    'joined': joinedload,
+    'subquery': subqueryload,
+}
+
+
+class LoginDailyCount(Model):
+    """Per-org daily counts of the logins started and verified over SMS and email.
+
+    Kept up to date in the same transaction as the token writes, so the aggregate
+    endpoint never has to scan the token tables.
+    """
+
+    __tablename__ = 'login_daily_counts'
+
+    COUNTERS = ('sms_created', 'sms_used', 'email_created', 'email_used')
+    GRANULARITIES = ('day', 'week', 'month')
+
+    org_id = reference_col('orgs', primary_key=True)
+    day = Column(db.Date, primary_key=True)
+    sms_created = Column(db.Integer, nullable=False, default=0, server_default='0')
+    sms_used = Column(db.Integer, nullable=False, default=0, server_default='0')
+    email_created = Column(db.Integer, nullable=False, default=0, server_default='0')
+    email_used = Column(db.Integer, nullable=False, default=0, server_default='0')
+
+    @classmethod
+    def increment(cls, org_id, counter):
+        """Add one to a counter for the org's current UTC day, without committing."""
+        if org_id is None:
+            return
+        table = cls.__table__
+        stmt = insert(table).values(org_id=org_id, day=dt.datetime.utcnow().date(), **{counter: 1})
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[table.c.org_id, table.c.day],
+            set_={counter: table.c[counter] + 1},
+        )
+        db.session.execute(stmt)
+
+    @classmethod
+    def backfill(cls, token_cls, prefix):
+        """Recompute the counters for one token table from its rows.
+
+        The token tables don't record when, or whether, a token was redeemed,
+        so tokens that were sent and are no longer active count as used, on the
+        day they were created. Tokens deactivated without being sent, after a
+        failed or abandoned delivery, aren't counted as used. The result still
+        differs from the counts kept as tokens are created and used:
+        redemptions count on the token's creation day rather than the day they
+        happened, and tokens the reaper already deleted aren't counted at all.
+        """
+        table = cls.__table__
+        day = db.func.date(db.func.timezone('UTC', token_cls.created_at))
+        counts = db.session.query(
+            token_cls.org_id,
+            day,
+            db.func.count(),
+            db.func.count().filter(db.and_(token_cls.active == False, token_cls.sent == True)),
+        ).filter(token_cls.org_id.isnot(None)).group_by(token_cls.org_id, day)
+        created, used = '{}_created'.format(prefix), '{}_used'.format(prefix)
+        stmt = insert(table).from_select(['org_id', 'day', created, used], counts.statement)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[table.c.org_id, table.c.day],
+            set_={created: stmt.excluded[created], used: stmt.excluded[used]},
+        )
+        db.session.execute(stmt)
+        db.session.commit()
+
+    @classmethod
+    def aggregate(cls, org_id, start=None, end=None, granularity='day'):
+        """Sum the counters for an org by day, week or month between two dates (inclusive)."""
+        period = db.cast(db.func.date_trunc(granularity, cls.day), db.Date).label('period')
+        query = db.session.query(
+            period,
+            *[db.func.sum(getattr(cls, counter)).label(counter) for counter in cls.COUNTERS]
+        ).filter(cls.org_id == org_id)
+        if start is not None:
+            query = query.filter(cls.day >= start)
+        if end is not None:
+            query = query.filter(cls.day <= end)
+        return query.group_by(period).order_by(period).all()
+
+
+def redeem_token(token_cls, token, org_id, counter):
+    """Deactivate a live token, record the end user's login and count it, in one statement.
+
+    Concurrent redemptions of the same token can't both succeed: the second
+    waits on the first's row lock and then no longer matches `active`. The
+    count is taken from the end user update's output, so the end user's row
+    is locked before the org's daily count row, in the same order as a send
+    for them (see reusable_token), and a verify racing a resend can't deadlock.
+
+    :return: the used token, or None if no live token matched
+    """
+    tokens = token_cls.__table__
+    end_users = EndUser.__table__
+    counts = LoginDailyCount.__table__
+
+    used = tokens.update()\
+        .where(db.and_(
+            tokens.c.token == token,
+            tokens.c.org_id == org_id,
+            tokens.c.active == True,
+            tokens.c.expired_at > db.func.now(),
+        ))\
+        .values(active=False)\
+        .returning(*tokens.c)\
+        .cte('used')
+    logged_in = end_users.update()\
+        .where(end_users.c.id == used.c.end_user_id)\
+        .values(last_login_at=db.func.now())\
+        .returning(end_users.c.org_id)\
+        .cte('logged_in')
+    # every counter is given, since column defaults aren't applied to an INSERT under a SELECT
+    counted = insert(counts)\
+        .from_select(['org_id', 'day', *LoginDailyCount.COUNTERS], db.select([
+            logged_in.c.org_id,
+            db.literal(dt.datetime.utcnow().date()),
+            *[db.literal(1 if name == counter else 0) for name in LoginDailyCount.COUNTERS],
+        ]))
+    counted = counted.on_conflict_do_update(
+        index_elements=[counts.c.org_id, counts.c.day],
+        set_={counter: counts.c[counter] + 1},
+    ).returning(counts.c.org_id).cte('counted')
+    stmt = db.select(used.c).where(counted.c.org_id == used.c.org_id)
+
+    row = db.session.execute(stmt).first()
+    db.session.commit()
+    if row is None:
+        return None
+    used_token = token_cls(**dict(row))
+    make_transient_to_detached(used_token)
+    return db.session.merge(used_token, load=False)
+
+
+def reusable_token(token_cls, end_user, idempotency_key=None):
+    """Find the token a repeated send for the end user should answer with, instead of sending another.
+
+    That's a token created for the same Idempotency-Key within
+    IDEMPOTENCY_KEY_TTL_SECONDS, or else a live one created and sent within
+    SEND_COOLDOWN_SECONDS. The end user's row is locked first, so concurrent
+    sends for them take turns and a double-click can't mint two tokens.
+
+    :return: the token, or None if a new one should be sent
+    """
+    now = dt.datetime.utcnow()
+    reusable = []
+    if idempotency_key is not None:
+        reusable.append(db.and_(
+            token_cls.idempotency_key == idempotency_key,
+            # a token whose send failed was deactivated without being sent
+            db.or_(token_cls.active == True, token_cls.sent == True),
+            token_cls.created_at > now - dt.timedelta(seconds=current_app.config['IDEMPOTENCY_KEY_TTL_SECONDS']),
+        ))
+    cooldown = current_app.config['SEND_COOLDOWN_SECONDS']
+    if cooldown:
+        reusable.append(db.and_(
+            token_cls.active == True,
+            token_cls.sent == True,
+            token_cls.expired_at > now,
+            token_cls.created_at > now - dt.timedelta(seconds=cooldown),
+        ))
+    if not reusable:
+        return None
+
+    db.session.query(EndUser.id).filter(EndUser.id == end_user.id).with_for_update().first()
+    token = token_cls.query\
+        .filter(token_cls.end_user_id == end_user.id, db.or_(*reusable))\
+        .order_by(token_cls.created_at.desc())\
+        .first()
+    if token is not None:
+        reason = 'idempotency_key' if idempotency_key is not None and token.idempotency_key == idempotency_key \
+            else 'cooldown'
+        LOGIN_SEND_REUSES.labels(token_cls.CHANNEL, reason).inc()
+    return token
 
 
 class EmailToken(Model):
     """A class for an email token."""
 
     __tablename__ = 'end_users_email_auth_token'
+    CHANNEL = 'email'
 
     token = Column(UUID(as_uuid=True), nullable=False, primary_key=True)
     end_user_id = reference_col('end_users', primary_key=True)
@@ -37,46 +217,50 @@ class EmailToken(Model):
                         default=dt.datetime.utcnow)
     expired_at = Column(db.DateTime(timezone=True), nullable=False,
                         default=dt.datetime.utcnow)
-    active = Column(db.Boolean, default=False, index=True)
-    sent = Column(db.Boolean, default=False, index=True)
+    active = Column(db.Boolean, default=False)
+    sent = Column(db.Boolean, default=False)
     org_id = reference_col('orgs', index=True, nullable=True)
+    idempotency_key = Column(db.String(255))
+
+    __table_args__ = (
+        db.Index('ix_end_users_email_auth_token_org_id_created_at', 'org_id', 'created_at'),
+        db.Index('ix_end_users_email_auth_token_org_id_token_active', 'org_id', 'token', postgresql_where=db.text('active')),
+        db.Index('ix_end_users_email_auth_token_end_user_id_created_at', 'end_user_id', 'created_at'),
+    )
 
     @classmethod
-    def generate(cls, end_user):
+    def generate(cls, end_user, commit=True, idempotency_key=None):
         """Create a random email token."""
-        token = uuid.uuid4()
-        email_token = cls.query.filter(cls.token == token)
-        while email_token is not None:
-            token = uuid.uuid4()
-            email_token = cls.query.filter(cls.token == token).first()
-        return cls.create(
-            token=token,
+        email_token = insert_unique(cls, lambda: dict(
+            token=uuid.uuid4(),
             end_user_id=end_user.id,
             org_id=end_user.org_id,
             active=True,
             sent=False,
-            expired_at=dt.datetime.utcnow() + dt.timedelta(hours=12)
-        )
+            expired_at=dt.datetime.utcnow() + dt.timedelta(hours=12),
+            idempotency_key=idempotency_key,
+        ))
+        LoginDailyCount.increment(end_user.org_id, 'email_created')
+        LOGIN_SENDS.labels('email').inc()
+        return email_token.save(commit=commit)
 
     @classmethod
     def use(cls, token: str, org_id: int):
         """Use the token to authenticate the end_user."""
-        email_token = cls.query.filter(
-            cls.token == token,
-            cls.active == True,
-            cls.org_id == org_id,
-            cls.expired_at > dt.datetime.utcnow().replace(tzinfo=pytz.utc),
-        ).first()
-
-        if email_token:
-            email_token.update(active=False)
+        email_token = redeem_token(cls, token, org_id, 'email_used')
+        LOGIN_VERIFIES.labels('email', 'success' if email_token else 'failure').inc()
         return email_token
 
     def make_magiclink(self):
         """Make the magiclink for the token, preserving the query params in the org's email."""
         custom_url = OrgProperty.find_for_org(self.org_id, OrgPropertyConstants.EMAIL_MAGICLINK)
         url = (custom_url.property_value if custom_url else current_app.config.get('BASE_SITE_HOST'))
-        params = { 'w_token': self.token }
+        return self.build_magiclink(url, self.token)
+
+    @staticmethod
+    def build_magiclink(url, token):
+        """Add the token to a magiclink URL's query params."""
+        params = { 'w_token': token }
 
         url_parts = list(urlparse.urlparse(url))
         query = dict(urlparse.parse_qsl(url_parts[4]))
@@ -89,28 +273,31 @@ class EmailToken(Model):
         """Send the token to the end_user."""
         if current_app.config.get('SEND_EMAILS'):
             email = self.end_user.email
-            ses_client = boto3.client('ses', region_name='us-west-2')
             org_name = OrgProperty.find_for_org(self.org_id, OrgPropertyConstants.COMPANY_NAME)
-            ses_client.send_email(
-                Source=current_app.config['FROM_EMAIL'],
-                Destination={
-                    'ToAddresses': [email],
-                },
-                Message={
-                    'Subject': {
-                        'Data': 'Log in to your {} account'.format(org_name.property_value if org_name else '')
+            html = render_template(
+                'emails/magiclink.html',
+                org_name=org_name.property_value if org_name else '',
+                email_magiclink='{}'.format(self.make_magiclink())
+            )
+            # end the transaction so no pooled connection is held while SES is called
+            db.session.commit()
+            with provider_timer('ses'):
+                current_app.providers.ses.send_email(
+                    Source=current_app.config['FROM_EMAIL'],
+                    Destination={
+                        'ToAddresses': [email],
                     },
-                    'Body': {
-                        'Html': {
-                            'Data': render_template(
-                                'emails/magiclink.html',
-                                org_name=org_name.property_value if org_name else '',
-                                email_magiclink='{}'.format(self.make_magiclink())
-                            )
+                    Message={
+                        'Subject': {
+                            'Data': 'Log in to your {} account'.format(org_name.property_value if org_name else '')
+                        },
+                        'Body': {
+                            'Html': {
+                                'Data': html
+                            }
                         }
                     }
-                }
-            )
+                )
         self.update(sent=True)
 
 
@@ -120,6 +307,7 @@ class SMSToken(Model):
     """A class for SMS authentication tokens."""
 
     __tablename__ = 'end_users_sms_auth_token'
+    CHANNEL = 'sms'
 
     TOKEN_CHARACTERS = '0123456789abcdefghijklmonpqrstuvwxyz'
 
@@ -130,57 +318,71 @@ class SMSToken(Model):
                         default=dt.datetime.utcnow)
     expired_at = Column(db.DateTime(timezone=True), nullable=False,
                         default=dt.datetime.utcnow)
-    active = Column(db.Boolean, default=False, index=True)
-    sent = Column(db.Boolean, default=False, index=True)
+    active = Column(db.Boolean, default=False)
+    sent = Column(db.Boolean, default=False)
     org_id = reference_col('orgs', index=True, nullable=True)
+    idempotency_key = Column(db.String(255))
+
+    __table_args__ = (
+        db.Index('ix_end_users_sms_auth_token_org_id_created_at', 'org_id', 'created_at'),
+        db.Index('ix_end_users_sms_auth_token_org_id_token_active', 'org_id', 'token', unique=True,
+                 postgresql_where=db.text('active')),
+        db.Index('ix_end_users_sms_auth_token_end_user_id_created_at', 'end_user_id', 'created_at'),
+    )
 
     @staticmethod
     def create_random_token():
-        """Create a random 6-digit token."""
-        return ''.join([random.choice(SMSToken.TOKEN_CHARACTERS) for _ in range(6)])
+        """Create a random 6-character token."""
+        return ''.join(secrets.choice(SMSToken.TOKEN_CHARACTERS) for _ in range(6))
 
     @classmethod
-    def generate(cls, end_user):
-        """Create a new SMS Token for a given end_user."""
-        text_token = cls.create_random_token()
-        sms_token = cls.query.filter(cls.token == text_token).first()
-        while sms_token is not None:
-            text_token = cls.create_random_token()
-            sms_token = cls.query.filter(cls.token == text_token).first()
-        return cls.create(
-            token=text_token,
+    def generate(cls, end_user, commit=True, idempotency_key=None):
+        """Create a new SMS Token for a given end_user.
+
+        Tokens only need to be unique among the org's active tokens. The unique
+        index on (org_id, token) where active enforces that, except across the
+        months of a partitioned table, which the NOT EXISTS guard covers.
+        """
+        sms_token = insert_unique(cls, lambda: dict(
+            token=cls.create_random_token(),
             end_user_id=end_user.id,
             org_id=end_user.org_id,
             active=True,
             sent=False,
             expired_at=dt.datetime.utcnow() + dt.timedelta(hours=1),
-        )
+            idempotency_key=idempotency_key,
+        ), unless=lambda values: db.and_(
+            cls.org_id == values['org_id'],
+            cls.token == values['token'],
+            cls.active == True,
+        ))
+        LoginDailyCount.increment(end_user.org_id, 'sms_created')
+        LOGIN_SENDS.labels('sms').inc()
+        return sms_token.save(commit=commit)
 
     @classmethod
     def use(cls, token_string: str, org_id: int):
         """Use the token to authenticate the end_user."""
-        sms_token = cls.query.filter(
-            cls.token == token_string.lower(),
-            cls.active == True,
-            cls.org_id == org_id,
-            cls.expired_at > dt.datetime.utcnow().replace(tzinfo=pytz.utc),
-        ).first()
-        if sms_token:
-            sms_token.update(active=False)
+        sms_token = redeem_token(cls, token_string.lower(), org_id, 'sms_used')
+        LOGIN_VERIFIES.labels('sms', 'success' if sms_token else 'failure').inc()
         return sms_token
 
     def send(self):
         """Send the token to the end_user."""
         if current_app.config.get('SEND_SMS'):
             phone_number = self.end_user.phone_number
-            current_app.twilio_client.messages.create(
-                to=phone_number,
-                from_=current_app.config['TWILIO_FROM_NUMBER'],
-                body='{}: {}'.format(
-                    OrgProperty.get_for_org_with_default(self.end_user.org_id, OrgPropertyConstants.TEXT_LOGIN_MESSAGE),
-                    self.token.upper(),
-                )
+            body = '{}: {}'.format(
+                OrgProperty.get_for_org_with_default(self.end_user.org_id, OrgPropertyConstants.TEXT_LOGIN_MESSAGE),
+                self.token.upper(),
             )
+            # end the transaction so no pooled connection is held while Twilio is called
+            db.session.commit()
+            with provider_timer('twilio'):
+                current_app.providers.twilio.messages.create(
+                    to=phone_number,
+                    from_=current_app.config['TWILIO_FROM_NUMBER'],
+                    body=body,
+                )
         self.update(sent=True)
 
 
@@ -219,25 +421,44 @@ class EndUser(UUIDModel):
     last_login_at = Column(db.DateTime(timezone=True), nullable=True)
     updated_at = Column(db.DateTime(timezone=True), nullable=True,
                         default=dt.datetime.utcnow)
+    version = version_col()
 
     __table_args__ = (
         UniqueConstraint('org_id', 'email', name='_email_org_uc'),
         UniqueConstraint('org_id', 'phone_number', name='_phone_org_uc'),
+        db.Index('ix_end_users_org_id_created_at', 'org_id', 'created_at'),
     )
 
-    @property
-    def properties(self):
-        """Get all the properties for the end user."""
-        return EndUserProperty.get_by_end_user(self.id)
+    properties = relationship('EndUserProperty', back_populates='end_user')
+
+    @classmethod
+    def with_properties(cls):
+        """Query end users, loading their properties with the configured strategy."""
+        loader = PROPERTY_LOADERS[current_app.config.get('END_USER_PROPERTIES_LOADER', 'select')]
+        return cls.query.options(loader(cls.properties))
+
+    @classmethod
+    def find_with_properties(cls, record_id):
+        """Get an end user by id along with their properties."""
+        if not isinstance(record_id, uuid.UUID):
+            record_id = uuid.UUID(record_id)
+        return cls.with_properties().get(record_id)
 
     @classmethod
     def from_google_token(cls, token: str, org_id: int):
         """Get the user from the google email via an OAuth2 token."""
-        res = req.get(GOOGLE_USER_URL, headers={'Authorization': 'Bearer {}'.format(token)})
+        with provider_timer('google'):
+            res = current_app.providers.http.get(
+                GOOGLE_USER_URL,
+                headers={'Authorization': 'Bearer {}'.format(token)},
+                timeout=current_app.config['PROVIDER_TIMEOUT_SECONDS'],
+            )
         if res.status_code != 200:
+            PROVIDER_ERRORS.labels('google').inc()
             raise InternalServerError(Errors.AUTH_PROVIDER_FAILED)
         userinfo = res.json()
         verified_email = userinfo.get('verified_email')
+        LOGIN_VERIFIES.labels('google', 'success' if verified_email else 'failure').inc()
         if not verified_email:
             raise ProxyAuthenticationRequired(Errors.GOOGLE_NOT_VERIFIED)
         google_id = userinfo.get('id')
@@ -261,10 +482,16 @@ class EndUser(UUIDModel):
 
     @classmethod
     def from_token(cls, token: str):
-        """Get the end_user from an auth token."""
-        end_user_id = EndUser.decode_auth_token(token)
-        if end_user_id:
-            return EndUser.find(end_user_id)
+        """Get the end_user from an auth token.
+
+        With STATELESS_AUTH on, tokens carrying claims give a lazy EndUserClaims
+        that only loads the row when a view needs a column the claims don't cover.
+        """
+        claims = EndUser.decode_auth_claims(token)
+        if current_app.config.get('STATELESS_AUTH') and 'org' in claims:
+            return EndUserClaims(claims)
+        if claims['sub']:
+            return EndUser.find_with_properties(claims['sub'])
 
     @staticmethod
     def decode_auth_token(auth_token: str) -> str:
@@ -273,9 +500,17 @@ class EndUser(UUIDModel):
         :param str auth_token:
         :return: string
         """
+        return EndUser.decode_auth_claims(auth_token)['sub']
+
+    @staticmethod
+    def decode_auth_claims(auth_token: str) -> dict:
+        """
+        Decodes the auth token into its full payload
+        :param str auth_token:
+        :return: dict
+        """
         try:
-            payload = jwt.decode(auth_token, current_app.config.get('SECRET_KEY'), algorithms=['HS256'])
-            return payload['sub']
+            return jwt.decode(auth_token, current_app.config.get('SECRET_KEY'), algorithms=['HS256'])
         except (jwt.ExpiredSignatureError, jwt.InvalidTokenError):
             raise Unauthorized(Errors.BAD_TOKEN)
 
@@ -290,6 +525,8 @@ class EndUser(UUIDModel):
                 'iat': dt.datetime.utcnow(),
                 'sub': str(self.id),
             }
+            if current_app.config.get('STATELESS_AUTH'):
+                payload.update(self.auth_claims())
             return jwt.encode(
                 payload,
                 current_app.config.get('SECRET_KEY'),
@@ -298,24 +535,85 @@ class EndUser(UUIDModel):
         except Exception as e:
             return e
 
-    def org_for_admin(self) -> int:
-        """Gets the org_id for which this user is the admin, since Weasl now runs on Weasl."""
+    def auth_claims(self) -> dict:
+        """Gets the claims embedded in the auth token so requests can skip loading the end user."""
+        return {
+            'org': self.org_id,
+            'adm': self.admin_org_id(),
+            'mst': self.is_weasl_master_admin(),
+        }
+
+    def admin_org_id(self):
+        """Gets the id of the org for which this user is the admin."""
         try:
             prop = next(filter(lambda eu_prop: eu_prop.property_name == 'org_id_as_admin' and eu_prop.trusted, self.properties))
-            return Org.find(prop.property_value)
+            return int(prop.property_value)
         except StopIteration as exc:
             return None
 
+    def org_for_admin(self) -> int:
+        """Gets the org_id for which this user is the admin, since Weasl now runs on Weasl."""
+        org_id = self.admin_org_id()
+        if org_id is None:
+            return None
+        return Org.find(org_id)
+
     def is_weasl_master_admin(self) -> bool:
         """Checks to see if the user is an admin of weasl overall."""
         try:
             prop = next(filter(lambda eu_prop: eu_prop.property_name == 'is_weasl_admin' and eu_prop.trusted, self.properties))
-            converter = eval('{}'.format(prop.property_type.value))
-            return converter(prop.property_value)
+            return prop.property_type.converter(prop.property_value)
         except StopIteration as exc:
             return False
 
 
+class EndUserClaims(object):
+    """A lazy stand-in for an EndUser, built from the claims in its auth token.
+
+    A token without an admin org falls back to the database, so a user who
+    became an org admin after logging in isn't locked out. The master admin
+    flag is trusted as issued, so checking it never loads the user; granting or
+    revoking it, like revoking admin access, takes effect once the token expires.
+
+    Views that read any other column, like /widget/me's version for its ETag,
+    still load the end user.
+    """
+
+    def __init__(self, claims: dict):
+        self.id = uuid.UUID(claims['sub'])
+        self.org_id = claims['org']
+        self._admin_org_id = claims.get('adm')
+        self._is_weasl_master_admin = claims.get('mst', False)
+        self._end_user = None
+
+    def __getattr__(self, name):
+        return getattr(self.load(), name)
+
+    def load(self):
+        """Load the end user the claims were issued for."""
+        if self._end_user is None:
+            self._end_user = EndUser.find_with_properties(self.id)
+            if self._end_user is None:
+                raise Unauthorized(Errors.LOGIN_REQUIRED)
+        return self._end_user
+
+    def admin_org_id(self):
+        """Gets the id of the org for which this user is the admin."""
+        if self._admin_org_id is None:
+            return self.load().admin_org_id()
+        return self._admin_org_id
+
+    def org_for_admin(self):
+        """Gets the org for which this user is the admin."""
+        org_id = self.admin_org_id()
+        if org_id is None:
+            return None
+        return Org.find(org_id)
+
+    def is_weasl_master_admin(self) -> bool:
+        """Checks to see if the user is an admin of weasl overall."""
+        return self._is_weasl_master_admin
+
 
 class EndUserPropertyTypes(enum.Enum):
     STRING = 'str'
@@ -323,6 +621,31 @@ class EndUserPropertyTypes(enum.Enum):
     JSON = 'json.loads'
     BOOLEAN = 'bool'
 
+    @property
+    def converter(self):
+        """The callable that decodes a stored property value of this type."""
+        return _END_USER_PROPERTY_CONVERTERS[self]
+
+    def encode(self, value):
+        """The stored form of a property value: strings as they are, anything else as JSON.
+
+        :raises ValueError: if the stored form doesn't decode as this type
+        """
+        stored = value if isinstance(value, str) else json.dumps(value)
+        try:
+            self.converter(stored)
+        except (ValueError, TypeError):
+            raise ValueError('{!r} is not a valid {}'.format(value, self.name))
+        return stored
+
+
+_END_USER_PROPERTY_CONVERTERS = {
+    EndUserPropertyTypes.STRING: str,
+    EndUserPropertyTypes.NUMBER: int,
+    EndUserPropertyTypes.JSON: json.loads,
+    EndUserPropertyTypes.BOOLEAN: bool,
+}
+
 
 class EndUserProperty(Model):
     """A class for end user properties in the database."""
@@ -334,6 +657,7 @@ class EndUserProperty(Model):
     property_value = Column(db.Text())
     property_type = Column(db.Enum(EndUserPropertyTypes), nullable=False)
     trusted = Column(db.Boolean, default=False)
+    end_user = relationship('EndUser', back_populates='properties')
 
     @classmethod
     def get_by_end_user(cls, end_user_id):
@@ -348,14 +672,31 @@ class EndUserProperty(Model):
     @classmethod
     def save_prop_for_end_user(cls, end_user_id, prop, value, prop_type=EndUserPropertyTypes.STRING, trusted=False):
         """Save a property for an end user."""
-        inst = cls.find_for_end_user(end_user_id, prop)
-        if inst is None:
-            return cls.create(
-                end_user_id=end_user_id,
-                property_name=prop,
-                property_value=value,
-                property_type=prop_type,
-                trusted=trusted,
-            )
-        else:
-            return inst.update(property_value=value)
+        return cls.save_props_for_end_user(end_user_id, [(prop, value, prop_type, trusted)])[0]
+
+    @classmethod
+    def save_props_for_end_user(cls, end_user_id, props):
+        """Save many properties for an end user in one statement, and bump the end user's version.
+
+        An end user already loaded in the session has its properties expired so
+        the next read sees the write.
+
+        :param props list: tuples of (prop, value, prop_type, trusted)
+        """
+        rows = {
+            prop: {
+                'end_user_id': end_user_id,
+                'property_name': prop,
+                'property_value': value,
+                'property_type': prop_type,
+                'trusted': trusted,
+            } for prop, value, prop_type, trusted in props
+        }
+        insts = upsert(cls, list(rows.values()), ['end_user_id', 'property_name'],
+                       ['property_value', 'property_type', 'trusted'], commit=False)
+        bump_version(EndUser, end_user_id)
+        db.session.commit()
+        end_user = db.session.identity_map.get(identity_key(EndUser, end_user_id))
+        if end_user is not None:
+            db.session.expire(end_user, ['properties'])
+        return insts
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""Retention for the SMS and email token tables.
+
+Tokens are only useful for the few hours before they expire; the login counts
+the admin dashboard shows live in the daily rollup. So anything older than the
+retention window can go, either in bounded batches of deletes or, once a table
+is partitioned by month, by dropping whole partitions.
+"""
+import datetime as dt
+import json
+import re
+
+from sqlalchemy.schema import AddConstraint, CreateIndex
+
+from weasl.database import db
+
+PARTITION_SUFFIX = re.compile(r'_p(\d{4})(\d{2})$')
+
+
+def reap_tokens(token_cls, before, batch_size, archive=None):
+    """Delete the tokens created before a cutoff.
+
+    Whole monthly partitions that end by the cutoff are dropped; the rest are
+    deleted in batches, each in its own short transaction so the reaper never
+    holds many row locks or bloats a single transaction.
+
+    :param token_cls: EmailToken or SMSToken
+    :param before datetime: delete tokens created before this time
+    :param batch_size int: the most rows to delete per transaction
+    :param archive: a text file to append the deleted tokens to, as JSON lines
+    :return: the number of tokens deleted
+    """
+    table = token_cls.__table__
+    reaped = 0
+    for partition, _, end in list_partitions(table.name):
+        if end <= before:
+            reaped += _drop_partition(partition, archive)
+
+    pk = db.tuple_(*table.primary_key.columns)
+    while True:
+        batch = db.select(list(table.primary_key.columns))\
+            .where(table.c.created_at < before)\
+            .limit(batch_size)\
+            .with_for_update(skip_locked=True)
+        rows = db.session.execute(
+            table.delete().where(pk.in_(batch)).returning(*table.c)
+        ).fetchall()
+        db.session.commit()
+        _archive_rows(rows, archive)
+        reaped += len(rows)
+        if len(rows) < batch_size:
+            return reaped
+
+
+def is_partitioned(table_name):
+    """Check whether a table is partitioned."""
+    return db.session.execute(
+        'SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(:name))',
+        {'name': table_name},
+    ).scalar()
+
+
+def list_partitions(table_name):
+    """Get the monthly partitions of a table, oldest first.
+
+    :return: a list of (partition name, start, end) tuples
+    """
+    rows = db.session.execute(
+        'SELECT child.relname FROM pg_inherits '
+        'JOIN pg_class child ON child.oid = pg_inherits.inhrelid '
+        'WHERE pg_inherits.inhparent = to_regclass(:name)',
+        {'name': table_name},
+    )
+    partitions = []
+    for name, in rows:
+        match = PARTITION_SUFFIX.search(name)
+        if match:
+            start = dt.datetime(int(match.group(1)), int(match.group(2)), 1, tzinfo=dt.timezone.utc)
+            partitions.append((name, start, _next_month(start)))
+    return sorted(partitions, key=lambda partition: partition[1])
+
+
+def partition_by_month(token_cls, months_ahead):
+    """Make sure a token table is range partitioned by month on created_at.
+
+    An unpartitioned table is rebuilt as a partitioned one in a single
+    transaction, which locks it while the rows are copied, so run it while
+    traffic is low. On a partitioned table this only adds the partitions for
+    the coming months.
+
+    :return: the names of the partitions created
+    """
+    table = token_cls.__table__
+    legacy = None if is_partitioned(table.name) else _swap_for_partitioned(table)
+
+    existing = {name for name, _, _ in list_partitions(table.name)}
+    this_month = _month_start(dt.datetime.now(dt.timezone.utc))
+    start, end = this_month, this_month
+    for _ in range(months_ahead + 1):
+        end = _next_month(end)
+    if legacy is not None:
+        oldest = db.session.execute('SELECT min(created_at) FROM {}'.format(legacy)).scalar()
+        if oldest is not None:
+            start = min(start, _month_start(oldest))
+
+    created = []
+    while start < end:
+        name = _partition_name(table.name, start)
+        if name not in existing:
+            _create_partition(table, name, 'FOR VALUES FROM (:start) TO (:end)',
+                              {'start': start, 'end': _next_month(start)})
+            created.append(name)
+        start = _next_month(start)
+
+    if legacy is not None:
+        _move_rows(table, legacy)
+    db.session.commit()
+    return created
+
+
+def _swap_for_partitioned(table):
+    """Rename a token table out of the way and create an empty partitioned copy in its place.
+
+    Rows outside every monthly partition land in a default partition rather
+    than failing the insert.
+
+    :return: the name the old table was renamed to
+    """
+    legacy = '{}_unpartitioned'.format(table.name)
+    db.session.execute('LOCK TABLE {} IN ACCESS EXCLUSIVE MODE'.format(table.name))
+    db.session.execute('ALTER TABLE {} RENAME TO {}'.format(table.name, legacy))
+    db.session.execute(
+        'CREATE TABLE {name} (LIKE {legacy} INCLUDING DEFAULTS) PARTITION BY RANGE (created_at)'
+        .format(name=table.name, legacy=legacy)
+    )
+    _create_partition(table, '{}_default'.format(table.name), 'DEFAULT')
+    return legacy
+
+
+def _move_rows(table, legacy):
+    """Copy the old table's rows into the partitioned one, then drop it and recreate its constraints and indices.
+
+    Postgres wants the partition key in the primary key, so created_at joins it.
+    """
+    db.session.execute('INSERT INTO {} SELECT * FROM {}'.format(table.name, legacy))
+    db.session.execute('DROP TABLE {}'.format(legacy))
+
+    key = [column.name for column in table.primary_key.columns] + ['created_at']
+    db.session.execute('ALTER TABLE {0} ADD CONSTRAINT {0}_pkey PRIMARY KEY ({1})'.format(
+        table.name, ', '.join(key)))
+    for constraint in table.foreign_key_constraints:
+        db.session.execute(AddConstraint(constraint))
+    for index in table.indexes:
+        if not index.unique:
+            db.session.execute(CreateIndex(index))
+
+
+def _create_partition(table, partition, bounds, params=None):
+    """Create a partition of the table, with the table's unique indices.
+
+    Postgres only allows unique indices on a partitioned table when they
+    include the partition key, so the model's other unique indices are made on
+    each partition instead and only hold within it.
+    """
+    db.session.execute('CREATE TABLE {} PARTITION OF {} {}'.format(partition, table.name, bounds), params)
+    for index in table.indexes:
+        if index.unique:
+            columns = [column.name for column in index.columns]
+            where = index.dialect_options['postgresql']['where']
+            db.session.execute('CREATE UNIQUE INDEX {}_{}_key ON {} ({}){}'.format(
+                partition, '_'.join(columns), partition, ', '.join(columns),
+                '' if where is None else ' WHERE {}'.format(where.compile(dialect=db.engine.dialect)),
+            ))
+
+
+def _drop_partition(partition, archive):
+    """Drop a partition, archiving its rows first if asked to."""
+    if archive is not None:
+        _archive_rows(db.session.execute('SELECT * FROM {}'.format(partition)), archive)
+    count = db.session.execute('SELECT count(*) FROM {}'.format(partition)).scalar()
+    db.session.execute('DROP TABLE {}'.format(partition))
+    db.session.commit()
+    return count
+
+
+def _archive_rows(rows, archive):
+    """Append the rows to the archive as JSON lines."""
+    if archive is None:
+        return
+    for row in rows:
+        archive.write(json.dumps(dict(row), default=str) + '\n')
+    archive.flush()
+
+
+def _month_start(timestamp):
+    return timestamp.astimezone(dt.timezone.utc).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def _next_month(month_start):
+    return (month_start + dt.timedelta(days=32)).replace(day=1)
+
+
+def _partition_name(table_name, month_start):
+    return '{}_p{:%Y%m}'.format(table_name, month_start)
@@ -60,9 +60,8 @@ class EndUserSchema(Schema):
     def attributes_from_properties(self, end_user):
         attrs = {}
         for prop in end_user.properties:
-            converter = eval('{}'.format(prop.property_type.value))
             attrs[prop.property_name] = {
-                'value': converter(prop.property_value),
+                'value': prop.property_type.converter(prop.property_value),
                 'trusted': prop.trusted,
             }
         return attrs
@@ -1,11 +1,13 @@
 # -*- coding: utf-8 -*-
 """A file for all the error classes."""
+import math
 
 
 class APIException(Exception):
     """A class to be inherited from for other API exceptions."""
 
     status_code = 400
+    headers = None
 
     def __init__(self, error_locale, status_code=None):
         """Create a new error from a given error locale.
@@ -61,6 +63,12 @@ class Conflict(APIException):
     status_code = 409
 
 
+class PayloadTooLarge(APIException):
+    """A 413 code."""
+
+    status_code = 413
+
+
 class UnprocessableEntity(APIException):
     """A 422 code."""
 
@@ -73,6 +81,20 @@ class PreconditionRequired(APIException):
     status_code = 428
 
 
+class TooManyRequests(APIException):
+    """A 429 code, telling the client when to retry."""
+
+    status_code = 429
+
+    def __init__(self, error_locale, retry_after):
+        """Create a new error.
+
+        :param retry_after float: seconds until the request would be allowed
+        """
+        super().__init__(error_locale)
+        self.headers = {'Retry-After': str(math.ceil(retry_after))}
+
+
 class InternalServerError(APIException):
     """A 500 code."""
 
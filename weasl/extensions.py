@@ -2,6 +2,17 @@
 """Extensions module. Each extension is initialized in the app factory located in app.py."""
 from flask_migrate import Migrate
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import orm
 
-db = SQLAlchemy()
+from weasl.replica import RoutingSession
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """SQLAlchemy with sessions that can read from the read replica."""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+db = RoutingSQLAlchemy()
 migrate = Migrate()
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""Per-request timings for SQL, the outbound providers and the whole request.
+
+Each request gets a RequestStats on flask.g that the engine hooks, the DB pool
+and provider_timer add to. When the request finishes the stats go out as a
+structured log line, and as a Server-Timing header when SERVER_TIMING is on.
+Request and provider latencies also feed the Prometheus metrics.
+"""
+import json
+import logging
+import time
+from contextlib import contextmanager
+
+from flask import g, has_request_context, request
+from sqlalchemy import event, inspect
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import TimeoutError as PoolTimeout
+from sqlalchemy.pool import QueuePool
+
+from weasl import metrics
+
+logger = logging.getLogger('weasl.requests')
+
+
+class RequestStats(object):
+    """What one request spent its time on."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.statements = 0
+        self.db_seconds = 0.0
+        self.pool_wait_seconds = 0.0
+        self.provider_seconds = {}
+
+    def add_provider_time(self, provider, seconds):
+        """Add time spent waiting on an outbound provider."""
+        self.provider_seconds[provider] = self.provider_seconds.get(provider, 0.0) + seconds
+
+    def elapsed(self):
+        """Get the seconds since the request started."""
+        return time.perf_counter() - self.started
+
+    def server_timing(self, total_seconds):
+        """Format the stats as a Server-Timing header value."""
+        metrics = ['db;dur={:.2f};desc="{} statements"'.format(self.db_seconds * 1000, self.statements),
+                   'pool;dur={:.2f}'.format(self.pool_wait_seconds * 1000)]
+        metrics += ['{};dur={:.2f}'.format(provider, seconds * 1000)
+                    for provider, seconds in sorted(self.provider_seconds.items())]
+        metrics.append('total;dur={:.2f}'.format(total_seconds * 1000))
+        return ', '.join(metrics)
+
+
+def current_stats():
+    """Get the stats for the request being served, or None outside of a request."""
+    if not has_request_context():
+        return None
+    return g.get('request_stats')
+
+
+@contextmanager
+def provider_timer(provider):
+    """Time a call to an outbound provider, e.g. ``with provider_timer('twilio'):``."""
+    started = time.perf_counter()
+    failed = True
+    try:
+        yield
+        failed = False
+    finally:
+        seconds = time.perf_counter() - started
+        metrics.record_provider_call(provider, seconds, failed)
+        stats = current_stats()
+        if stats is not None:
+            stats.add_provider_time(provider, seconds)
+
+
+class TimedQueuePool(QueuePool):
+    """A QueuePool that reports how long checkouts wait and how many connections are out."""
+
+    def _do_get(self):
+        started = time.perf_counter()
+        timed_out = False
+        try:
+            return super()._do_get()
+        except PoolTimeout:
+            timed_out = True
+            raise
+        finally:
+            seconds = time.perf_counter() - started
+            metrics.record_pool_checkout(seconds, timed_out)
+            metrics.record_pool_usage(self.checkedout())
+            stats = current_stats()
+            if stats is not None:
+                stats.pool_wait_seconds += seconds
+
+    def _do_return_conn(self, conn):
+        super()._do_return_conn(conn)
+        metrics.record_pool_usage(self.checkedout())
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _start_statement_timer(conn, cursor, statement, parameters, context, executemany):
+    if current_stats() is not None:
+        conn.info['statement_started'] = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _stop_statement_timer(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.pop('statement_started', None)
+    stats = current_stats()
+    if stats is not None and started is not None:
+        stats.statements += 1
+        stats.db_seconds += time.perf_counter() - started
+
+
+def init_app(app):
+    """Collect the stats for every request the app serves."""
+    if app.config['LOG_REQUESTS'] and not logger.handlers:
+        logger.addHandler(logging.StreamHandler())
+        logger.setLevel(logging.INFO)
+
+    @app.before_request
+    def start_request_stats():
+        g.request_stats = RequestStats()
+
+    @app.after_request
+    def report_request_stats(response):
+        stats = current_stats()
+        if stats is None:
+            return response
+        total_seconds = stats.elapsed()
+        metrics.record_request(request.endpoint, request.method, response.status_code, total_seconds)
+        if app.config['SERVER_TIMING']:
+            response.headers['Server-Timing'] = stats.server_timing(total_seconds)
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(json.dumps({
+                'endpoint': request.endpoint,
+                'method': request.method,
+                'status': response.status_code,
+                'org_id': _request_org_id(),
+                'db_statements': stats.statements,
+                'db_ms': round(stats.db_seconds * 1000, 2),
+                'pool_wait_ms': round(stats.pool_wait_seconds * 1000, 2),
+                'provider_ms': {provider: round(seconds * 1000, 2)
+                                for provider, seconds in stats.provider_seconds.items()},
+                'total_ms': round(total_seconds * 1000, 2),
+            }, sort_keys=True))
+        return response
+
+
+def _request_org_id():
+    """Get the ID of the org the request was for, without loading anything from the database."""
+    from weasl.end_user.models import EndUserClaims
+    org = g.get('current_org')
+    if org is not None:
+        identity = inspect(org).identity
+        return identity[0] if identity else None
+    end_user = g.get('end_user')
+    if isinstance(end_user, EndUserClaims):
+        return end_user.org_id
+    if end_user is not None:
+        return inspect(end_user).dict.get('org_id')
+    return None
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""Prometheus metrics for requests, logins, providers and the DB pool.
+
+Under gunicorn each worker writes its samples to files in the directory named
+by the prometheus_multiproc_dir environment variable (see gunicorn.conf.py),
+and /internal/metrics adds up every worker's files. Without it, the metrics
+are kept in this process only.
+
+`flask deliver` serves no HTTP, and on Heroku its dyno can't be reached or
+share files with the web dynos, so it pushes its metrics (the delivery,
+provider and abandoned delivery ones) to a Prometheus Pushgateway instead.
+"""
+import os
+
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+from prometheus_client import REGISTRY, push_to_gateway
+from prometheus_client.multiprocess import MultiProcessCollector
+
+MULTIPROCESS_DIR_ENV = 'prometheus_multiproc_dir'
+PUSH_TIMEOUT_SECONDS = 5
+
+REQUEST_LATENCY = Histogram(
+    'weasl_request_duration_seconds',
+    'Time to serve a request, by Flask endpoint.',
+    ['endpoint', 'method', 'status'],
+)
+LOGIN_SENDS = Counter(
+    'weasl_login_sends_total',
+    'Login tokens created to be sent, by channel.',
+    ['channel'],
+)
+LOGIN_VERIFIES = Counter(
+    'weasl_login_verifies_total',
+    'Login verification attempts, by channel and whether they succeeded.',
+    ['channel', 'result'],
+)
+LOGIN_SEND_REUSES = Counter(
+    'weasl_login_send_reuses_total',
+    'Repeated login sends answered with an existing token, by channel and why it was reused.',
+    ['channel', 'reason'],
+)
+PROVIDER_LATENCY = Histogram(
+    'weasl_provider_duration_seconds',
+    'Time spent calling an outbound provider.',
+    ['provider'],
+)
+PROVIDER_ERRORS = Counter(
+    'weasl_provider_errors_total',
+    'Calls to an outbound provider that raised.',
+    ['provider'],
+)
+DELIVERIES_ABANDONED = Counter(
+    'weasl_deliveries_abandoned_total',
+    'Outbox messages given up on after DELIVERY_MAX_ATTEMPTS failed deliveries, by channel.',
+    ['channel'],
+)
+RATE_LIMITED = Counter(
+    'weasl_rate_limited_sends_total',
+    'Login sends rejected for going over a rate limit, by channel.',
+    ['channel'],
+)
+REPLICA_ROUTING = Counter(
+    'weasl_replica_routed_requests_total',
+    'Requests to read-replica routes, by whether they read from the replica or fell back to the primary.',
+    ['target'],
+)
+POOL_CHECKOUT_WAIT = Histogram(
+    'weasl_db_pool_checkout_wait_seconds',
+    'Time spent waiting for a connection from the DB pool.',
+    buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30),
+)
+POOL_CHECKOUT_TIMEOUTS = Counter(
+    'weasl_db_pool_checkout_timeouts_total',
+    'Checkouts that gave up waiting for a connection from the DB pool.',
+)
+POOL_CHECKED_OUT = Gauge(
+    'weasl_db_pool_checked_out_connections',
+    'Connections checked out of the DB pool.',
+    multiprocess_mode='livesum',
+)
+
+
+def record_request(endpoint, method, status, seconds):
+    """Record a served request."""
+    REQUEST_LATENCY.labels(endpoint or 'unknown', method, str(status)).observe(seconds)
+
+
+def record_provider_call(provider, seconds, failed):
+    """Record a call to an outbound provider."""
+    PROVIDER_LATENCY.labels(provider).observe(seconds)
+    if failed:
+        PROVIDER_ERRORS.labels(provider).inc()
+
+
+def record_pool_checkout(seconds, timed_out):
+    """Record a wait for a connection from the DB pool."""
+    POOL_CHECKOUT_WAIT.observe(seconds)
+    if timed_out:
+        POOL_CHECKOUT_TIMEOUTS.inc()
+
+
+def record_pool_usage(checked_out):
+    """Record how many connections are checked out of the DB pool."""
+    POOL_CHECKED_OUT.set(checked_out)
+
+
+def exposition():
+    """Get the metrics in the Prometheus text format, for every worker process.
+
+    :return: a tuple of (body, content type)
+    """
+    return generate_latest(_registry()), CONTENT_TYPE_LATEST
+
+
+def push(gateway, job, instance):
+    """Replace the metrics a Pushgateway holds for this job and instance with this process's."""
+    push_to_gateway(gateway, job=job, registry=_registry(), grouping_key={'instance': instance},
+                    timeout=PUSH_TIMEOUT_SECONDS)
+
+
+def _registry():
+    if os.environ.get(MULTIPROCESS_DIR_ENV):
+        registry = CollectorRegistry()
+        MultiProcessCollector(registry)
+        return registry
+    return REGISTRY
+
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""An in-process cache for resolving orgs from their client credentials."""
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import inspect
+from sqlalchemy.orm import make_transient_to_detached
+
+from weasl.extensions import db
+from weasl.org.models import Org
+
+_MISSING = object()
+
+
+class OrgCache(object):
+    """A TTL- and size-bounded LRU cache of orgs keyed by client ID and client secret.
+
+    Entries hold a snapshot of the org's columns rather than the instance
+    itself, so a cached org never outlives the session it was loaded in. On a
+    hit the snapshot is merged into the current session without a query.
+    Unknown credentials are cached too, so a widget with a bad client ID
+    doesn't hit the database on every request.
+
+    Each process has its own cache and invalidate() only clears this one, so
+    after an org changes other processes serve the old entry until its TTL
+    runs out: a rotated client secret keeps working, and changed settings
+    aren't seen, for up to ttl seconds.
+    """
+
+    def __init__(self, ttl=60, max_size=1024, clock=time.monotonic):
+        """Create a new cache.
+
+        :param ttl int: seconds an entry stays valid; 0 disables the cache.
+        :param max_size int: the most entries held before evicting the least
+            recently used.
+        :param clock callable: returns the current time in seconds.
+        """
+        self.ttl = ttl
+        self.max_size = max_size
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        """Whether the cache holds entries at all."""
+        return self.ttl > 0 and self.max_size > 0
+
+    def from_client_id(self, client_id):
+        """Get the org from the client ID."""
+        return self._get(('client_id', client_id), Org.from_client_id)
+
+    def from_client_secret(self, client_secret):
+        """Get the org from the client secret."""
+        return self._get(('client_secret', client_secret), Org.from_client_secret)
+
+    def invalidate(self, org_id=None, client_id=None, client_secret=None):
+        """Drop every entry for the given org ID or credentials."""
+        with self._lock:
+            for key, (_, values) in list(self._entries.items()):
+                if key in (('client_id', client_id), ('client_secret', client_secret)):
+                    del self._entries[key]
+                elif org_id is not None and values is not None and values['id'] == org_id:
+                    del self._entries[key]
+
+    def clear(self):
+        """Drop every entry."""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Get the hit/miss counters for the cache."""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._entries),
+            }
+
+    def _get(self, key, loader):
+        """Get the org for the key, calling the loader on a miss."""
+        if not self.enabled:
+            return loader(key[1])
+
+        values = self._lookup(key)
+        if values is not _MISSING:
+            return self._to_org(values)
+
+        org = loader(key[1])
+        self._store(key, self._to_values(org))
+        return org
+
+    def _lookup(self, key):
+        """Get the cached column values for the key, or _MISSING."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= self.clock():
+                self._entries.pop(key, None)
+                self.misses += 1
+                return _MISSING
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def _store(self, key, values):
+        """Cache the column values for the key, evicting the oldest entries."""
+        with self._lock:
+            self._entries[key] = (self.clock() + self.ttl, values)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    @staticmethod
+    def _to_values(org):
+        """Snapshot the column values for an org."""
+        if org is None:
+            return None
+        return {attr.key: getattr(org, attr.key) for attr in inspect(Org).column_attrs}
+
+    @staticmethod
+    def _to_org(values):
+        """Rebuild an org from its snapshot in the current session."""
+        if values is None:
+            return None
+        org = Org(**values)
+        make_transient_to_detached(org)
+        return db.session.merge(org, load=False)
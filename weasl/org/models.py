@@ -1,7 +1,8 @@
 import datetime as dt
 import random
 import enum
-import uuid
+import json
+import secrets
 
 import boto3
 import jwt
@@ -13,7 +14,8 @@ from sqlalchemy import and_
 
 from weasl.constants import Errors
 from weasl.database import (Column, Model, db, reference_col,
-                            IDModel, relationship)
+                            IDModel, bump_version, insert_unique, relationship, upsert,
+                            version_col)
 from weasl.errors import Unauthorized
 
 class OrgPropertyNamespaces(enum.Enum):
@@ -29,6 +31,19 @@ class OrgPropertyTypes(enum.Enum):
     JSON = 'json.loads'
     BOOLEAN = 'lambda s: s == "true"'
 
+    @property
+    def converter(self):
+        """The callable that decodes a stored property value of this type."""
+        return _ORG_PROPERTY_CONVERTERS[self]
+
+
+_ORG_PROPERTY_CONVERTERS = {
+    OrgPropertyTypes.STRING: str,
+    OrgPropertyTypes.NUMBER: int,
+    OrgPropertyTypes.JSON: json.loads,
+    OrgPropertyTypes.BOOLEAN: lambda s: s == 'true',
+}
+
 
 class OrgProperty(Model):
     """A class for org properties in the database."""
@@ -66,40 +81,60 @@ class OrgProperty(Model):
     @classmethod
     def save_prop_for_org(cls, org_id, prop, value, namespace=OrgPropertyNamespaces.NONE, prop_type=OrgPropertyTypes.STRING):
         """Save a property for an org."""
-        inst = cls.find_for_org(org_id, prop)
-        if inst is None:
-            return cls.create(
-                org_id=org_id,
-                property_name=prop.property_name,
-                property_namespace=namespace,
-                property_value=value,
-                property_type=prop_type,
-            )
-        else:
-            return inst.update(property_value=value, property_type=prop_type)
+        return cls.save_props_for_org(org_id, [(prop, value, namespace, prop_type)])[0]
+
+    @classmethod
+    def save_props_for_org(cls, org_id, props):
+        """Save many properties for an org in one statement, and bump the org's version.
+
+        An existing property keeps its namespace and takes the new value and type.
+
+        :param props list: tuples of (prop, value, namespace, prop_type)
+        """
+        rows = {
+            prop.property_name: {
+                'org_id': org_id,
+                'property_name': prop.property_name,
+                'property_value': value,
+                'property_namespace': namespace,
+                'property_type': prop_type,
+            } for prop, value, namespace, prop_type in props
+        }
+        insts = upsert(cls, list(rows.values()), ['org_id', 'property_name'], ['property_value', 'property_type'],
+                       commit=False)
+        bump_version(Org, org_id)
+        db.session.commit()
+        current_app.org_cache.invalidate(org_id=org_id)
+        return insts
+
+
+def new_client_id():
+    """Make a random 10 character client ID."""
+    return secrets.token_hex(5)
+
+
+def new_client_secret():
+    """Make a random 32 character client secret."""
+    return secrets.token_hex(16)
+
 
 class Org(IDModel):
     """A class for orgs in the database."""
 
     __tablename__ = 'orgs'
 
-    client_id = Column(db.String(255), default=lambda _: uuid.uuid4().hex[:10], index=True, unique=True, nullable=False)
-    client_secret = Column(db.String(255), default=lambda _: uuid.uuid4().hex, index=True, unique=True, nullable=False)
+    client_id = Column(db.String(255), default=lambda _: new_client_id(), index=True, unique=True, nullable=False)
+    client_secret = Column(db.String(255), default=lambda _: new_client_secret(), index=True, unique=True, nullable=False)
+    version = version_col()
 
     @classmethod
     def generate_new(cls):
         """Generate a new org."""
-        unused_id = uuid.uuid4().hex[:10]
-        maybe_org = cls.from_client_id(unused_id)
-        while maybe_org is not None:
-            unused_id = uuid.uuid4().hex[:10]
-            maybe_org = cls.from_client_id(unused_id)
-        unused_secret = uuid.uuid4().hex
-        maybe_org = cls.from_client_secret(unused_secret)
-        while maybe_org is not None:
-            unused_secret = uuid.uuid4().hex
-            maybe_org = cls.from_client_secret(unused_secret)
-        return Org.create(client_id=unused_id, client_secret=unused_secret)
+        org = insert_unique(cls, lambda: dict(client_id=new_client_id(), client_secret=new_client_secret()))
+        client_id, client_secret = org.client_id, org.client_secret
+        db.session.commit()
+        current_app.org_cache.invalidate(client_id=client_id, client_secret=client_secret)
+        return org
 
     @classmethod
     def from_client_id(cls, maybe_id):
@@ -1,6 +1,5 @@
 # -*- coding: utf-8 -*-
 """Org schema."""
-import json  # noqa - needed for the eval(...) call
 from marshmallow import Schema, fields, validate, EXCLUDE
 
 from weasl.org.models import OrgPropertyTypes
@@ -22,8 +21,7 @@ class OrgPropertySchema(Schema):
 
     def derive_value(self, prop):
         """derive the value for the property."""
-        converter = eval('{}'.format(prop.property_type.value))
-        return converter(prop.property_value)
+        return prop.property_type.converter(prop.property_value)
 
 
 class OrgSchema(Schema):
@@ -0,0 +1,124 @@
+import datetime as dt
+import enum
+
+import pytz
+from flask import current_app
+from sqlalchemy.dialects.postgresql import UUID
+
+from weasl.database import Column, IDModel, db, reference_col
+from weasl.end_user.models import EmailToken, SMSToken
+from weasl.metrics import DELIVERIES_ABANDONED
+
+
+def utcnow():
+    return dt.datetime.utcnow().replace(tzinfo=pytz.utc)
+
+
+class OutboxChannels(enum.Enum):
+    SMS = 'sms'
+    EMAIL = 'email'
+
+
+TOKEN_CLASSES = {
+    OutboxChannels.SMS: SMSToken,
+    OutboxChannels.EMAIL: EmailToken,
+}
+
+
+class OutboxMessage(IDModel):
+    """A token waiting to be sent by the delivery worker.
+
+    Rows are written in the same transaction as the token they deliver, so a
+    token is never committed without its delivery being queued.
+    """
+
+    __tablename__ = 'delivery_outbox'
+
+    channel = Column(db.Enum(OutboxChannels), nullable=False)
+    token = Column(db.String(36), nullable=False)
+    end_user_id = Column(UUID(as_uuid=True), db.ForeignKey('end_users.id'), nullable=False)
+    org_id = reference_col('orgs', nullable=True)
+    created_at = Column(db.DateTime(timezone=True), nullable=False, default=utcnow)
+    available_at = Column(db.DateTime(timezone=True), nullable=False, default=utcnow)
+    delivered_at = Column(db.DateTime(timezone=True), nullable=True)
+    attempts = Column(db.Integer, nullable=False, default=0)
+    last_error = Column(db.Text(), nullable=True)
+
+    __table_args__ = (
+        db.Index('ix_delivery_outbox_pending', 'available_at', postgresql_where=db.text('delivered_at IS NULL')),
+    )
+
+    @classmethod
+    def dispatch(cls, token):
+        """Send the token, or queue it for the delivery worker when ASYNC_DELIVERY is on.
+
+        Either way the token is committed along with its delivery. A token
+        sent inline is committed before the provider is called, so the send
+        holds no row locks, like the org's daily login count, while it waits;
+        if the send fails, the token is deactivated.
+        """
+        if current_app.config.get('ASYNC_DELIVERY'):
+            return cls.enqueue(token)
+        db.session.commit()
+        try:
+            return token.send()
+        except Exception:
+            db.session.rollback()
+            token.update(active=False)
+            raise
+
+    @classmethod
+    def enqueue(cls, token):
+        """Queue a token for delivery."""
+        channel = next(channel for channel, token_cls in TOKEN_CLASSES.items() if isinstance(token, token_cls))
+        return cls.create(
+            channel=channel,
+            token=str(token.token),
+            end_user_id=token.end_user_id,
+            org_id=token.org_id,
+        )
+
+    @classmethod
+    def claim(cls, limit, lease, max_attempts):
+        """Claim up to limit pending messages for this worker.
+
+        Claimed messages are hidden from other workers for the lease, so a
+        worker that dies mid-delivery has its messages picked up again.
+        """
+        now = utcnow()
+        messages = cls.query.filter(
+            cls.delivered_at.is_(None),
+            cls.available_at <= now,
+            cls.attempts < max_attempts,
+        ).order_by(cls.available_at).limit(limit).with_for_update(skip_locked=True).all()
+        for message in messages:
+            message.available_at = now + lease
+        db.session.commit()
+        return [message.id for message in messages]
+
+    def load_token(self):
+        """Get the token this message delivers."""
+        return TOKEN_CLASSES[self.channel].query.get((self.token, self.end_user_id))
+
+    def mark_delivered(self):
+        """Record a successful delivery."""
+        return self.update(delivered_at=utcnow(), attempts=self.attempts + 1, last_error=None)
+
+    def mark_failed(self, error, backoff, max_attempts):
+        """Record a failed delivery, retrying after the backoff.
+
+        The last of max_attempts gives up on the message and deactivates its
+        token, so it can't be reused for a repeated send or redeemed.
+        """
+        if self.attempts + 1 >= max_attempts:
+            token = self.load_token()
+            if token is not None and not token.sent:
+                token.update(commit=False, active=False)
+            current_app.logger.error('Giving up on outbox message %s after %d attempts: %s', self.id,
+                                     self.attempts + 1, error)
+            DELIVERIES_ABANDONED.labels(self.channel.value).inc()
+        return self.update(
+            available_at=utcnow() + backoff * 2 ** self.attempts,
+            attempts=self.attempts + 1,
+            last_error=error,
+        )
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""The delivery worker that drains the outbox."""
+import datetime as dt
+import logging
+import os
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from weasl import metrics
+from weasl.extensions import db
+from weasl.outbox.models import OutboxMessage
+
+logger = logging.getLogger(__name__)
+
+
+def deliver(app, message_id):
+    """Deliver a claimed message in its own app context, returning whether it was sent."""
+    with app.app_context():
+        message = OutboxMessage.query.get(message_id)
+        try:
+            token = message.load_token()
+            # a token already flagged as sent was delivered by a worker that died before marking the message
+            if token is not None and not token.sent:
+                token.send()
+            message.mark_delivered()
+            return True
+        except Exception as exc:
+            logger.exception('Delivery of outbox message %s failed', message_id)
+            db.session.rollback()
+            message.mark_failed(repr(exc), dt.timedelta(seconds=app.config['DELIVERY_BACKOFF_SECONDS']),
+                                app.config['DELIVERY_MAX_ATTEMPTS'])
+            return False
+
+
+def drain(app, executor, batch_size):
+    """Claim and deliver one batch of messages, returning how many were claimed."""
+    message_ids = OutboxMessage.claim(
+        batch_size,
+        dt.timedelta(seconds=app.config['DELIVERY_LEASE_SECONDS']),
+        app.config['DELIVERY_MAX_ATTEMPTS'],
+    )
+    results = list(executor.map(lambda message_id: deliver(app, message_id), message_ids))
+    if message_ids:
+        logger.info('Delivered %d of %d outbox messages', sum(results), len(message_ids))
+    return len(message_ids)
+
+
+def push_metrics(app):
+    """Push the worker's metrics to METRICS_PUSHGATEWAY, if it's set, logging rather than raising failures."""
+    gateway = app.config['METRICS_PUSHGATEWAY']
+    if not gateway:
+        return
+    try:
+        metrics.push(gateway, 'weasl-deliver', os.environ.get('DYNO') or socket.gethostname())
+    except OSError:
+        logger.exception('Pushing metrics to %s failed', gateway)
+
+
+def run(app, concurrency, batch_size, poll_interval, once=False):
+    """Drain the outbox until interrupted, or until it is empty if once is set.
+
+    Metrics are pushed every METRICS_PUSH_SECONDS, and once more on the way out.
+    """
+    next_push = 0
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            while True:
+                claimed = drain(app, executor, batch_size)
+                if time.monotonic() >= next_push:
+                    push_metrics(app)
+                    next_push = time.monotonic() + app.config['METRICS_PUSH_SECONDS']
+                if claimed == 0:
+                    if once:
+                        return
+                    time.sleep(poll_interval)
+    finally:
+        push_metrics(app)
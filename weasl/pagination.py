@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""Pagination for the list endpoints."""
+import base64
+import binascii
+import datetime as dt
+import json
+import uuid
+
+from flask import request
+from sqlalchemy import tuple_
+from sqlalchemy.dialects.postgresql import UUID
+
+from weasl.constants import Errors
+from weasl.errors import BadRequest
+from weasl.extensions import db
+from weasl.utils import friendly_arg_get
+
+
+def paginate(query, key_columns):
+    """Paginate the query for the current request.
+
+    Uses page/per_page offset pagination unless the request passes a cursor or
+    ?pagination=cursor, in which case it pages through the key columns instead.
+
+    :param query Query: the query to paginate
+    :param key_columns list: a timestamp column followed by columns that make it unique
+    :return: a tuple of (items, meta pagination dict)
+    """
+    per_page = max(friendly_arg_get('per_page', 10, int), 1)
+    cursor = request.args.get('cursor')
+    if cursor is None and request.args.get('pagination') != 'cursor':
+        return offset_paginate(query, friendly_arg_get('page', 1, int), per_page)
+    return keyset_paginate(query, key_columns, cursor, per_page, request.args.get('count'))
+
+
+def offset_paginate(query, page_num, per_page):
+    """Paginate the query with OFFSET, counting every matching row."""
+    page = query.paginate(page=page_num, per_page=per_page)
+
+    meta_pagination = {
+        'first': request.path + '?page={page}&per_page={per_page}'.format(
+            page=1, per_page=page.per_page),
+        'next': request.path + '?page={page}&per_page={per_page}'.format(
+            page=page.next_num, per_page=page.per_page),
+        'last': request.path + '?page={page}&per_page={per_page}'.format(
+            page=page.pages or 1, per_page=page.per_page),
+        'prev': request.path + '?page={page}&per_page={per_page}'.format(
+            page=page.prev_num, per_page=page.per_page),
+        'total': page.pages
+    }
+
+    if not page.has_next:
+        meta_pagination.pop('next')
+    if not page.has_prev:
+        meta_pagination.pop('prev')
+
+    return page.items, meta_pagination
+
+
+def keyset_paginate(query, key_columns, cursor, per_page, count=None):
+    """Paginate the query by seeking past the key of the last row on the previous page.
+
+    :param count str: 'exact' to count every matching row, 'estimate' to use
+        the planner's estimate, anything else to skip counting.
+    """
+    per_page = max(per_page, 1)
+    after = decode_cursor(cursor, key_columns) if cursor else None
+    items = _seek(query, key_columns, after, per_page + 1)
+
+    meta_pagination = {
+        'first': _cursor_url(None, per_page),
+    }
+    if len(items) > per_page:
+        items = items[:per_page]
+        next_cursor = encode_cursor([getattr(items[-1], column.key) for column in key_columns])
+        meta_pagination['next'] = _cursor_url(next_cursor, per_page)
+        meta_pagination['next_cursor'] = next_cursor
+
+    if count == 'exact':
+        meta_pagination['count'] = query.order_by(None).count()
+    elif count == 'estimate':
+        meta_pagination['count'] = estimate_count(query)
+
+    return items, meta_pagination
+
+
+def _seek(query, key_columns, after, limit):
+    """Get up to limit rows ordered by the key columns, starting after the given key.
+
+    Rows with a null timestamp sort last and are walked by the remaining columns.
+    """
+    timestamp, tiebreakers = key_columns[0], key_columns[1:]
+    if after is not None and after[0] is None:
+        return query.filter(
+            timestamp.is_(None),
+            tuple_(*tiebreakers) > tuple(after[1:]),
+        ).order_by(*tiebreakers).limit(limit).all()
+
+    seek = query.filter(timestamp.isnot(None))
+    if after is not None:
+        seek = seek.filter(tuple_(*key_columns) > tuple(after))
+    items = seek.order_by(*key_columns).limit(limit).all()
+
+    if len(items) < limit and timestamp.expression.nullable:
+        items += query.filter(timestamp.is_(None))\
+            .order_by(*tiebreakers)\
+            .limit(limit - len(items))\
+            .all()
+    return items
+
+
+def estimate_count(query):
+    """Estimate the number of rows the query matches from the planner's statistics."""
+    statement = query.order_by(None).statement.compile(dialect=db.engine.dialect)
+    plan = db.session.connection()\
+        .execute('EXPLAIN (FORMAT JSON) ' + str(statement), statement.params)\
+        .scalar()
+    return plan[0]['Plan']['Plan Rows']
+
+
+def encode_cursor(key):
+    """Encode a row's key into an opaque cursor."""
+    values = [value.isoformat() if isinstance(value, dt.datetime) else
+              str(value) if isinstance(value, uuid.UUID) else value
+              for value in key]
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, key_columns):
+    """Decode an opaque cursor back into a row's key, checking it against the key columns' types.
+
+    Only the timestamp, the first column, can be null.
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        if not isinstance(values, list) or len(values) != len(key_columns):
+            raise ValueError('wrong number of key columns')
+        return [None if value is None and i == 0 else _decode_key_value(column, value)
+                for i, (column, value) in enumerate(zip(key_columns, values))]
+    except (binascii.Error, ValueError, TypeError, AttributeError, NotImplementedError):
+        raise BadRequest(Errors.BAD_CURSOR)
+
+
+def _decode_key_value(column, value):
+    """Turn a cursor's value for a key column back into the column's Python type.
+
+    :raises ValueError: if it isn't one
+    """
+    if isinstance(column.type, UUID):
+        key = uuid.UUID(value)
+        return key if column.type.as_uuid else str(key)
+    python_type = column.type.python_type
+    if python_type is dt.datetime:
+        return dt.datetime.fromisoformat(value)
+    if not isinstance(value, python_type) or isinstance(value, bool):
+        raise ValueError('expected {}'.format(python_type.__name__))
+    return value
+
+
+def _cursor_url(cursor, per_page):
+    """Make the link to a page of cursor pagination."""
+    url = request.path + '?pagination=cursor&per_page={per_page}'.format(per_page=per_page)
+    if cursor is not None:
+        url += '&cursor={cursor}'.format(cursor=cursor)
+    return url
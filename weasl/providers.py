@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""Long-lived clients for the outbound providers (SES, Twilio, Google)."""
+import itertools
+import random
+import threading
+import time
+from collections import OrderedDict, deque
+from types import SimpleNamespace
+
+import boto3
+import requests
+from botocore.config import Config as BotoConfig
+from requests.adapters import HTTPAdapter
+from twilio.rest import Client as TwilioClient
+
+
+class Providers(object):
+    """The provider clients shared by every request an app serves.
+
+    Built once in create_app so client construction, credential resolution and
+    TLS handshakes aren't paid per login. boto3 clients are thread-safe, and the
+    HTTP session's connection pool is sized for the worker's threads.
+    """
+
+    def __init__(self, ses, twilio, http):
+        self.ses = ses
+        self.twilio = twilio
+        self.http = http
+
+    @classmethod
+    def from_config(cls, config):
+        """Make the providers described by the app config."""
+        if config.get('FAKE_PROVIDERS'):
+            return FakeProviders.from_config(config)
+        pool_size = config['PROVIDER_POOL_SIZE']
+        return cls(
+            ses=boto3.client(
+                'ses',
+                region_name=config['SES_REGION'],
+                config=BotoConfig(max_pool_connections=pool_size, retries={'max_attempts': 2}),
+            ),
+            twilio=TwilioClient(config['TWILIO_ACCOUNT_SID'], config['TWILIO_AUTH_TOKEN']),
+            http=make_http_session(pool_size),
+        )
+
+
+def make_http_session(pool_size):
+    """Make a keep-alive HTTP session with a connection pool of the given size."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=1)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+class FakeProviders(Providers):
+    """Providers that record what would have been sent instead of calling out.
+
+    Used by the tests and for running locally without provider credentials.
+    Each call can be slowed by a fixed latency and fail at a given rate, to
+    stand in for the real providers under load.
+    """
+
+    def __init__(self, latency=0, failure_rate=0):
+        simulator = ProviderSimulator(latency, failure_rate)
+        super().__init__(ses=FakeSES(simulator), twilio=FakeTwilio(simulator), http=FakeHTTP(simulator))
+
+    @classmethod
+    def from_config(cls, config):
+        """Make fake providers with the latency and failure rate in the app config."""
+        return cls(
+            latency=config.get('FAKE_PROVIDER_LATENCY_MS', 0) / 1000,
+            failure_rate=config.get('FAKE_PROVIDER_FAILURE_RATE', 0),
+        )
+
+
+# Sends and requests a fake provider keeps, so long runs against the fakes use bounded memory
+FAKE_HISTORY_SIZE = 1000
+
+
+class ProviderUnavailable(Exception):
+    """Raised by a fake provider to simulate a failed call."""
+
+
+class ProviderSimulator(object):
+    """Delays fake provider calls and decides which ones fail."""
+
+    def __init__(self, latency=0, failure_rate=0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+
+    def call(self):
+        """Wait out the latency, then tell whether the call fails."""
+        if self.latency:
+            time.sleep(self.latency)
+        return self.failure_rate > 0 and random.random() < self.failure_rate
+
+
+def _remember(latest, key, value):
+    """Record the latest value for a key, forgetting the least recently updated key once there are too many."""
+    latest.pop(key, None)
+    latest[key] = value
+    if len(latest) > FAKE_HISTORY_SIZE:
+        latest.popitem(last=False)
+
+
+class FakeSES(object):
+    """Records the latest emails sent through it, and the latest to each address."""
+
+    def __init__(self, simulator=None):
+        self.sent = deque(maxlen=FAKE_HISTORY_SIZE)
+        self.latest = OrderedDict()
+        self.simulator = simulator or ProviderSimulator()
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+
+    def send_email(self, **kwargs):
+        if self.simulator.call():
+            raise ProviderUnavailable('SES')
+        with self._lock:
+            self.sent.append(kwargs)
+            for address in kwargs['Destination']['ToAddresses']:
+                _remember(self.latest, address, kwargs)
+            return {'MessageId': str(next(self._ids))}
+
+
+class FakeTwilio(object):
+    """Records the latest text messages sent through it, and the latest to each number."""
+
+    def __init__(self, simulator=None):
+        self.sent = deque(maxlen=FAKE_HISTORY_SIZE)
+        self.latest = OrderedDict()
+        self.simulator = simulator or ProviderSimulator()
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self.messages = SimpleNamespace(create=self._create_message)
+
+    def _create_message(self, **kwargs):
+        if self.simulator.call():
+            raise ProviderUnavailable('Twilio')
+        with self._lock:
+            self.sent.append(kwargs)
+            _remember(self.latest, kwargs['to'], kwargs)
+            sid = str(next(self._ids))
+        return SimpleNamespace(sid=sid, **kwargs)
+
+
+class FakeHTTP(object):
+    """Answers GETs with canned responses registered per URL, and records the latest requests."""
+
+    def __init__(self, simulator=None):
+        self.responses = {}
+        self.requests = deque(maxlen=FAKE_HISTORY_SIZE)
+        self.simulator = simulator or ProviderSimulator()
+
+    def respond(self, url, json, status_code=200):
+        """Answer GETs to the URL with the given JSON body.
+
+        :param json: the body, or a function of the request's keyword arguments that makes it
+        """
+        self.responses[url] = (status_code, json)
+
+    def get(self, url, **kwargs):
+        self.requests.append((url, kwargs))
+        if self.simulator.call():
+            return FakeResponse(503, {})
+        status_code, body = self.responses.get(url, (404, {}))
+        return FakeResponse(status_code, body(**kwargs) if callable(body) else body)
+
+
+class FakeResponse(object):
+
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self._body = body
+
+    def json(self):
+        return self._body
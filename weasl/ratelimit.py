@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""Rate limits for the widget's send routes.
+
+Sends are limited per org, per destination (the phone number or email) and
+per client IP, each as a token bucket of ``requests`` sends refilling over
+``seconds``. The defaults come from RATE_LIMITS and an org can override each
+scope with a ``rate_limit_<scope>`` setting of ``"<requests>/<seconds>"``, or
+``"off"``. Org settings are reloaded only when the org's version changes, so
+with the org cache warm a rejected send doesn't touch the database.
+
+Buckets live in a backend. The default keeps them in this process; a shared
+backend (e.g. Redis) implements RateLimitBackend so every worker draws from
+the same buckets.
+"""
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from functools import wraps
+
+from flask import current_app, g, request
+
+from weasl.constants import Errors
+from weasl.errors import TooManyRequests
+from weasl.metrics import RATE_LIMITED
+from weasl.org.models import OrgProperty, OrgPropertyNamespaces
+
+SCOPES = ('org', 'destination', 'ip')
+# A send answered with an existing token gives back only its destination's token. It still counts against
+# the org and IP limits, which keep a client repeating sends from costing a locked read each time unchecked.
+REFUNDED_SCOPES = ('destination',)
+SETTING_PREFIX = 'rate_limit_'
+
+Limit = namedtuple('Limit', ['requests', 'seconds'])
+
+
+def parse_limit(value):
+    """Parse a ``"<requests>/<seconds>"`` limit, or None for ``"off"``.
+
+    :raises ValueError: for anything else
+    """
+    if value is None or value.strip().lower() == 'off':
+        return None
+    requests, _, seconds = value.partition('/')
+    limit = Limit(int(requests), float(seconds))
+    if limit.requests <= 0 or limit.seconds <= 0:
+        raise ValueError('rate limits must be positive')
+    return limit
+
+
+class RateLimitBackend(object):
+    """Where the token buckets are kept."""
+
+    def acquire(self, buckets, now):
+        """Take a token from every bucket, or from none of them if any is empty.
+
+        :param buckets list: tuples of (key, Limit)
+        :param now float: the current time in seconds
+        :return: 0 if the tokens were taken, else seconds until they all could be
+        """
+        raise NotImplementedError
+
+    def release(self, buckets, now):
+        """Give back the token acquire took from every bucket."""
+        raise NotImplementedError
+
+    def clear(self):
+        """Empty every bucket."""
+        raise NotImplementedError
+
+
+class MemoryBackend(RateLimitBackend):
+    """Token buckets in this process, bounded to the most recently used max_keys.
+
+    Each bucket is stored as the time it will next be full (GCRA), so a check
+    is a dict lookup and some arithmetic.
+    """
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._full_at = OrderedDict()
+        self._lock = threading.Lock()
+
+    def acquire(self, buckets, now):
+        with self._lock:
+            taken = []
+            retry_after = 0
+            for key, limit in buckets:
+                interval = limit.seconds / limit.requests
+                full_at = max(self._full_at.get(key, now), now) + interval
+                if full_at - now > limit.seconds:
+                    retry_after = max(retry_after, full_at - now - limit.seconds)
+                taken.append((key, full_at))
+            if retry_after:
+                return retry_after
+            for key, full_at in taken:
+                self._full_at[key] = full_at
+                self._full_at.move_to_end(key)
+            while len(self._full_at) > self.max_keys:
+                self._full_at.popitem(last=False)
+            return 0
+
+    def release(self, buckets, now):
+        with self._lock:
+            for key, limit in buckets:
+                if key in self._full_at:
+                    self._full_at[key] -= limit.seconds / limit.requests
+
+    def clear(self):
+        with self._lock:
+            self._full_at.clear()
+
+
+class RateLimiter(object):
+    """Checks sends against the default and per-org limits."""
+
+    def __init__(self, backend, defaults, enabled=True, trusted_proxies=0, clock=time.time):
+        """Create a new limiter.
+
+        :param defaults dict: a Limit, or None for no limit, per scope
+        :param trusted_proxies int: proxies in front of the app that append
+            the client's address to X-Forwarded-For
+        """
+        self.backend = backend
+        self.defaults = defaults
+        self.enabled = enabled
+        self.trusted_proxies = trusted_proxies
+        self.clock = clock
+        self._org_limits = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        """Make the limiter for an app's config, with an in-memory backend."""
+        return cls(
+            MemoryBackend(config['RATE_LIMIT_MAX_KEYS']),
+            {scope: parse_limit(config['RATE_LIMITS'].get(scope)) for scope in SCOPES},
+            enabled=config['RATE_LIMITING'],
+            trusted_proxies=config['RATE_LIMIT_TRUSTED_PROXIES'],
+        )
+
+    def limits_for(self, org):
+        """Get the org's limits per scope, loading its settings when its version changes.
+
+        The org comes from the org cache, so in other processes a change to its
+        limits applies within ORG_CACHE_TTL seconds.
+        """
+        with self._lock:
+            cached = self._org_limits.get(org.id)
+        if cached is not None and cached[0] == org.version:
+            return cached[1]
+        limits = dict(self.defaults)
+        settings = OrgProperty.query.filter(
+            OrgProperty.org_id == org.id,
+            OrgProperty.property_namespace == OrgPropertyNamespaces.SETTINGS,
+            OrgProperty.property_name.in_([SETTING_PREFIX + scope for scope in SCOPES]),
+        )
+        for setting in settings:
+            try:
+                limits[setting.property_name[len(SETTING_PREFIX):]] = parse_limit(setting.property_value)
+            except ValueError:
+                current_app.logger.warning('Ignoring bad %s for org %s: %r', setting.property_name, org.id,
+                                           setting.property_value)
+        with self._lock:
+            self._org_limits[org.id] = (org.version, limits)
+        return limits
+
+    def client_ip(self):
+        """Get the client's address, trusting only the proxies in front of the app."""
+        forwarded = request.access_route if request.headers.get('X-Forwarded-For') else []
+        if self.trusted_proxies and len(forwarded) >= self.trusted_proxies:
+            return forwarded[-self.trusted_proxies]
+        return request.remote_addr
+
+    def buckets(self, channel, org, destination, scopes=SCOPES):
+        """Get the org, destination and client IP's buckets for a send, as (key, Limit) tuples.
+
+        :param scopes: the scopes to get buckets for
+        """
+        limits = self.limits_for(org)
+        values = {'org': '', 'destination': destination, 'ip': self.client_ip()}
+        return [
+            ('{}:{}:{}:{}'.format(channel, scope, org.id, values[scope]), limits[scope])
+            for scope in scopes if limits[scope] is not None and values[scope] is not None
+        ]
+
+    def check(self, buckets):
+        """Take a send from each of the buckets.
+
+        :return: 0 if the send is allowed, else seconds until it would be
+        """
+        if not buckets:
+            return 0
+        return self.backend.acquire(buckets, self.clock())
+
+    def refund(self, buckets):
+        """Give back a send taken from each of the buckets."""
+        if buckets:
+            self.backend.release(buckets, self.clock())
+
+
+def rate_limited(channel, destination_field):
+    """Reject sends over the org's rate limits with a 429, before any database work.
+
+    Goes under client_id_required, which loads the org. A send that turns out
+    to send nothing gives its destination's token back with refund_send.
+
+    :param destination_field str: the JSON field with the phone number or email
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            limiter = current_app.rate_limiter
+            if limiter.enabled:
+                destination = (request.get_json(silent=True) or {}).get(destination_field)
+                if isinstance(destination, str):
+                    destination = destination.strip().lower()
+                else:
+                    destination = None
+                buckets = limiter.buckets(channel, g.current_org, destination)
+                retry_after = limiter.check(buckets)
+                if retry_after:
+                    RATE_LIMITED.labels(channel).inc()
+                    raise TooManyRequests(Errors.RATE_LIMITED, retry_after=retry_after)
+                g.rate_limit_refund = limiter.buckets(channel, g.current_org, destination, REFUNDED_SCOPES)
+            return f(*args, **kwargs)
+        return decorated_function
+    return decorator
+
+
+def refund_send():
+    """Give back what the current send took from its destination's limit, e.g. when it reused a token."""
+    buckets = g.pop('rate_limit_refund', None)
+    if buckets:
+        current_app.rate_limiter.refund(buckets)
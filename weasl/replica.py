@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""Routing read-only routes to a read replica.
+
+The replica is the 'replica' entry in SQLALCHEMY_BINDS. Routes decorated with
+read_replica run their queries against it, unless it's further behind the
+primary than REPLICA_MAX_LAG_SECONDS, in which case they stay on the primary.
+Flushes always go to the primary.
+"""
+import math
+import threading
+import time
+from functools import wraps
+
+from flask import current_app, g, has_request_context
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy.exc import DBAPIError
+
+from weasl.metrics import REPLICA_ROUTING
+
+REPLICA_BIND = 'replica'
+LAG_SQL = (
+    'SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 '
+    'ELSE extract(epoch FROM now() - pg_last_xact_replay_timestamp()) END'
+)
+
+
+class RoutingSession(SignallingSession):
+    """A session that reads from the replica while a read_replica route is being served."""
+
+    def __init__(self, db, **options):
+        self.db = db
+        super().__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if not self._flushing and has_request_context() and g.get('read_replica'):
+            return self.db.get_engine(self.app, bind=REPLICA_BIND)
+        return super().get_bind(mapper, clause)
+
+
+class ReplicaLag(object):
+    """How far the replica is behind the primary, checked at most once per interval.
+
+    A primary, or any database that isn't replaying WAL, counts as caught up,
+    so the same database can be configured as its own replica. A replica that
+    can't be reached counts as infinitely far behind.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._seconds = None
+        self._checked_at = None
+        self._lock = threading.Lock()
+
+    def seconds(self, engine):
+        """Get the replica's lag in seconds, checking it again if the last check is stale."""
+        with self._lock:
+            now = time.monotonic()
+            if self._checked_at is None or now - self._checked_at >= self.interval:
+                self._seconds = self._check(engine)
+                self._checked_at = now
+            return self._seconds
+
+    def clear(self):
+        """Forget the last check."""
+        with self._lock:
+            self._checked_at = None
+
+    @staticmethod
+    def _check(engine):
+        try:
+            with engine.connect() as conn:
+                lag = conn.execute(LAG_SQL).scalar()
+        except DBAPIError:
+            return math.inf
+        return float(lag or 0)
+
+
+def replica_configured(app):
+    """Check whether the app has a read replica."""
+    return REPLICA_BIND in (app.config.get('SQLALCHEMY_BINDS') or {})
+
+
+def replica_ready():
+    """Check whether the replica is configured and caught up enough to read from."""
+    if not replica_configured(current_app):
+        return False
+    engine = current_app.extensions['sqlalchemy'].db.get_engine(current_app, bind=REPLICA_BIND)
+    return current_app.replica_lag.seconds(engine) <= current_app.config['REPLICA_MAX_LAG_SECONDS']
+
+
+def read_replica(f):
+    """Run a read-only route's queries on the read replica when it's caught up.
+
+    Goes under the auth decorators, so the user is still loaded from the primary.
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if not replica_configured(current_app):
+            return f(*args, **kwargs)
+        g.read_replica = replica_ready()
+        REPLICA_ROUTING.labels('replica' if g.read_replica else 'primary').inc()
+        try:
+            return f(*args, **kwargs)
+        finally:
+            g.read_replica = False
+    return decorated_function
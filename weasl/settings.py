@@ -12,12 +12,104 @@ class Config(object):
     PROJECT_ROOT = os.path.abspath(os.path.join(APP_DIR, os.pardir))
     SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+    # DB engine; each process holds at most DB_POOL_SIZE + DB_MAX_OVERFLOW connections
+    DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+    DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 5))
+    DB_POOL_TIMEOUT = int(os.environ.get('DB_POOL_TIMEOUT', 10))
+    DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+    # Pinging costs a SELECT 1 per checkout; recycling already replaces connections before idle timeouts
+    DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', 'false') == 'true'
+    # psycopg2 executemany: values (multi-row INSERT ... VALUES), batch, or empty for one statement per row
+    DB_EXECUTEMANY_MODE = os.environ.get('DB_EXECUTEMANY_MODE', 'values') or None
+    # Connecting through PgBouncer in transaction mode: no per-connection settings, only per-transaction ones
+    DB_PGBOUNCER = os.environ.get('DB_PGBOUNCER', 'false') == 'true'
+    # Statement timeouts in milliseconds (0 for none): for every connection, and for requests per blueprint
+    DB_STATEMENT_TIMEOUT_MS = int(os.environ.get('DB_STATEMENT_TIMEOUT_MS', 0))
+    DB_BLUEPRINT_STATEMENT_TIMEOUTS_MS = {
+        'widget': int(os.environ.get('DB_WIDGET_STATEMENT_TIMEOUT_MS', 5000)),
+        'end_users': int(os.environ.get('DB_API_STATEMENT_TIMEOUT_MS', 30000)),
+        'orgs': int(os.environ.get('DB_API_STATEMENT_TIMEOUT_MS', 30000)),
+        'internal': int(os.environ.get('DB_API_STATEMENT_TIMEOUT_MS', 30000)),
+    }
+
+    # Optional read replica for the admin listings, which fall back to the primary while it lags
+    SQLALCHEMY_BINDS = {
+        'replica': os.environ['REPLICA_DATABASE_URI'],
+    } if os.environ.get('REPLICA_DATABASE_URI') else {}
+    REPLICA_MAX_LAG_SECONDS = float(os.environ.get('REPLICA_MAX_LAG_SECONDS', 5))
+    REPLICA_LAG_CHECK_SECONDS = float(os.environ.get('REPLICA_LAG_CHECK_SECONDS', 5))
+
     BASE_API_HOST = 'http://localhost:5000'
     BASE_SITE_HOST = 'http://localhost:5000'
     IFRAME_HOST = 'http://lcl.weasl.in:9001'
     APP_SPA_HOST = 'http://localhost:3000'
     SEND_EMAILS = True
     SEND_SMS = True
+    # Queue sends in the delivery outbox for `flask deliver` instead of sending inline
+    ASYNC_DELIVERY = os.environ.get('ASYNC_DELIVERY', 'false') == 'true'
+    DELIVERY_CONCURRENCY = int(os.environ.get('DELIVERY_CONCURRENCY', 4))
+    DELIVERY_BATCH_SIZE = int(os.environ.get('DELIVERY_BATCH_SIZE', 50))
+    DELIVERY_POLL_INTERVAL = float(os.environ.get('DELIVERY_POLL_INTERVAL', 1))
+    DELIVERY_LEASE_SECONDS = 60
+    DELIVERY_BACKOFF_SECONDS = 5
+    DELIVERY_MAX_ATTEMPTS = 5
+    # Embed org/admin claims in auth tokens and skip loading the end user
+    STATELESS_AUTH = os.environ.get('STATELESS_AUTH', 'false') == 'true'
+    # How EndUser.properties is loaded with the end user: select, selectin, joined or subquery
+    END_USER_PROPERTIES_LOADER = os.environ.get('END_USER_PROPERTIES_LOADER', 'selectin')
+
+    # `flask reap-tokens` deletes SMS and email tokens older than this
+    TOKEN_RETENTION_DAYS = int(os.environ.get('TOKEN_RETENTION_DAYS', 30))
+    TOKEN_REAP_BATCH_SIZE = int(os.environ.get('TOKEN_REAP_BATCH_SIZE', 5000))
+    # Monthly token partitions to keep created ahead of time, once `flask partition-tokens` has run
+    TOKEN_PARTITION_MONTHS_AHEAD = 3
+
+    # Rows `/end_users/import` and `flask import-end-users` stage and merge per transaction
+    IMPORT_CHUNK_SIZE = int(os.environ.get('IMPORT_CHUNK_SIZE', 50000))
+    # Largest body `/end_users/import` takes; ~100k rows, which merge in about 10s, well inside request timeouts
+    IMPORT_MAX_BYTES = int(os.environ.get('IMPORT_MAX_BYTES', 10 * 1024 * 1024))
+    # Rows the exports fetch from their server-side cursor, and encode, at a time
+    EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', 1000))
+
+    # Repeated widget sends answer with the live token instead of sending another until the cooldown
+    # has passed (0 to always send), or for as long as the TTL with the same Idempotency-Key header
+    SEND_COOLDOWN_SECONDS = int(os.environ.get('SEND_COOLDOWN_SECONDS', 30))
+    IDEMPOTENCY_KEY_TTL_SECONDS = int(os.environ.get('IDEMPOTENCY_KEY_TTL_SECONDS', 24 * 60 * 60))
+    # Widget send limits per org, destination and client IP, as "<requests>/<seconds>" or "off";
+    # orgs override them with rate_limit_<scope> settings
+    RATE_LIMITING = os.environ.get('RATE_LIMITING', 'true') == 'true'
+    RATE_LIMITS = {
+        'org': os.environ.get('RATE_LIMIT_ORG', '600/60'),
+        'destination': os.environ.get('RATE_LIMIT_DESTINATION', '5/300'),
+        'ip': os.environ.get('RATE_LIMIT_IP', '20/60'),
+    }
+    RATE_LIMIT_MAX_KEYS = int(os.environ.get('RATE_LIMIT_MAX_KEYS', 100000))
+    # Proxies in front of the app appending to X-Forwarded-For, e.g. Heroku's router
+    RATE_LIMIT_TRUSTED_PROXIES = int(os.environ.get('RATE_LIMIT_TRUSTED_PROXIES', 1 if 'DYNO' in os.environ else 0))
+
+    # Org lookups by client ID/secret. Invalidation only reaches the process that changed the org, so other
+    # workers and dynos keep its old secret, settings and rate limits for up to ORG_CACHE_TTL seconds
+    ORG_CACHE_TTL = int(os.environ.get('ORG_CACHE_TTL', 60))
+    ORG_CACHE_MAX_SIZE = int(os.environ.get('ORG_CACHE_MAX_SIZE', 1024))
+    # Seconds browsers and CDNs may reuse /widget/org before revalidating its ETag
+    WIDGET_ORG_MAX_AGE = int(os.environ.get('WIDGET_ORG_MAX_AGE', 60))
+
+    # Per-request SQL, provider and total timings: as a Server-Timing header, and logged to weasl.requests
+    SERVER_TIMING = os.environ.get('SERVER_TIMING', 'false') == 'true'
+    LOG_REQUESTS = os.environ.get('LOG_REQUESTS', 'false') == 'true'
+    # Bearer token for scraping /internal/metrics; the endpoint 404s without one
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+    # Pushgateway URL `flask deliver` pushes its metrics to every METRICS_PUSH_SECONDS; it has no endpoint to scrape
+    METRICS_PUSHGATEWAY = os.environ.get('METRICS_PUSHGATEWAY')
+    METRICS_PUSH_SECONDS = float(os.environ.get('METRICS_PUSH_SECONDS', 15))
+
+    # Outbound providers; fakes record sends instead of calling out
+    FAKE_PROVIDERS = os.environ.get('FAKE_PROVIDERS', 'false') == 'true'
+    FAKE_PROVIDER_LATENCY_MS = float(os.environ.get('FAKE_PROVIDER_LATENCY_MS', 0))
+    FAKE_PROVIDER_FAILURE_RATE = float(os.environ.get('FAKE_PROVIDER_FAILURE_RATE', 0))
+    PROVIDER_POOL_SIZE = int(os.environ.get('PROVIDER_POOL_SIZE', 10))
+    PROVIDER_TIMEOUT_SECONDS = 10
+    SES_REGION = 'us-west-2'
 
     # Twilio stuff
     TWILIO_AUTH_TOKEN = os.environ.get('TWILIO_AUTH_TOKEN')
@@ -68,6 +160,7 @@ class TestConfig(Config):
     DEBUG = True
     SEND_EMAILS = False
     SEND_SMS = False
+    FAKE_PROVIDERS = True
     SQLALCHEMY_DATABASE_URI = 'postgresql://weasl:weasl123@' + \
         'localhost:5432/weasl_test'
     APP_SPA_HOST = 'http://dev.weasl.in'
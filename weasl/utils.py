@@ -4,7 +4,6 @@ from functools import wraps, update_wrapper
 from weasl.constants import Errors
 from weasl.errors import Unauthorized, Forbidden, BadRequest
 from weasl.end_user.models import EndUser
-from weasl.org.models import Org
 
 
 def friendly_arg_get(key, default=None, type_cast=None):
@@ -55,7 +54,7 @@ def client_secret_required(f):
         auth_header = get_request_secret_key()
         if not auth_header:
             raise Unauthorized(Errors.CLIENT_SECRET_REQUIRED)
-        org = Org.from_client_secret(auth_header)
+        org = current_app.org_cache.from_client_secret(auth_header)
         if not org:
             raise Unauthorized(Errors.INVALID_CLIENT_SECRET)
 
@@ -70,7 +69,7 @@ def client_id_required(f):
         auth_header = request.headers.get('X-Weasl-Client-Id')
         if not auth_header:
             raise Unauthorized(Errors.CLIENT_ID_REQUIRED)
-        org = Org.from_client_id(auth_header)
+        org = current_app.org_cache.from_client_id(auth_header)
         if not org:
             raise Unauthorized(Errors.INVALID_CLIENT_ID)
 
@@ -82,3 +81,23 @@ def client_id_required(f):
 def get_request_secret_key():
     header = request.headers.get('X-Weasl-Client-Secret')
     return header
+
+
+def conditional_response(etag, make_response, **cache_control):
+    """Answer with a 304 if the request already holds the representation with the given ETag.
+
+    Otherwise answer with make_response(), so nothing is serialized for clients
+    that are up to date.
+
+    :param etag str: a strong ETag for the representation
+    :param make_response callable: makes the full response
+    :param cache_control: Cache-Control directives to send, e.g. max_age=60
+    """
+    if request.if_none_match.contains(etag):
+        response = current_app.response_class(status=304)
+    else:
+        response = make_response()
+    response.set_etag(etag)
+    for directive, value in cache_control.items():
+        setattr(response.cache_control, directive, value)
+    return response